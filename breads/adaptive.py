@@ -0,0 +1,157 @@
+"""
+Coarse to fine grid search, see adaptive_grid_search().
+"""
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from breads.parallel import Executor, thread_split
+from breads.storage import _split_output, _store_outputs
+
+__all__ = ('adaptive_grid_search',)
+
+
+def adaptive_grid_search(para_vecs,dataobj,fm_func,fm_paras,coarse_step=8,top_k=10,delta_log_prob=None,
+                         rank_by="log_prob",dense=True,numthreads=None,mypool=None,**kwargs):
+    """
+    Coarse to fine version of grid_search() for sharply peaked posteriors.
+    The grid defined by para_vecs is first evaluated with a step of coarse_step points along each axis. The step is then
+    halved at each iteration, and only the neighborhood of the best points found so far is evaluated at the new
+    resolution, until the resolution of para_vecs is reached.
+
+    Args:
+        para_vecs, dataobj, fm_func, fm_paras: See grid_search(). para_vecs defines the final resolution.
+        coarse_step: Initial step along each axis in number of grid points, as an integer or a list with one integer
+            per axis (e.g. 1 for an axis that should not be refined). Default 8.
+        top_k: Number of best points refined at each iteration. Default 10.
+        delta_log_prob: If not None, all the points within delta_log_prob of the best point are also refined.
+        rank_by: Quantity used to select the best points, "log_prob" (default) or "log_bayes_factor"
+            (log_prob - log_prob_H0, requires computeH0=True).
+        dense: If True (default), also return the outputs on the full grid, where the points that were not evaluated
+            are linearly interpolated from the initial coarse grid.
+        numthreads, mypool: See grid_search(). If numthreads is defined, a breads.parallel.Executor (or a ThreadPool
+            with backend="threads") is used for all the iterations.
+        kwargs: Other arguments passed to grid_search() (e.g. computeH0, bounds). out_path is not supported.
+
+    Returns:
+        sparse: Dictionary with the evaluated points: "indices" (N_points, N_paras) indices in the grid,
+            "nonlin_paras" (N_points, N_paras) values of the non-linear parameters, and "log_prob", "log_prob_H0",
+            "rchi2", "linparas", "linparas_err" as in grid_search() with a first axis of size N_points, and "status"
+            (see return_status in grid_search()).
+        dense: log_prob, log_prob_H0, rchi2, linparas, linparas_err on the full grid as in grid_search(), or None if
+            dense is False.
+    """
+    # Imported here because breads.grid_search re-exports adaptive_grid_search()
+    from breads.grid_search import _search
+    if "out_path" in kwargs:
+        raise ValueError("out_path is not supported by adaptive_grid_search().")
+    if rank_by not in ["log_prob", "log_bayes_factor"]:
+        raise ValueError("rank_by must be log_prob or log_bayes_factor.")
+    grid_shape = [np.size(v) for v in para_vecs]
+    N_paras = len(para_vecs)
+    steps = np.zeros(N_paras, dtype=int) + np.array(coarse_step, dtype=int)
+    steps = np.clip(steps, 1, None)
+
+    # Initial coarse grid, always including the last point of each axis
+    coarse_indices = [np.unique(np.append(np.arange(0, n, step), n - 1)) for n, step in zip(grid_shape, steps)]
+    coarse_points = np.stack([np.ravel(ind) for ind in np.meshgrid(*coarse_indices, indexing="ij")], axis=1)
+
+    own_pool = numthreads is not None and mypool is None
+    if own_pool:
+        if numthreads == "auto":
+            numthreads = thread_split()[0]
+        if kwargs.get("backend", "processes") == "threads":
+            mypool = ThreadPool(processes=numthreads)
+        else:
+            mypool = Executor(numthreads, dataobj=dataobj, fm_paras=fm_paras)
+    try:
+        evaluated_indices = []
+        evaluated_outs = []
+        evaluated_status = []
+        evaluated_set = set()
+        new_points = coarse_points
+        while True:
+            if len(new_points) != 0:
+                para_grids = [np.asarray(v)[new_points[:, k]] for k, v in enumerate(para_vecs)]
+                _out, _status, _ = _search(para_grids, [len(new_points)], dataobj, fm_func, fm_paras, mypool=mypool,
+                                           **kwargs)
+                evaluated_outs.append(_out)
+                evaluated_status.append(_status)
+                evaluated_indices.append(new_points)
+                evaluated_set.update(np.ravel_multi_index(new_points.T, grid_shape).tolist())
+            if np.all(steps == 1):
+                break
+            indices = np.concatenate(evaluated_indices, axis=0)
+            out = _concatenate_outputs(evaluated_outs)
+
+            # Select the best points evaluated so far
+            criterion = out[:, 0] - out[:, 1] if rank_by == "log_bayes_factor" else out[:, 0]
+            criterion = np.where(np.isfinite(criterion), criterion, -np.inf)
+            selected = np.argsort(criterion)[::-1][0:top_k]
+            if delta_log_prob is not None and np.isfinite(np.max(criterion)):
+                selected = np.union1d(selected, np.where(criterion >= np.max(criterion) - delta_log_prob)[0])
+            selected = selected[np.isfinite(criterion[selected])]
+
+            # Neighborhood of the selected points at the new resolution
+            new_steps = np.clip(steps // 2, 1, None)
+            offsets = np.stack([np.ravel(off) for off in np.meshgrid(
+                *[np.arange(-step, step + 1, new_step) for step, new_step in zip(steps, new_steps)],
+                indexing="ij")], axis=1)
+            candidates = (indices[selected][:, None, :] + offsets[None, :, :]).reshape(-1, N_paras)
+            candidates = candidates[np.all((candidates >= 0) * (candidates < np.array(grid_shape)[None, :]), axis=1)]
+            candidates_flat = np.unique(np.ravel_multi_index(candidates.T, grid_shape))
+            candidates_flat = np.array([l for l in candidates_flat.tolist() if l not in evaluated_set], dtype=int)
+            new_points = np.stack(np.unravel_index(candidates_flat, grid_shape), axis=1).reshape(-1, N_paras)
+            steps = new_steps
+    finally:
+        if own_pool:
+            mypool.close()
+            mypool.join()
+
+    indices = np.concatenate(evaluated_indices, axis=0)
+    out = _concatenate_outputs(evaluated_outs)
+    log_prob, log_prob_H0, rchi2, linparas, linparas_err = _split_output(out)
+    sparse = {"indices": indices,
+              "nonlin_paras": np.stack([np.asarray(v)[indices[:, k]] for k, v in enumerate(para_vecs)], axis=1),
+              "log_prob": log_prob, "log_prob_H0": log_prob_H0, "rchi2": rchi2, "linparas": linparas,
+              "linparas_err": linparas_err, "status": np.concatenate(evaluated_status)}
+    if not dense:
+        return sparse, None
+
+    # Interpolate the coarse grid, which was fully evaluated, and then insert the points evaluated at higher resolution
+    N_coarse = np.prod([np.size(ind) for ind in coarse_indices])
+    dense_out = np.reshape(out[0:N_coarse], [np.size(ind) for ind in coarse_indices] + [out.shape[-1]])
+    for axis, ind in enumerate(coarse_indices):
+        dense_out = _interp_axis(dense_out, axis, ind, grid_shape[axis])
+    dense_out[tuple(indices.T)] = out
+    return sparse, _split_output(dense_out)
+
+
+def _concatenate_outputs(outs):
+    """ Concatenate outputs of _search() of shape (N, 3+2*N_linpara), possibly with different N_linpara. """
+    out = None
+    N_points = 0
+    for _out in outs:
+        N_points += _out.shape[0]
+    k = 0
+    for _out in outs:
+        out = _store_outputs(out, np.arange(k, k + _out.shape[0]), _out, [N_points])
+        k += _out.shape[0]
+    return out
+
+
+def _interp_axis(arr, axis, coarse_indices, n):
+    """ Linear interpolation of arr along axis from the grid indices coarse_indices to range(n). """
+    if np.size(coarse_indices) == 1:
+        return np.take(arr, np.zeros(n, dtype=int), axis=axis)
+    fine_indices = np.arange(n)
+    j = np.clip(np.searchsorted(coarse_indices, fine_indices, side="right") - 1, 0, np.size(coarse_indices) - 2)
+    w = (fine_indices - coarse_indices[j]) / (coarse_indices[j + 1] - coarse_indices[j])
+    w_shape = [1] * arr.ndim
+    w_shape[axis] = n
+    w = np.reshape(w, w_shape)
+    left, right = np.take(arr, j, axis=axis), np.take(arr, j + 1, axis=axis)
+    # Use the coarse values as is at the coarse points, blending them with an infinite neighbor would give nan
+    with np.errstate(invalid="ignore"):
+        blend = left * (1 - w) + right * w
+    return np.where(w == 0, left, np.where(w == 1, right, blend))
@@ -1,15 +1,278 @@
+import hashlib
+import os
+import uuid
+import weakref
 from copy import copy
 
 import matplotlib.pyplot as plt
 import numpy as np
+import scipy.sparse
+from scipy.linalg import cho_solve_banded, cholesky_banded, solve_triangular
 from scipy.optimize import lsq_linear
+from scipy.sparse.csgraph import reverse_cuthill_mckee
 from scipy.special import loggamma
 
-__all__ =  ('fitfm', 'log_prob', 'combined_log_prob', 'nlog_prob')
+from breads import profiling
+from breads.utils import LRUCache
+
+__all__ =  ('fitfm', 'fitfm_batch', 'log_prob', 'combined_log_prob', 'nlog_prob', 'LogProbCache', 'STATUS_NAMES')
+
+# Status codes of a fit (see status in fitfm() and return_status in breads.grid_search.grid_search())
+STATUS_OK = 0
+# fm_func returned no valid data (e.g. too many bad pixels or outside of the field of view)
+STATUS_EMPTY_DATA = 1
+# The planet (first) column of the linear model is zero
+STATUS_NO_PLANET = 2
+# The normal matrix could not be factorized or inverted
+STATUS_SINGULAR = 3
+# The log probability is not a number (e.g. nans in the model)
+STATUS_MODEL_NAN = 4
+# An exception was raised by fm_func or during the fit
+STATUS_EXCEPTION = 5
+# Point not evaluated because of a validity mask
+STATUS_MASKED = 6
+# Point not evaluated (yet)
+STATUS_NOT_COMPUTED = 7
+STATUS_NAMES = {STATUS_OK: "ok", STATUS_EMPTY_DATA: "empty_data", STATUS_NO_PLANET: "no_planet",
+                STATUS_SINGULAR: "singular", STATUS_MODEL_NAN: "model_nan", STATUS_EXCEPTION: "exception",
+                STATUS_MASKED: "masked", STATUS_NOT_COMPUTED: "not_computed"}
+
+# Smallest acceptable squared diagonal element of the Cholesky factor of the column-normalized normal matrix.
+# Below this value, the normal equations are considered too ill-conditioned and a QR decomposition of M is used instead.
+_CHOLESKY_MIN_PIVOT = 1e-10
+# Number of columns of the identity matrix solved at once when computing the diagonal of a sparse inverse normal matrix.
+_SPARSE_INV_CHUNK = 256
+# Number of rows of a reduced precision (e.g. float32) linear model converted to float64 at once.
+_FLOAT64_CHUNK = 4096
+
+def _matvec(M, v, transpose=False):
+    """
+    Compute M.v (or M^T.v if transpose is True) in float64.
+    If M is stored in reduced precision (e.g. float32), it is converted to float64 by chunks of rows to avoid making a
+    float64 copy of the entire matrix.
+    """
+    if scipy.sparse.issparse(M) or M.dtype == np.float64:
+        if transpose:
+            return M.T.dot(v)
+        return M.dot(v)
+    out = np.zeros(M.shape[1] if transpose else M.shape[0])
+    for start in range(0, M.shape[0], _FLOAT64_CHUNK):
+        _M = M[start:start + _FLOAT64_CHUNK].astype(np.float64)
+        if transpose:
+            out += np.dot(_M.T, v[start:start + _FLOAT64_CHUNK])
+        else:
+            out[start:start + _FLOAT64_CHUNK] = np.dot(_M, v)
+    return out
+
+def _normal_matrix(M):
+    """
+    Compute M^T.M accumulating in float64 by chunks of rows if M is stored in reduced precision (e.g. float32).
+    """
+    if M.dtype == np.float64:
+        return np.dot(M.T, M)
+    MTM = np.zeros((M.shape[1], M.shape[1]))
+    for start in range(0, M.shape[0], _FLOAT64_CHUNK):
+        _M = M[start:start + _FLOAT64_CHUNK].astype(np.float64)
+        MTM += np.dot(_M.T, _M)
+    return MTM
+
+def _factorize_normal_equations(M, d):
+    """
+    Factorize the linear least-squares problem d = M.p using a single decomposition.
+
+    The columns of M are first normalized to unit norm to improve the conditioning. A Cholesky decomposition of the
+    normal matrix M^T.M is attempted first. If it fails, or if the problem is too ill-conditioned, a QR decomposition of
+    M is used instead.
+    If M is stored in reduced precision (e.g. float32), the normal matrix is still accumulated in float64.
+
+    Args:
+        M: Linear model as a matrix of shape (Nd,Np).
+        d: Data vector of size Nd.
+
+    Returns:
+        R: Upper triangular matrix of shape (Np,Np) such that (M/colnorms)^T.(M/colnorms) = R^T.R
+        z: Projected data vector R^{-T}.(M/colnorms)^T.d of size Np.
+        colnorms: Norms of the columns of M.
+    """
+    if M.dtype == np.float64:
+        colnorms = np.sqrt(np.sum(M**2, axis=0))
+    else:
+        MTM = _normal_matrix(M)
+        colnorms = np.sqrt(np.diag(MTM))
+    if np.any(colnorms == 0) or not np.all(np.isfinite(colnorms)):
+        raise np.linalg.LinAlgError("Linear model has empty or non-finite columns.")
+    if M.dtype == np.float64:
+        Mn = M / colnorms[None, :]
+        MTM = np.dot(Mn.T, Mn)
+        MTd = np.dot(Mn.T, d)
+    else:
+        MTM = MTM / np.outer(colnorms, colnorms)
+        MTd = _matvec(M, d, transpose=True) / colnorms
+    try:
+        R = np.linalg.cholesky(MTM).T
+        if np.min(np.diag(R))**2 < _CHOLESKY_MIN_PIVOT:
+            raise np.linalg.LinAlgError("Ill-conditioned normal matrix.")
+        z = solve_triangular(R, MTd, trans="T")
+    except np.linalg.LinAlgError:
+        if M.shape[0] < M.shape[1]:
+            raise np.linalg.LinAlgError("Singular matrix: fewer data points than linear parameters.")
+        Q, R = np.linalg.qr(M.astype(np.float64) / colnorms[None, :], mode="reduced")
+        if np.min(np.abs(np.diag(R))) == 0:
+            raise np.linalg.LinAlgError("Singular matrix")
+        z = np.dot(Q.T, d)
+    return R, z, colnorms
+
+def _solve_factorized(R, z, colnorms, full_cov=False, return_cov=True):
+    """
+    Best fit linear parameters, covariance and log determinant from the output of _factorize_normal_equations().
+
+    Because R is triangular, the problem restricted to the first k columns of M is solved by simply passing
+    R[:k,:k], z[:k], colnorms[:k].
+
+    Args:
+        R, z, colnorms: Outputs of _factorize_normal_equations().
+        full_cov: If True, return the full inverse of M^T.M instead of its diagonal.
+        return_cov: If False, skip the O(Np^3) covariance calculation and return None instead.
+
+    Returns:
+        paras: Best fit linear parameters.
+        iMTM: Diagonal of (M^T.M)^{-1}, or the full matrix if full_cov is True.
+        logdet_MTM: log|M^T.M|
+    """
+    paras = solve_triangular(R, z) / colnorms
+    logdet_MTM = 2 * np.sum(np.log(np.abs(np.diag(R)))) + 2 * np.sum(np.log(colnorms))
+    if not return_cov:
+        return paras, None, logdet_MTM
+    iR = solve_triangular(R, np.eye(R.shape[0]))
+    if full_cov:
+        iMTM = np.dot(iR, iR.T) / np.outer(colnorms, colnorms)
+    else:
+        iMTM = np.sum(iR**2, axis=1) / colnorms**2
+    return paras, iMTM, logdet_MTM
+
+def _bordered_factorization(M_fixed, m, d, nuisance_cache):
+    """
+    Factorize the linear least-squares problem d = [M_fixed,m].p by adding the column m to a cached factorization of
+    M_fixed (bordered Cholesky update). The factorization of M_fixed is computed with _factorize_normal_equations() the
+    first time a given (M_fixed, d) is seen and stored in nuisance_cache. Updating it costs O(Nd.Np) instead of O(Nd.Np^2).
+
+    Args:
+        M_fixed: Linear model of shape (Nd,Np-1) that does not depend on the parameters being explored.
+        m: New column of size Nd.
+        d: Data vector of size Nd.
+        nuisance_cache: Dictionary-like object (e.g. breads.utils.LRUCache) storing the factorizations of M_fixed.
+
+    Returns:
+        R, z, colnorms: Same as _factorize_normal_equations() for the matrix [M_fixed,m].
+        iMTM: Diagonal of ([M_fixed,m]^T.[M_fixed,m])^{-1}
+    """
+    # Hashing the whole matrix costs O(Nd.Np) like the update itself, but two different matrices can never share a key.
+    key = hashlib.sha1()
+    for arr in (M_fixed, d):
+        arr = np.ascontiguousarray(arr)
+        key.update((str(arr.dtype) + str(arr.shape)).encode())
+        key.update(arr.data)
+    key = key.hexdigest()
+    cached = nuisance_cache.get(key)
+    if cached is None:
+        R_f, z_f, colnorms_f = _factorize_normal_equations(M_fixed, d)
+        iR_f = solve_triangular(R_f, np.eye(R_f.shape[0]))
+        cached = (R_f, z_f, colnorms_f, iR_f, np.sum(iR_f ** 2, axis=1))
+        nuisance_cache[key] = cached
+    R_f, z_f, colnorms_f, iR_f, diag_iMTM_f = cached
+
+    m = m.astype(np.float64)
+    colnorm_m = np.sqrt(np.sum(m ** 2))
+    if colnorm_m == 0 or not np.isfinite(colnorm_m):
+        raise np.linalg.LinAlgError("Linear model has empty or non-finite columns.")
+    mn = m / colnorm_m
+    r = solve_triangular(R_f, _matvec(M_fixed, mn, transpose=True) / colnorms_f, trans="T")
+    rho2 = 1 - np.dot(r, r)
+    if rho2 < _CHOLESKY_MIN_PIVOT:
+        raise np.linalg.LinAlgError("Ill-conditioned normal matrix.")
+    rho = np.sqrt(rho2)
+
+    Np = R_f.shape[0] + 1
+    R = np.zeros((Np, Np))
+    R[:-1, :-1] = R_f
+    R[:-1, -1] = r
+    R[-1, -1] = rho
+    z = np.append(z_f, (np.dot(mn, d) - np.dot(r, z_f)) / rho)
+    colnorms = np.append(colnorms_f, colnorm_m)
+    iMTM = np.append(diag_iMTM_f + np.dot(iR_f, r) ** 2 / rho2, 1 / rho2) / colnorms ** 2
+    return R, z, colnorms, iMTM
+
+def _solve_sparse_normal_equations(M, d):
+    """
+    Sparse equivalent of _factorize_normal_equations() and _solve_factorized() for a scipy.sparse linear model M whose
+    last column is the planet model.
+
+    The columns are ordered with a reverse Cuthill-McKee permutation to minimize the bandwidth of the normal matrix of
+    the nuisance (all but last) columns, which is then factorized with a banded Cholesky decomposition. Spline-based
+    nuisance models are block diagonal (e.g. by detector row or spaxel) which makes this normal matrix narrow banded.
+    The dense planet column is added with a bordered update.
+
+    Args:
+        M: Linear model as a scipy.sparse matrix of shape (Nd,Np).
+        d: Data vector of size Nd.
+
+    Returns:
+        paras: Best fit linear parameters.
+        iMTM: Diagonal of (M^T.M)^{-1}
+        logdet_MTM: log|M^T.M|
+        paras_H0: Best fit linear parameters without the last column.
+        logdet_MTM_H0: log|M^T.M| without the last column.
+        z_planet: Reduction of the chi2 from adding the last column is z_planet**2.
+    """
+    M = scipy.sparse.csc_matrix(M, dtype=np.float64)
+    colnorms = np.sqrt(np.ravel(M.multiply(M).sum(axis=0)))
+    if np.any(colnorms == 0) or not np.all(np.isfinite(colnorms)):
+        raise np.linalg.LinAlgError("Linear model has empty or non-finite columns.")
+    Mn = M @ scipy.sparse.diags(1 / colnorms)
+    Mn_f = Mn[:, :-1]
+    bn = np.ravel(Mn[:, -1].toarray())
+
+    F = (Mn_f.T @ Mn_f).tocsr()
+    order = reverse_cuthill_mckee(F, symmetric_mode=True)
+    F = F[order][:, order].tocoo()
+    Nf = F.shape[0]
+    upper = F.row <= F.col
+    bandwidth = np.max(F.col[upper] - F.row[upper])
+    ab = np.zeros((bandwidth + 1, Nf))
+    ab[bandwidth + F.row[upper] - F.col[upper], F.col[upper]] = F.data[upper]
+    cb = cholesky_banded(ab)
+    if np.min(cb[-1]) ** 2 < _CHOLESKY_MIN_PIVOT:
+        raise np.linalg.LinAlgError("Ill-conditioned normal matrix.")
+
+    MTd = (Mn_f.T @ d)[order]
+    MTb = (Mn_f.T @ bn)[order]
+    x_f = cho_solve_banded((cb, False), MTd)
+    g = cho_solve_banded((cb, False), MTb)
+    rho2 = 1 - np.dot(MTb, g)
+    if rho2 < _CHOLESKY_MIN_PIVOT:
+        raise np.linalg.LinAlgError("Ill-conditioned normal matrix.")
+    z_planet = (np.dot(bn, d) - np.dot(MTb, x_f)) / np.sqrt(rho2)
+    paras_planet = z_planet / np.sqrt(rho2)
+
+    diag_iF = np.zeros(Nf)
+    for start in range(0, Nf, _SPARSE_INV_CHUNK):
+        ids = np.arange(start, np.min([start + _SPARSE_INV_CHUNK, Nf]))
+        E = np.zeros((Nf, np.size(ids)))
+        E[ids, np.arange(np.size(ids))] = 1
+        diag_iF[ids] = cho_solve_banded((cb, False), E)[ids, np.arange(np.size(ids))]
+
+    inv_order = np.argsort(order)
+    logdet_F = 2 * np.sum(np.log(cb[-1]))
+    paras = np.append((x_f - g * paras_planet)[inv_order], paras_planet) / colnorms
+    iMTM = np.append((diag_iF + g ** 2 / rho2)[inv_order], 1 / rho2) / colnorms ** 2
+    logdet_MTM = logdet_F + np.log(rho2) + 2 * np.sum(np.log(colnorms))
+    paras_H0 = x_f[inv_order] / colnorms[:-1]
+    logdet_MTM_H0 = logdet_F + 2 * np.sum(np.log(colnorms[:-1]))
+    return paras, iMTM, logdet_MTM, paras_H0, logdet_MTM_H0, z_planet
 
 def fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0 = True,bounds = None,
           residuals=None,residuals_H0=None,noise4residuals=None,scale_noise=True,marginalize_noise_scaling=False,
-          debug=False):
+          debug=False,nuisance_cache=None,dtype=None,status=None,verbose=True):
     """
     Fit a forard model to data returning probabilities and best fit linear parameters.
 
@@ -26,7 +289,24 @@ def fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0 = True,bounds = Non
             Bounds on the linear parameters used in lsq_linear as a tuple of arrays (min_vals, maxvals).
             e.g. ([0,0,...], [np.inf,np.inf,...]) default no bounds.
             Each numpy array must have shape (N_linear_parameters,).
+            Without bounds, the linear parameters, their uncertainties and the determinant of the normal matrix are
+            all derived in closed form from a single Cholesky (or QR if ill-conditioned) factorization.
+        nuisance_cache: Dictionary-like object (e.g. breads.utils.LRUCache) used to store the factorization of the
+            nuisance part of the linear model. If not None, fm_func is called with split_planet=True and must return
+            (d, M_fixed, m_planet, s) with m_planet the first (planet) column of the linear model. Only the planet
+            column is then folded into the cached factorization of M_fixed, which speeds up the exploration of
+            parameters that do not change M_fixed (e.g. RV or atmospheric parameters at a fixed position).
+            Ignored if bounds are used or with regularization.
 
+        dtype: If not None, passed to fm_func to build d, M and s with this precision (e.g. np.float32 to reduce the memory
+            footprint). The normal matrix, the log determinants and the chi2 are still computed in float64.
+            Ignored if bounds are used or with regularization, in which case M is converted to float64.
+        status: If not None, dictionary in which the status code of the fit (status["code"], one of the STATUS_*
+            constants of this module, see STATUS_NAMES) and an error message if any (status["message"]) are saved.
+        verbose: If False, do not print the errors of the fit (see status).
+
+    fm_func can return the linear model M as a scipy.sparse matrix (e.g. spline based speckle models). Without bounds
+    or regularization, the normal equations are then solved with a banded Cholesky decomposition exploiting the sparsity.
 
     Returns:
         log_prob: Probability of the model marginalized over linear parameters.
@@ -35,7 +315,18 @@ def fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0 = True,bounds = Non
         linparas: Best fit linear parameters
         linparas_err: Uncertainties of best fit linear parameters
     """
-    fm_out = fm_func(nonlin_paras,dataobj,**fm_paras)
+    timer = profiling.timer("fitfm")
+    if dtype is not None:
+        fm_paras = dict(fm_paras, dtype=dtype)
+    if nuisance_cache is not None:
+        fm_out = fm_func(nonlin_paras,dataobj,split_planet=True,**fm_paras)
+        M_fixed = fm_out[1]
+        if scipy.sparse.issparse(M_fixed):
+            M_fixed = M_fixed.toarray()
+        fm_out = (fm_out[0],np.concatenate([fm_out[2][:,None],M_fixed],axis=1),fm_out[3]) + tuple(fm_out[4::])
+    else:
+        fm_out = fm_func(nonlin_paras,dataobj,**fm_paras)
+    timer.lap("forward_model")
 
     if len(fm_out) == 3:
         d_no_reg, M_no_reg, s_no_reg = fm_out
@@ -47,6 +338,7 @@ def fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0 = True,bounds = Non
     linparas = np.ones(N_linpara)+np.nan
     linparas_err = np.ones(N_linpara)+np.nan
     if N_data == 0:
+        _set_status(status, STATUS_EMPTY_DATA)
         log_prob = -np.inf
         log_prob_H0 = -np.inf
         s2 = np.inf
@@ -55,14 +347,30 @@ def fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0 = True,bounds = Non
     if N_linpara == 1:
         computeH0 = False
 
+    # The sparse and reduced precision solvers only handle unbounded problems without regularization
+    closed_form = bounds is None and not (len(fm_out) == 4 and "regularization" in extra_outputs.keys())
+    if scipy.sparse.issparse(M_no_reg):
+        if closed_form and N_linpara > 1:
+            M_no_reg = scipy.sparse.csc_matrix(M_no_reg)
+        else:
+            M_no_reg = M_no_reg.toarray()
+    if not closed_form:
+        M_no_reg = M_no_reg.astype(np.float64, copy=False)
+    d_no_reg = np.asarray(d_no_reg, dtype=np.float64)
+    s_no_reg = np.asarray(s_no_reg, dtype=np.float64)
+
     if bounds is None:
         _bounds = ([-np.inf,]*N_linpara,[np.inf,]*N_linpara)
     else:
         _bounds = (copy(bounds[0]),copy(bounds[1]))
 
-    validpara = np.where(np.nanmax(np.abs(M_no_reg),axis=0)!=0)
+    if scipy.sparse.issparse(M_no_reg):
+        validpara = np.where(np.ravel(abs(M_no_reg).max(axis=0).toarray())!=0)
+    else:
+        validpara = np.where(np.nanmax(np.abs(M_no_reg),axis=0)!=0)
 
     if 0 not in validpara[0]:
+        _set_status(status, STATUS_NO_PLANET)
         log_prob = -np.inf
         log_prob_H0 = -np.inf
         s2 = np.inf
@@ -72,7 +380,10 @@ def fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0 = True,bounds = Non
     M_no_reg = M_no_reg[:,validpara[0]]
 
     d_no_reg = d_no_reg / s_no_reg
-    M_no_reg = M_no_reg / s_no_reg [:, None]
+    if scipy.sparse.issparse(M_no_reg):
+        M_no_reg = scipy.sparse.csc_matrix(scipy.sparse.diags(1 / s_no_reg) @ M_no_reg)
+    else:
+        M_no_reg = M_no_reg / s_no_reg [:, None].astype(M_no_reg.dtype)
 
     if len(fm_out) == 4:
         if "regularization" in extra_outputs.keys() and marginalize_noise_scaling:
@@ -92,7 +403,15 @@ def fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0 = True,bounds = Non
             s = np.concatenate([s_no_reg,s_reg])
 
             if scale_noise:
-                paras = lsq_linear(M, d, bounds=_bounds).x
+                if bounds is None:
+                    try:
+                        R, z, colnorms = _factorize_normal_equations(M, d)
+                    except np.linalg.LinAlgError as e:
+                        _set_status(status, STATUS_SINGULAR, e, verbose)
+                        return -np.inf, -np.inf, np.inf, linparas, linparas_err
+                    paras = solve_triangular(R, z) / colnorms
+                else:
+                    paras = lsq_linear(M, d, bounds=_bounds).x
                 m = np.dot(M, paras)
                 r = d - m
                 rchi2 = np.nansum(r[0:N_data] ** 2) / N_data
@@ -113,11 +432,55 @@ def fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0 = True,bounds = Non
         d = d_no_reg
         s = s_no_reg
 
+    with_regularization = len(fm_out) == 4 and "regularization" in extra_outputs.keys()
+    timer.lap("masking")
+    profiling.record_shape(N_data, M.shape[1])
+
     logdet_Sigma = np.sum(2 * np.log(s))
-    paras = lsq_linear(M, d,bounds=_bounds).x
+    if bounds is None:
+        # Closed form solution: a single factorization gives the best fit parameters, their covariance and log|M^T.M|
+        # The planet (first) column is factorized last so that the factorization of the H0 model is nested in it.
+        perm = np.roll(np.arange(M.shape[1]), -1)
+        sparse_solution = None
+        if scipy.sparse.issparse(M) and M.shape[1] == 1:
+            # Only the planet column is left (e.g. empty continuum model), there is no nuisance matrix to factorize.
+            M = M.toarray()
+        elif scipy.sparse.issparse(M):
+            try:
+                sparse_solution = _solve_sparse_normal_equations(M[:, perm], d)
+            except np.linalg.LinAlgError:
+                # Too ill-conditioned for the sparse Cholesky decomposition, use the dense solver instead.
+                M = M.toarray()
+        try:
+            if sparse_solution is not None:
+                _paras, _iMTM, logdet_MTM = sparse_solution[0:3]
+            elif nuisance_cache is not None and not with_regularization:
+                try:
+                    R, z, colnorms, _iMTM = _bordered_factorization(M[:, 1::], M[:, 0], d, nuisance_cache)
+                    _paras = solve_triangular(R, z) / colnorms
+                    logdet_MTM = 2 * np.sum(np.log(np.abs(np.diag(R)))) + 2 * np.sum(np.log(colnorms))
+                except np.linalg.LinAlgError:
+                    # The planet is too degenerate with the nuisance model for the update, factorize everything.
+                    R, z, colnorms = _factorize_normal_equations(M[:, perm], d)
+                    _paras, _iMTM, logdet_MTM = _solve_factorized(R, z, colnorms)
+            else:
+                R, z, colnorms = _factorize_normal_equations(M[:, perm], d)
+                _paras, _iMTM, logdet_MTM = _solve_factorized(R, z, colnorms, full_cov=with_regularization)
+        except np.linalg.LinAlgError as e:
+            _set_status(status, STATUS_SINGULAR, e, verbose)
+            return -np.inf, -np.inf, np.inf, linparas, linparas_err
+        paras = np.zeros(_paras.shape)
+        paras[perm] = _paras
+        iMTM = np.zeros(_iMTM.shape)
+        if with_regularization:
+            iMTM[np.ix_(perm, perm)] = _iMTM
+        else:
+            iMTM[perm] = _iMTM
+    else:
+        paras = lsq_linear(M, d,bounds=_bounds).x
     # paras = lsq_linear(M, d).x
 
-    m = np.dot(M, paras)
+    m = _matvec(M, paras)
     r = d  - m
     chi2 = np.nansum(r**2)
     # s2 = chi2 / np.size(r)
@@ -130,16 +493,20 @@ def fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0 = True,bounds = Non
     # for col in M.T:
     #     plt.plot(col / np.nanmean(col))
     # plt.show()
+    timer.lap("solve")
 
     # Section to compute error bars of linear parameters
-    MTM = np.dot(M.T, M)
     try:
-        iMTM = np.linalg.inv(MTM)
-        if len(fm_out) == 4 and "regularization" in extra_outputs.keys():
+        if bounds is not None:
+            MTM = np.dot(M.T, M)
+            iMTM = np.linalg.inv(MTM)
+            logdet_MTM = np.linalg.slogdet(MTM)[1]
+        if with_regularization:
             if not scale_noise:
                 rchi2 = np.nansum(r[0:N_data] ** 2) / N_data
             MTM_noreg = np.dot(M_no_reg.T,M_no_reg)
             covphi = np.dot(iMTM,np.dot(MTM_noreg,iMTM.T))
+            diagcovphi = copy(np.diag(covphi))
             # The formula below assumes that we are using the determinant of the inverse covariance
             # That's why we are adding the minus sign
             logdet_icovphi0 = -np.sum(np.log(np.diag(covphi)))
@@ -150,6 +517,7 @@ def fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0 = True,bounds = Non
                 slogdet_covphi0 = np.linalg.slogdet(covphi)
                 logdet_icovphi01 = -slogdet_covphi0[1]
 
+                MTM = np.dot(M.T, M)
                 logdet_MTM = np.linalg.slogdet(MTM)[1]
                 logdet_MTM_noreg = np.linalg.slogdet(MTM_noreg)[1]
                 logdet_icovphi02 = -(-2*logdet_MTM+logdet_MTM_noreg)
@@ -209,23 +577,23 @@ def fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0 = True,bounds = Non
                 noise_scaling = np.sqrt(rchi2)
             else:
                 noise_scaling = 1
-            covphi = noise_scaling * iMTM
+            if bounds is None:
+                diagcovphi = noise_scaling * iMTM
+            else:
+                diagcovphi = noise_scaling * copy(np.diag(iMTM))
             # covphi = np.linalg.inv(MTM)
-            slogdet_icovphi0 = np.linalg.slogdet(MTM)
-            logdet_icovphi0 = slogdet_icovphi0[1]
+            logdet_icovphi0 = logdet_MTM
             if debug:
-                plt.plot(np.diag(covphi))
+                plt.plot(diagcovphi)
                 plt.show()
-                print("logdet_icovphi02,logdet_icovphi0",logdet_icovphi0,-np.sum(np.log(np.diag(covphi))))
+                print("logdet_icovphi02,logdet_icovphi0",logdet_icovphi0,-np.sum(np.log(diagcovphi)))
                 exit()
     except Exception as e:
-        print("Exiting covariance section in fitfm() with error:")
-        print(e)
+        _set_status(status, STATUS_SINGULAR if isinstance(e, np.linalg.LinAlgError) else STATUS_EXCEPTION, e, verbose)
         log_prob = -np.inf
         log_prob_H0 = -np.inf
         rchi2 = np.inf
         return log_prob, log_prob_H0, rchi2, linparas, linparas_err
-    diagcovphi = copy(np.diag(covphi))
     diagcovphi[np.where(diagcovphi<0.0)] = np.nan
     paras_err = np.sqrt(diagcovphi)
 
@@ -243,15 +611,29 @@ def fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0 = True,bounds = Non
         log_prob = ((M.shape[1]-N_data)/2)*np.log(2*np.pi) -0.5 * logdet_Sigma - 0.5 * logdet_icovphi0 \
                    -((N_data-M.shape[1])/2) * np.log(noise_scaling**2) -0.5*chi2/noise_scaling**2
         # log_prob = -0.5*chi2/noise_scaling**2
+    timer.lap("covariance")
 
     if computeH0:
-        paras_H0 = lsq_linear(M[:,1::], d,bounds=(np.array(_bounds[0])[1::],np.array(_bounds[1])[1::])).x
-        # paras_H0 = lsq_linear(M[:,1::], d).x
-        m_H0 = np.dot(M[:,1::] , paras_H0)
-        r_H0 = d  - m_H0
-        chi2_H0 = np.nansum(r_H0**2)
-        # rchi2_H0 = np.nansum(r_H0[0:N_data]**2) / N_data
-        slogdet_icovphi0_H0 = np.linalg.slogdet(np.dot(M[:,1::].T, M[:,1::]))
+        if bounds is None:
+            # H0 removes the planet, which is the last column of the factorization. The H0 factorization is therefore
+            # the leading block of R, and the chi2 only differs by the squared last element of z (Schur complement).
+            if sparse_solution is not None:
+                paras_H0, logdet_MTM_H0, z_planet = sparse_solution[3:6]
+            else:
+                paras_H0, _, logdet_MTM_H0 = _solve_factorized(R[:-1, :-1], z[:-1], colnorms[:-1], return_cov=False)
+                z_planet = z[-1]
+            chi2_H0 = chi2 + z_planet**2
+            slogdet_icovphi0_H0 = (1.0, logdet_MTM_H0)
+            if residuals_H0 is not None:
+                r_H0 = d - _matvec(M[:,1::], paras_H0)
+        else:
+            paras_H0 = lsq_linear(M[:,1::], d,bounds=(np.array(_bounds[0])[1::],np.array(_bounds[1])[1::])).x
+            # paras_H0 = lsq_linear(M[:,1::], d).x
+            m_H0 = np.dot(M[:,1::] , paras_H0)
+            r_H0 = d  - m_H0
+            chi2_H0 = np.nansum(r_H0**2)
+            # rchi2_H0 = np.nansum(r_H0[0:N_data]**2) / N_data
+            slogdet_icovphi0_H0 = np.linalg.slogdet(np.dot(M[:,1::].T, M[:,1::]))
         #todo check the maths when N_linpara is different from M.shape[1]. E.g. at the edge of the FOV
         # log_prob_H0 = -0.5*logdet_Sigma - 0.5*slogdet_icovphi0_H0[1] - (N_data-1+N_linpara-1-1)/2*np.log(chi2_H0)+ \
         #               loggamma((N_data-1+(N_linpara-1)-1)/2)+((N_linpara-1)-N_data)/2*np.log(2*np.pi)
@@ -266,6 +648,7 @@ def fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0 = True,bounds = Non
             residuals_H0[0:np.size(s)] = r_H0
     else:
         log_prob_H0 = np.nan
+    timer.lap("H0")
 
     linparas[validpara] = paras
     linparas_err[validpara] = paras_err
@@ -280,10 +663,216 @@ def fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0 = True,bounds = Non
     # plt.legend()
     # plt.show()
 
-
+    _set_status(status, STATUS_MODEL_NAN if np.isnan(log_prob) else STATUS_OK)
     return log_prob, log_prob_H0, rchi2, linparas, linparas_err
 
-def log_prob(nonlin_paras, dataobj, fm_func, fm_paras,nonlin_lnprior_func=None,bounds=None,scale_noise=True):
+def _set_status(status, code, error=None, verbose=False):
+    if error is not None and verbose:
+        print("Exiting covariance section in fitfm() with error:")
+        print(error)
+    if status is not None:
+        status["code"] = code
+        if error is not None:
+            status["message"] = str(error)
+
+def fitfm_batch(nonlin_paras_array, dataobj, fm_func, fm_paras,computeH0 = True,scale_noise=True,
+                marginalize_noise_scaling=False,dtype=None,status=None):
+    """
+    Batched version of fitfm() solving many sets of non-linear parameters at once (no bounds on the linear parameters).
+
+    Forward models can opt in by defining a `batched` attribute, fm_func.batched(nonlin_paras_array,dataobj,**fm_paras),
+    returning d (B,Nd), M (B,Nd,Np), s (B,Nd) and a boolean mask (B,Nd) flagging the valid elements of each row.
+    The whole batch is then solved with stacked numpy.linalg routines. The elements of the batch whose normal matrix is
+    too ill-conditioned for a Cholesky decomposition are solved with a QR decomposition instead, as in fitfm().
+    Otherwise, it falls back to calling fitfm() for each set of parameters.
+    Forward models returning regularization outputs are not supported in batched mode. fm_func.batched can raise a
+    NotImplementedError for the options of the forward model it does not support, see
+    breads.grid_search.process_chunk().
+
+    Args:
+        nonlin_paras_array: Non-linear parameters as an array of shape (B, N_nonlin_paras). Each row is the
+            nonlin_paras argument of fitfm().
+        dataobj: A data object of type breads.instruments.instrument.Instrument to be analyzed.
+        fm_func: A forward model function. See breads.fm.template.template() for an example.
+        fm_paras: Additional parameters for fm_func (other than non-linear parameters and dataobj)
+        computeH0: If true (default), compute the probability of the model removing the first element of the linear
+            model. See fitfm().
+        scale_noise: See fitfm().
+        marginalize_noise_scaling: See fitfm().
+        dtype: See fitfm().
+        status: If not None, dictionary in which the status codes of the fits (status["code"], array of shape (B,), see
+            STATUS_NAMES) and the error messages if any (status["message"], dictionary {index in the batch: message})
+            are saved.
+
+    Returns:
+        log_prob: Array of shape (B,)
+        log_prob_H0: Array of shape (B,)
+        rchi2: Array of shape (B,)
+        linparas: Array of shape (B,Np)
+        linparas_err: Array of shape (B,Np)
+    """
+    nonlin_paras_array = np.atleast_2d(nonlin_paras_array)
+    if dtype is not None:
+        fm_paras = dict(fm_paras, dtype=dtype)
+    if hasattr(fm_func, "batched"):
+        timer = profiling.timer("fitfm_batch")
+        d, M, s, mask = fm_func.batched(nonlin_paras_array, dataobj, **fm_paras)
+        timer.lap("forward_model")
+        profiling.record_shape(M.shape[1], M.shape[2])
+        out = _fitfm_batch_solve(d, M, s, mask, computeH0=computeH0, scale_noise=scale_noise,
+                                 marginalize_noise_scaling=marginalize_noise_scaling)
+        timer.lap("solve")
+        if status is not None:
+            status["code"] = out[5]
+            status["message"] = {int(k): "Singular matrix" for k in np.where(out[5] == STATUS_SINGULAR)[0]}
+        return out[0:5]
+
+    out = []
+    codes = np.zeros(len(nonlin_paras_array), dtype=np.int8)
+    messages = {}
+    for k, nonlin_paras in enumerate(nonlin_paras_array):
+        fit_status = {}
+        out.append(fitfm(nonlin_paras, dataobj, fm_func, fm_paras, computeH0=computeH0, scale_noise=scale_noise,
+                         marginalize_noise_scaling=marginalize_noise_scaling, status=fit_status, verbose=False))
+        codes[k] = fit_status["code"]
+        if "message" in fit_status:
+            messages[k] = fit_status["message"]
+    if status is not None:
+        status["code"] = codes
+        status["message"] = messages
+    log_prob, log_prob_H0, rchi2, linparas, linparas_err = zip(*out)
+    return np.array(log_prob), np.array(log_prob_H0), np.array(rchi2), np.array(linparas), np.array(linparas_err)
+
+def _fitfm_batch_solve(d, M, s, mask, computeH0=True, scale_noise=True, marginalize_noise_scaling=False):
+    """
+    Solve a stack of linear models for fitfm_batch(). Returns log_prob, log_prob_H0, rchi2, linparas, linparas_err and
+    the status code of each element of the batch (see STATUS_NAMES).
+
+    Empty columns of M (e.g. at the edge of the FOV) are decoupled from the rest of the model by replacing them with
+    an identity block in the normal matrix, which leaves the solution and the log determinant unchanged.
+    The elements for which the Cholesky decomposition of the normal matrix fails or is too ill-conditioned are
+    factorized with a QR decomposition of the model, like in _factorize_normal_equations().
+    """
+    B, Nd, N_linpara = M.shape
+    codes = np.zeros(B, dtype=np.int8) + STATUS_OK
+    log_prob = np.zeros(B) - np.inf
+    log_prob_H0 = np.zeros(B) - np.inf
+    rchi2 = np.zeros(B) + np.inf
+    linparas = np.zeros((B, N_linpara)) + np.nan
+    linparas_err = np.zeros((B, N_linpara)) + np.nan
+    if not computeH0 or N_linpara == 1:
+        log_prob_H0[:] = np.nan
+        computeH0 = False
+
+    mask = mask & np.isfinite(d) & np.isfinite(s) & np.all(np.isfinite(M), axis=2)
+    N_data = np.sum(mask, axis=1)
+    # The whitened arrays are created in float64 even if the forward model is computed in reduced precision
+    _s = np.where(mask, s, 1).astype(np.float64)
+    dw = np.where(mask, d, 0) / _s
+    Mw = np.where(mask[:, :, None], M, 0) / _s[:, :, None]
+
+    # The planet (first) column is moved last so that the H0 factorization is nested in the H1 factorization.
+    perm = np.roll(np.arange(N_linpara), -1)
+    Mw = Mw[:, :, perm]
+    colnorms = np.sqrt(np.sum(Mw ** 2, axis=1))
+    validpara = colnorms != 0
+    valid = validpara[:, -1] & (N_data != 0)
+    codes[N_data == 0] = STATUS_EMPTY_DATA
+    codes[(N_data != 0) & ~validpara[:, -1]] = STATUS_NO_PLANET
+    if not np.any(valid):
+        return log_prob, log_prob_H0, rchi2, linparas, linparas_err, codes
+    # Only keep the elements of the batch that can be fitted
+    Mw, dw, colnorms, validpara, N_data = Mw[valid], dw[valid], colnorms[valid], validpara[valid], N_data[valid]
+    logdet_Sigma = np.sum(np.where(mask[valid], 2 * np.log(_s[valid]), 0), axis=1)
+    colnorms[~validpara] = 1
+    Np = np.sum(validpara, axis=1)
+
+    Mn = Mw / colnorms[:, None, :]
+    MTM = np.matmul(np.swapaxes(Mn, 1, 2), Mn)
+    where_empty = np.where(~validpara)
+    MTM[where_empty[0], where_empty[1], where_empty[1]] = 1
+    try:
+        L = np.linalg.cholesky(MTM)
+        failed = np.zeros(MTM.shape[0], dtype=bool)
+    except np.linalg.LinAlgError:
+        # Find the elements of the batch that cannot be factorized
+        L = np.zeros(MTM.shape)
+        failed = np.zeros(MTM.shape[0], dtype=bool)
+        for b in range(MTM.shape[0]):
+            try:
+                L[b] = np.linalg.cholesky(MTM[b])
+            except np.linalg.LinAlgError:
+                failed[b] = True
+    R = np.swapaxes(L, 1, 2)
+    failed |= np.min(np.abs(np.diagonal(R, axis1=1, axis2=2)), axis=1) ** 2 < _CHOLESKY_MIN_PIVOT
+    singular = np.zeros(MTM.shape[0], dtype=bool)
+    for b in np.where(failed)[0]:
+        # QR decomposition of the model, with a unit row for each empty column to match the identity block of MTM
+        empty = np.where(~validpara[b])[0]
+        E = np.zeros((np.size(empty), N_linpara))
+        E[np.arange(np.size(empty)), empty] = 1
+        _R = np.linalg.qr(np.concatenate([Mn[b], E], axis=0), mode="r") if N_data[b] >= Np[b] else None
+        if _R is None or np.min(np.abs(np.diag(_R))) == 0:
+            singular[b] = True
+            R[b] = np.eye(N_linpara)
+            continue
+        # Same sign convention as the Cholesky factor (positive diagonal)
+        R[b] = _R * np.where(np.diag(_R) < 0, -1, 1)[:, None]
+    diagR = np.diagonal(R, axis1=1, axis2=2)
+    iR = np.linalg.inv(R)
+    z = np.matmul(np.matmul(dw[:, None, :], Mn), iR)[:, 0, :]
+    _paras = np.matmul(iR, z[:, :, None])[:, :, 0] / colnorms
+    _iMTM = np.sum(iR ** 2, axis=2) / colnorms ** 2
+    logdet_MTM = 2 * np.sum(np.log(diagR), axis=1) + 2 * np.sum(np.log(colnorms), axis=1)
+
+    r = dw - np.matmul(Mw, _paras[:, :, None])[:, :, 0]
+    chi2 = np.sum(r ** 2, axis=1)
+    _rchi2 = chi2 / N_data
+    if scale_noise:
+        noise_scaling = np.sqrt(_rchi2)
+    else:
+        noise_scaling = np.ones(_rchi2.shape)
+    diagcovphi = noise_scaling[:, None] * _iMTM
+    diagcovphi[np.where(diagcovphi < 0.0)] = np.nan
+
+    if marginalize_noise_scaling:
+        _log_prob = (Np - N_data) / 2 * np.log(2 * np.pi) - 0.5 * logdet_Sigma - 0.5 * logdet_MTM \
+                    - ((N_data - Np + 2 - 1) / 2) * np.log(chi2) + loggamma((N_data - Np + 2 - 1) / 2)
+    else:
+        # log(Eq 36) in Ruffio+2019:
+        _log_prob = ((Np - N_data) / 2) * np.log(2 * np.pi) - 0.5 * logdet_Sigma - 0.5 * logdet_MTM \
+                    - ((N_data - Np) / 2) * np.log(noise_scaling ** 2) - 0.5 * chi2 / noise_scaling ** 2
+
+    if computeH0:
+        logdet_MTM_H0 = 2 * np.sum(np.log(diagR[:, :-1]), axis=1) + 2 * np.sum(np.log(colnorms[:, :-1]), axis=1)
+        chi2_H0 = chi2 + z[:, -1] ** 2
+        if marginalize_noise_scaling:
+            _log_prob_H0 = -0.5 * logdet_Sigma - 0.5 * logdet_MTM_H0 - (N_data + (Np - 1) + 2 - 1) / 2 * np.log(chi2_H0) + \
+                           loggamma((N_data - (Np - 1) + 2 - 1) / 2) + ((Np - 1) - N_data) / 2 * np.log(2 * np.pi)
+        else:
+            _log_prob_H0 = ((Np - N_data) / 2) * np.log(2 * np.pi) - 0.5 * logdet_Sigma - 0.5 * logdet_MTM_H0 \
+                           - ((N_data - Np) / 2) * np.log(noise_scaling ** 2) - 0.5 * chi2_H0 / noise_scaling ** 2
+        log_prob_H0[valid] = _log_prob_H0
+
+    _paras[~validpara] = np.nan
+    diagcovphi[~validpara] = np.nan
+    log_prob[valid] = _log_prob
+    rchi2[valid] = _rchi2
+    linparas[np.ix_(valid, perm)] = _paras
+    linparas_err[np.ix_(valid, perm)] = np.sqrt(diagcovphi)
+
+    where_singular = np.where(valid)[0][singular]
+    log_prob[where_singular] = -np.inf
+    log_prob_H0[where_singular] = -np.inf
+    rchi2[where_singular] = np.inf
+    linparas[where_singular] = np.nan
+    linparas_err[where_singular] = np.nan
+    codes[where_singular] = STATUS_SINGULAR
+    codes[np.isnan(log_prob)] = STATUS_MODEL_NAN
+    return log_prob, log_prob_H0, rchi2, linparas, linparas_err, codes
+
+def log_prob(nonlin_paras, dataobj, fm_func, fm_paras,nonlin_lnprior_func=None,bounds=None,scale_noise=True,
+             cache=None):
     """
     Wrapper to fit_fm() but only returns the log probability marginalized over the linear parameters.
 
@@ -300,6 +889,8 @@ def log_prob(nonlin_paras, dataobj, fm_func, fm_paras,nonlin_lnprior_func=None,b
             Bounds on the linear parameters used in lsq_linear as a tuple of arrays (min_vals, maxvals).
             e.g. ([0,0,...], [np.inf,np.inf,...]). default no bounds.
             Each numpy array must have shape (N_linear_parameters,).
+        cache: Optional LogProbCache memoizing the log probability of the parameters already evaluated. Use one cache
+            per (dataobj, fm_func, fm_paras, bounds, scale_noise) combination.
 
     Returns:
         log_prob: Probability of the model marginalized over linear parameters.
@@ -308,11 +899,18 @@ def log_prob(nonlin_paras, dataobj, fm_func, fm_paras,nonlin_lnprior_func=None,b
         prior = nonlin_lnprior_func(nonlin_paras)
     else:
         prior = 0
+    if cache is not None:
+        key = cache.key(nonlin_paras)
+        lnprob = cache.get(key)
+        if lnprob is not None:
+            return lnprob+prior
     try:
-        lnprob = fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0=False,bounds=bounds,scale_noise=scale_noise)[0]+prior
+        lnprob = fitfm(nonlin_paras, dataobj, fm_func, fm_paras,computeH0=False,bounds=bounds,scale_noise=scale_noise)[0]
     except:
         lnprob =  -np.inf
-    return lnprob
+    if cache is not None:
+        cache.set(key, lnprob)
+    return lnprob+prior
 
 
 def combined_log_prob(nonlin_paras, dataobjlist,fm_funclist, fm_paraslist, nonlin_lnprior_func=None,bounds=None):
@@ -333,7 +931,8 @@ def combined_log_prob(nonlin_paras, dataobjlist,fm_funclist, fm_paraslist, nonli
         combined_lnprob += lnprob
     return combined_lnprob
 
-def nlog_prob(nonlin_paras, dataobj, fm_func, fm_paras,nonlin_lnprior_func=None,bounds=None,scale_noise=True):
+def nlog_prob(nonlin_paras, dataobj, fm_func, fm_paras,nonlin_lnprior_func=None,bounds=None,scale_noise=True,
+              cache=None):
     """
    Returns the negative of the log_prob() for minimization routines.
 
@@ -350,10 +949,91 @@ def nlog_prob(nonlin_paras, dataobj, fm_func, fm_paras,nonlin_lnprior_func=None,
             Bounds on the linear parameters used in lsq_linear as a tuple of arrays (min_vals, maxvals).
             e.g. ([0,0,...], [np.inf,np.inf,...]) default no bounds.
             Each numpy array must have shape (N_linear_parameters,).
+        cache: Optional LogProbCache, see log_prob().
 
     Returns:
         log_prob: Probability of the model marginalized over linear parameters.
     """
-    nlogprob_val =  - log_prob(nonlin_paras, dataobj, fm_func, fm_paras,nonlin_lnprior_func,bounds,scale_noise)
+    nlogprob_val =  - log_prob(nonlin_paras, dataobj, fm_func, fm_paras,nonlin_lnprior_func,bounds,scale_noise,
+                               cache=cache)
     # print( nlogprob_val, nonlin_paras)
-    return nlogprob_val
\ No newline at end of file
+    return nlogprob_val
+
+
+# Per-process storage of the LogProbCache instances: cache name -> LRUCache. The entry of a cache is released when the
+# cache is garbage collected in the process that created it. The worker processes only receive pickled copies of the
+# caches and keep the entries of the most recently used ones.
+_log_prob_caches = LRUCache(maxsize=16)
+
+
+class LogProbCache:
+    """
+    Bounded memoization of log_prob() and nlog_prob() for optimizers and samplers re-evaluating the same parameters.
+    The non-linear parameters are rounded to the given number of decimals to define the key, so that nearly identical
+    vectors share the same entry.
+
+    The cache can be sent to pooled workers (e.g. emcee or dynesty with a multiprocessing pool): only its definition is
+    pickled, and each process fills its own cache, which persists between the calls even if the cache is pickled again
+    with every task.
+
+        cache = LogProbCache(maxsize=10000, decimals=8)
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, log_prob, args=[dataobj, fm_func, fm_paras],
+                                        kwargs={"cache": cache})
+        print(cache.stats())
+
+    Args:
+        maxsize: Maximum number of entries per process. No limit if None. Default 4096.
+        decimals: Number of decimals used to round the parameters, or a list with one value per parameter.
+            No rounding if None (default).
+    """
+    def __init__(self, maxsize=4096, decimals=None):
+        self.maxsize = maxsize
+        self.decimals = decimals
+        self.name = uuid.uuid4().hex
+        weakref.finalize(self, _log_prob_caches.pop, self.name, None)
+
+    def _cache(self):
+        cache = _log_prob_caches.get(self.name)
+        if cache is None:
+            cache = _log_prob_caches[self.name] = LRUCache(maxsize=self.maxsize)
+        return cache
+
+    def key(self, nonlin_paras):
+        """ Cache key of a vector of non-linear parameters. """
+        nonlin_paras = np.atleast_1d(np.asarray(nonlin_paras, dtype=float))
+        if self.decimals is not None:
+            decimals = np.broadcast_to(self.decimals, nonlin_paras.shape)
+            nonlin_paras = np.array([np.round(p, int(d)) for p, d in zip(nonlin_paras, decimals)])
+        # Avoid distinguishing 0.0 and -0.0
+        return (nonlin_paras + 0.0).tobytes()
+
+    def get(self, key):
+        return self._cache().get(key)
+
+    def set(self, key, value):
+        self._cache()[key] = value
+
+    def __len__(self):
+        return len(self._cache())
+
+    @property
+    def hits(self):
+        return self._cache().hits
+
+    @property
+    def misses(self):
+        return self._cache().misses
+
+    def hit_rate(self):
+        """ Fraction of the lookups of the current process answered by the cache. """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """ Statistics of the cache of the current process. """
+        return {"pid": os.getpid(), "size": len(self), "maxsize": self.maxsize, "hits": self.hits,
+                "misses": self.misses, "hit_rate": self.hit_rate()}
+
+    def clear(self):
+        """ Empty the cache of the current process and reset its statistics. """
+        _log_prob_caches.pop(self.name, None)
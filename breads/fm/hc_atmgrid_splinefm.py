@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.sparse
 from PyAstronomy import pyasl
 from astropy import constants as const
 from scipy.interpolate import interp1d
@@ -8,7 +9,8 @@ from breads.utils import get_spline_model, pixgauss2d
 
 # pos: (x,y) or fiber, position of the companion
 def hc_atmgrid_splinefm(nonlin_paras, cubeobj, atm_grid=None, atm_grid_wvs=None, transmission=None, star_spectrum=None,boxw=1, psfw=1.2,nodes=20,
-             badpixfraction=0.75,loc=None,fix_parameters=None,return_where_finite=False):
+             badpixfraction=0.75,loc=None,fix_parameters=None,return_where_finite=False,split_planet=False,
+             sparse=False,dtype=np.float64):
     """
     For high-contrast companions (planet + speckles).
     Generate forward model fitting the continuum with a spline.
@@ -41,6 +43,11 @@ def hc_atmgrid_splinefm(nonlin_paras, cubeobj, atm_grid=None, atm_grid_wvs=None,
             When loc is not None, the x,y non-linear parameters should not be given.
         fix_parameters: List. Use to fix the value of some non-linear parameters. The values equal to None are being
                     fitted for, other elements will be fixed to the value specified.
+        split_planet: If True, return the planet model separately from the speckle model: (d, M_fixed, m_planet, s),
+            with M = [m_planet, M_fixed]. See nuisance_cache in breads.fit.fitfm().
+        sparse: If True, return the linear model as a scipy.sparse.csc_matrix built from the non-zero blocks of the
+            speckle model (one per spaxel), without forming the dense matrix. See breads.fit.fitfm().
+        dtype: Data type of d, M and s (e.g. np.float32 to reduce the memory footprint). Default np.float64.
 
     Returns:
         d: Data as a 1d vector with bad pixels removed (no nans)
@@ -164,30 +171,58 @@ def hc_atmgrid_splinefm(nonlin_paras, cubeobj, atm_grid=None, atm_grid_wvs=None,
     if np.size(where_finite[0]) <= (1-badpixfraction) * np.size(badpixs) or vsini < 0 or \
             padk > ny+2*w-1 or padk < 0 or padl > nx+2*w-1 or padl < 0:
         # don't bother to do a fit if there are too many bad pixels
+        if split_planet:
+            return np.array([]), np.array([]).reshape(0,N_linpara-1), np.array([]), np.array([])
         return np.array([]), np.array([]).reshape(0,N_linpara), np.array([])
     else:
-        # Get the linear model (ie the matrix) for the spline
-        M_speckles = np.zeros((nz, boxw, boxw, boxw, boxw, N_nodes))
-        for _k in range(boxw):
-            for _l in range(boxw):
-                lwvs = wvs[:,np.clip(k-w+_k,0,nywv-1),np.clip(l-w+_l,0,nxwv-1)]
-                M_spline = get_spline_model(x_knots, lwvs, spline_degree=3)
-                M_speckles[:, _k, _l, _k, _l, :] = M_spline * star_spectrum[:, None]
-        M_speckles = np.reshape(M_speckles, (nz, boxw, boxw, boxw * boxw * N_nodes))
-
-        if fitback:
-            M_background = np.zeros((nz, boxw, boxw, boxw, boxw,3))
+        if sparse:
+            # Only build the non-zero blocks of the speckle model as (rows, columns, values) triplets. The row of
+            # the wavelength z of the spaxel (_k,_l) in the raveled stamp is (z*boxw+_k)*boxw+_l, before removing
+            # the bad pixels.
+            speckles_rows, speckles_cols, speckles_vals = [np.array([],dtype=int)], [np.array([],dtype=int)], \
+                                                          [np.array([])]
+            for _k in range(boxw):
+                for _l in range(boxw):
+                    lwvs = wvs[:,np.clip(k-w+_k,0,nywv-1),np.clip(l-w+_l,0,nxwv-1)]
+                    M_spline = get_spline_model(x_knots, lwvs, spline_degree=3, sparse=True).tocoo()
+                    speckles_rows.append((M_spline.row * boxw + _k) * boxw + _l)
+                    speckles_cols.append((_k * boxw + _l) * N_nodes + M_spline.col)
+                    speckles_vals.append(M_spline.data * star_spectrum[M_spline.row])
+            speckles_rows = np.concatenate(speckles_rows)
+            # Index of each row after removing the bad pixels, -1 for the bad pixels
+            finite_ids = np.zeros(nz * boxw * boxw, dtype=int) - 1
+            finite_ids[where_finite[0]] = np.arange(np.size(where_finite[0]))
+            keep = finite_ids[speckles_rows] >= 0
+            speckles_cols = np.concatenate(speckles_cols)[keep]
+            M_speckles_r = scipy.sparse.csc_matrix((np.concatenate(speckles_vals)[keep],
+                                                    (finite_ids[speckles_rows[keep]], speckles_cols)),
+                                                   shape=(np.size(where_finite[0]), N_linpara-1), dtype=dtype)
+            M_speckles_r.eliminate_zeros()
+        else:
+            # Get the linear model (ie the matrix) for the spline
+            M_speckles = np.zeros((nz, boxw, boxw, boxw, boxw, N_nodes), dtype=dtype)
             for _k in range(boxw):
                 for _l in range(boxw):
                     lwvs = wvs[:,np.clip(k-w+_k,0,nywv-1),np.clip(l-w+_l,0,nxwv-1)]
-                    M_background[:, _k, _l, _k, _l, 0] = 1
-                    M_background[:, _k, _l, _k, _l, 1] = lwvs
-                    M_background[:, _k, _l, _k, _l, 2] = lwvs**2
-            M_background = np.reshape(M_background, (nz, boxw, boxw, 3*boxw**2))
+                    M_spline = get_spline_model(x_knots, lwvs, spline_degree=3)
+                    M_speckles[:, _k, _l, _k, _l, :] = M_spline * star_spectrum[:, None]
+            M_speckles = np.reshape(M_speckles, (nz, boxw, boxw, boxw * boxw * N_nodes))
+
+            if fitback:
+                M_background = np.zeros((nz, boxw, boxw, boxw, boxw,3), dtype=dtype)
+                for _k in range(boxw):
+                    for _l in range(boxw):
+                        lwvs = wvs[:,np.clip(k-w+_k,0,nywv-1),np.clip(l-w+_l,0,nxwv-1)]
+                        M_background[:, _k, _l, _k, _l, 0] = 1
+                        M_background[:, _k, _l, _k, _l, 1] = lwvs
+                        M_background[:, _k, _l, _k, _l, 2] = lwvs**2
+                M_background = np.reshape(M_background, (nz, boxw, boxw, 3*boxw**2))
 
         planet_model = atm_grid(atm_paras)[0]
 
         if np.sum(np.isnan(planet_model)) >= 1 or np.sum(planet_model)==0 or np.size(atm_grid_wvs) != np.size(planet_model):
+            if split_planet:
+                return np.array([]), np.array([]).reshape(0,N_linpara-1), np.array([]), np.array([])
             return np.array([]), np.array([]).reshape(0,N_linpara), np.array([])
         else:
             if vsini != 0:
@@ -217,21 +252,31 @@ def hc_atmgrid_splinefm(nonlin_paras, cubeobj, atm_grid=None, atm_grid_wvs=None,
                 scaled_psfs[:,_k,_l] = psfs[:, _k,_l] * planet_spec
 
         planet_flux = np.size(scaled_psfs) * np.nanmean(scaled_psfs)
-        scaled_psfs = scaled_psfs / planet_flux * star_flux
+        scaled_psfs = (scaled_psfs / planet_flux * star_flux).astype(dtype, copy=False)
         # print(np.nansum(scaled_psfs))
 
-        # combine planet model with speckle model
-        if fitback:
-            M = np.concatenate([scaled_psfs[:, :, :, None], M_speckles,M_background], axis=3)
-        else:
-            M = np.concatenate([scaled_psfs[:, :, :, None], M_speckles], axis=3)
-        # Ravel data dimension
-        M = np.reshape(M, (nz * boxw * boxw, N_linpara))
         # Get rid of bad pixels
-        sr = s[where_finite]
-        dr = d[where_finite]
-        Mr = M[where_finite[0], :]
+        sr = s[where_finite].astype(dtype, copy=False)
+        dr = d[where_finite].astype(dtype, copy=False)
+        if sparse:
+            # The speckle model is already sparse, only the planet column is added
+            planet_r = np.ravel(scaled_psfs)[where_finite[0]]
+            Mr = scipy.sparse.hstack([scipy.sparse.csc_matrix(planet_r[:, None]), M_speckles_r], format="csc")
+        else:
+            # combine planet model with speckle model
+            if fitback:
+                M = np.concatenate([scaled_psfs[:, :, :, None], M_speckles,M_background], axis=3)
+            else:
+                M = np.concatenate([scaled_psfs[:, :, :, None], M_speckles], axis=3)
+            # Ravel data dimension
+            M = np.reshape(M, (nz * boxw * boxw, N_linpara))
+            Mr = M[where_finite[0], :]
 
+        if split_planet:
+            out = (dr, M_speckles_r, planet_r, sr) if sparse else (dr, Mr[:, 1::], Mr[:, 0], sr)
+            if return_where_finite:
+                return out + (where_finite,)
+            return out
         if return_where_finite:
             return dr, Mr, sr, where_finite
         else:
@@ -1,5 +1,6 @@
 import astropy.units as u
 import numpy as np
+import scipy.sparse
 from PyAstronomy import pyasl
 from astropy import constants as const
 from scipy.interpolate import interp1d
@@ -11,7 +12,8 @@ from breads.utils import get_spline_model
 # pos: (x,y) or fiber, position of the companion
 def hc_atmgrid_splinefm_jwst_nirspec_cal(nonlin_paras, cubeobj, atm_grid=None, atm_grid_wvs=None, star_func=None,radius_as=0.2, nodes=20,
              badpixfraction=0.75,fix_parameters=None,Nrows_max=200,return_extra_outputs=False,detec_KLs=None,wvs_KLs_f=None,
-             regularization=None,reg_mean_map=None,reg_std_map=None):
+             regularization=None,reg_mean_map=None,reg_std_map=None,split_planet=False,sparse=False,
+             dtype=np.float64):
 
     """
     For high-contrast companions (planet + speckles).
@@ -38,6 +40,11 @@ def hc_atmgrid_splinefm_jwst_nirspec_cal(nonlin_paras, cubeobj, atm_grid=None, a
         badpixfraction: Max fraction of bad pixels in data.
         fix_parameters: List. Use to fix the value of some non-linear parameters. The values equal to None are being
                     fitted for, other elements will be fixed to the value specified.
+        split_planet: If True, return the planet model separately from the speckle model: (d, M_fixed, m_planet, s),
+            with M = [m_planet, M_fixed]. See nuisance_cache in breads.fit.fitfm().
+        sparse: If True, return the linear model as a scipy.sparse.csc_matrix. The speckle model is block diagonal by
+            detector row, which is used by breads.fit.fitfm() to solve the fit more efficiently when there are many rows.
+        dtype: Data type of d, M and s (e.g. np.float32 to reduce the memory footprint). Default np.float64.
 
     Returns:
         d: Data as a 1d vector with bad pixels removed (no nans)
@@ -91,6 +98,8 @@ def hc_atmgrid_splinefm_jwst_nirspec_cal(nonlin_paras, cubeobj, atm_grid=None, a
 
     planet_model = atm_grid(atm_paras)[0]
     if np.sum(planet_model)==0 or np.size(atm_grid_wvs) != np.size(planet_model):
+        if split_planet:
+            return np.array([]), np.array([]).reshape(0,N_linpara-1), np.array([]), np.array([])
         return np.array([]), np.array([]).reshape(0,N_linpara), np.array([])
     else:
         if vsini != 0:
@@ -128,8 +137,8 @@ def hc_atmgrid_splinefm_jwst_nirspec_cal(nonlin_paras, cubeobj, atm_grid=None, a
     if Nrows >Nrows_max:
         raise Exception("Too many rows")
 
-    d = data[where_trace_finite]
-    s = noise[where_trace_finite]
+    d = data[where_trace_finite].astype(dtype, copy=False)
+    s = noise[where_trace_finite].astype(dtype, copy=False)
     w = wvs[where_trace_finite]
     # dw = dwvs[where_trace_finite]
     x = ra_array[where_trace_finite]
@@ -173,6 +182,8 @@ def hc_atmgrid_splinefm_jwst_nirspec_cal(nonlin_paras, cubeobj, atm_grid=None, a
     if np.size(where_trace_finite[0]) <= (1-badpixfraction) * np.sum(new_mask*larger_mask_comp) or vsini < 0:
         # print("coucou")
         # don't bother to do a fit if there are too many bad pixels
+        if split_planet:
+            return np.array([]), np.array([]).reshape(0,N_linpara-1), np.array([]), np.array([])
         return np.array([]), np.array([]).reshape(0,N_linpara), np.array([])
     else:
 
@@ -187,16 +198,20 @@ def hc_atmgrid_splinefm_jwst_nirspec_cal(nonlin_paras, cubeobj, atm_grid=None, a
         #     M_KLs = np.zeros((Nd,Nrows_max, len(wvs_KLs_f)))
         # if detec_KLs is not None:
         #     M_KLs_detec = np.zeros((Nd,Nrows_max, detec_KLs.shape[1]))
-        M_speckles = np.zeros((Nd,Nrows, N_nodes))
+        if sparse:
+            # Only store the non-zero blocks of the speckle model as (rows, columns, values) triplets
+            speckles_rows, speckles_cols, speckles_vals = [np.array([],dtype=int)], [np.array([],dtype=int)], [np.array([])]
+        else:
+            M_speckles = np.zeros((Nd,Nrows, N_nodes), dtype=dtype)
         if regularization == "user":
             d_reg_speckles = np.zeros((Nrows, N_nodes))+np.nan
             s_reg_speckles = np.zeros((Nrows, N_nodes))+np.nan
             wvs_reg_speckles = np.zeros((Nrows, N_nodes))+np.nan
             rows_reg_speckles = np.tile((np.pad(rows_ids,(0,Nrows-np.size(rows_ids)),constant_values=0))[:,None],(1,N_nodes))
         if wvs_KLs_f is not None:
-            M_KLs = np.zeros((Nd,Nrows, len(wvs_KLs_f)))
+            M_KLs = np.zeros((Nd,Nrows, len(wvs_KLs_f)), dtype=dtype)
         if detec_KLs is not None:
-            M_KLs_detec = np.zeros((Nd,Nrows, detec_KLs.shape[1]))
+            M_KLs_detec = np.zeros((Nd,Nrows, detec_KLs.shape[1]), dtype=dtype)
         # M_spline = get_spline_model(x_nodes, np.arange(nx), spline_degree=3)
         for _k in range(Nrows):
             where_finite_and_in_row = np.where(where_trace_finite[0]==rows_ids[_k])
@@ -208,7 +223,13 @@ def hc_atmgrid_splinefm_jwst_nirspec_cal(nonlin_paras, cubeobj, atm_grid=None, a
             if np.size(where_del_col[0]) == selec_M_spline.shape[1]:
                 continue
             selec_M_spline[:,where_del_col[0]] = 0
-            M_speckles[where_finite_and_in_row[0], _k, :] = selec_M_spline
+            if sparse:
+                _rows, _cols = np.meshgrid(where_finite_and_in_row[0], _k*N_nodes+np.arange(N_nodes), indexing="ij")
+                speckles_rows.append(np.ravel(_rows))
+                speckles_cols.append(np.ravel(_cols))
+                speckles_vals.append(np.ravel(selec_M_spline))
+            else:
+                M_speckles[where_finite_and_in_row[0], _k, :] = selec_M_spline
             rows_ids_mask[_k] = 1
             if regularization == "user":
                 d_reg_speckles[_k,:] = reg_mean_map[rows_ids[_k],:]
@@ -236,10 +257,19 @@ def hc_atmgrid_splinefm_jwst_nirspec_cal(nonlin_paras, cubeobj, atm_grid=None, a
         #     M_KLs = np.reshape(M_KLs, (Nd, Nrows_max * len(wvs_KLs_f)))
         # if detec_KLs is not None:
         #     M_KLs_detec = np.reshape(M_KLs_detec, (Nd, Nrows_max * detec_KLs.shape[1]))
-        M_speckles = np.reshape(M_speckles, (Nd, Nrows * N_nodes))
+        if sparse:
+            M_speckles = scipy.sparse.csc_matrix((np.concatenate(speckles_vals),
+                                                  (np.concatenate(speckles_rows),np.concatenate(speckles_cols))),
+                                                 shape=(Nd, Nrows * N_nodes), dtype=dtype)
+            M_speckles.eliminate_zeros()
+        else:
+            M_speckles = np.reshape(M_speckles, (Nd, Nrows * N_nodes))
         if fitback:
             M_background = M_speckles
-        M_speckles = M_speckles*star_func(w)[:,None]
+        if sparse:
+            M_speckles = scipy.sparse.csc_matrix(scipy.sparse.diags(star_func(w).astype(dtype)) @ M_speckles)
+        else:
+            M_speckles = M_speckles*star_func(w).astype(dtype)[:,None]
         if wvs_KLs_f is not None:
             M_KLs = np.reshape(M_KLs, (Nd, Nrows * len(wvs_KLs_f)))
         if detec_KLs is not None:
@@ -264,6 +294,7 @@ def hc_atmgrid_splinefm_jwst_nirspec_cal(nonlin_paras, cubeobj, atm_grid=None, a
         #     comp_model = cubeobj.webbpsf_interp((x-comp_dra_as)*cubeobj.webbpsf_wv0/w, (y-comp_ddec_as)*cubeobj.webbpsf_wv0/w)*comp_spec
         comp_model = cubeobj.webbpsf_interp((x - comp_dra_as) * cubeobj.webbpsf_wv0 / w,
                                             (y - comp_ddec_as) * cubeobj.webbpsf_wv0 / w) * comp_spec
+        comp_model = comp_model.astype(dtype, copy=False)
 
         # plt.plot(np.nanmax(M_speckles, axis=1))
         # plt.show()
@@ -271,13 +302,23 @@ def hc_atmgrid_splinefm_jwst_nirspec_cal(nonlin_paras, cubeobj, atm_grid=None, a
         # M_speckles[:, useless_paras[0]] = 0
 
         # combine planet model with speckle model
-        M = np.concatenate([comp_model[:, None], M_speckles], axis=1)
-        if fitback:
-            M = np.concatenate([M,M_background], axis=1)
-        if wvs_KLs_f is not None:
-            M = np.concatenate([M,M_KLs], axis=1)
-        if detec_KLs is not None:
-            M = np.concatenate([M,M_KLs_detec], axis=1)
+        if sparse:
+            M_list = [scipy.sparse.csc_matrix(comp_model[:, None]), M_speckles]
+            if fitback:
+                M_list.append(M_background)
+            if wvs_KLs_f is not None:
+                M_list.append(scipy.sparse.csc_matrix(M_KLs))
+            if detec_KLs is not None:
+                M_list.append(scipy.sparse.csc_matrix(M_KLs_detec))
+            M = scipy.sparse.hstack(M_list, format="csc")
+        else:
+            M = np.concatenate([comp_model[:, None], M_speckles], axis=1)
+            if fitback:
+                M = np.concatenate([M,M_background], axis=1)
+            if wvs_KLs_f is not None:
+                M = np.concatenate([M,M_KLs], axis=1)
+            if detec_KLs is not None:
+                M = np.concatenate([M,M_KLs_detec], axis=1)
 
 
         if regularization == "default":
@@ -363,6 +404,11 @@ def hc_atmgrid_splinefm_jwst_nirspec_cal(nonlin_paras, cubeobj, atm_grid=None, a
             extra_outputs["where_trace_finite"] = where_trace_finite
 
 
+        if split_planet:
+            if len(extra_outputs) >= 1:
+                return d, M[:, 1::], comp_model, s, extra_outputs
+            else:
+                return d, M[:, 1::], comp_model, s
         if len(extra_outputs) >= 1:
             return d, M, s,extra_outputs
         else:
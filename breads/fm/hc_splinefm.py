@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.sparse
 from astropy import constants as const
 
 from breads.utils import get_spline_model, pixgauss2d
@@ -6,7 +7,7 @@ from breads.utils import get_spline_model, pixgauss2d
 
 
 def hc_splinefm(nonlin_paras, cubeobj, planet_f=None, transmission=None, star_spectrum=None,boxw=1, psfw=1.2,nodes=20,
-                badpixfraction=0.75,loc=None,fix_parameters=None):
+                badpixfraction=0.75,loc=None,fix_parameters=None,split_planet=False,sparse=False,dtype=np.float64):
     """
     For high-contrast companions (planet + speckles).
     Generate forward model fitting the continuum with a spline. No high pass filter or continuum normalization here.
@@ -38,6 +39,11 @@ def hc_splinefm(nonlin_paras, cubeobj, planet_f=None, transmission=None, star_sp
             When loc is not None, the x,y non-linear parameters should not be given.
         fix_parameters: List. Use to fix the value of some non-linear parameters. The values equal to None are being
                     fitted for, other elements will be fixed to the value specified.
+        split_planet: If True, return the planet model separately from the speckle model: (d, M_fixed, m_planet, s),
+            with M = [m_planet, M_fixed]. See nuisance_cache in breads.fit.fitfm().
+        sparse: If True, return the linear model as a scipy.sparse.csc_matrix built from the non-zero blocks of the
+            speckle model (one per spaxel), without forming the dense matrix. See breads.fit.fitfm().
+        dtype: Data type of d, M and s (e.g. np.float32 to reduce the memory footprint). Default np.float64.
 
     Returns:
         d: Data as a 1d vector with bad pixels removed (no nans)
@@ -45,18 +51,178 @@ def hc_splinefm(nonlin_paras, cubeobj, planet_f=None, transmission=None, star_sp
             vector and Np = N_nodes*boxw^2+1 is the number of linear parameters.
         s: Noise vector (standard deviation) as a 1d vector matching d.
     """
-    if transmission is None:
-        transmission = np.ones(cubeobj.data.shape[0])
     # import matplotlib.pyplot as plt
     # plt.plot(star_spectrum)
     # plt.show()
+    location = hc_splinefm_location(nonlin_paras, fix_parameters=fix_parameters)
+    stamp = hc_splinefm_prepare(location, cubeobj, transmission=transmission, star_spectrum=star_spectrum, boxw=boxw,
+                                psfw=psfw, nodes=nodes, badpixfraction=badpixfraction, loc=loc, sparse=sparse,
+                                dtype=dtype)
+    return hc_splinefm_evaluate(nonlin_paras, stamp, cubeobj, planet_f=planet_f, transmission=transmission,
+                                star_spectrum=star_spectrum, boxw=boxw, psfw=psfw, nodes=nodes,
+                                badpixfraction=badpixfraction, loc=loc, fix_parameters=fix_parameters,
+                                split_planet=split_planet, sparse=sparse, dtype=dtype)
 
+def hc_splinefm_location(nonlin_paras, fix_parameters=None, **kwargs):
+    """
+    Location of the planet (all the non-linear parameters but the RV) for the location-major protocol of
+    breads.grid_search.process_chunk(). See hc_splinefm() for the arguments.
+    """
     if fix_parameters is not None:
         _nonlin_paras = np.array(fix_parameters)
         _nonlin_paras[np.where(np.array(fix_parameters)==None)] = nonlin_paras
     else:
         _nonlin_paras = nonlin_paras
+    return tuple(_nonlin_paras[1::])
+
+def hc_splinefm_N_linpara(boxw=1, nodes=20, **kwargs):
+    """
+    Number of linear parameters of hc_splinefm() (N_nodes*boxw^2+1), independent of the point of the grid.
+    See hc_splinefm() for the arguments.
+    """
+    if type(nodes) is int:
+        N_nodes = nodes
+    elif (type(nodes) is list or type(nodes) is np.ndarray) and \
+            (type(nodes[0]) is list or type(nodes[0]) is np.ndarray):
+        N_nodes = np.sum([np.size(n) for n in nodes])
+    else:
+        N_nodes = np.size(nodes)
+    return int(boxw * boxw * N_nodes + 1)
+
+def hc_splinefm_prepare(location, cubeobj, planet_f=None, transmission=None, star_spectrum=None,boxw=1, psfw=1.2,
+                        nodes=20,badpixfraction=0.75,loc=None,fix_parameters=None,split_planet=False,sparse=False,
+                        dtype=np.float64):
+    """
+    Part of hc_splinefm() that only depends on the location of the planet (see hc_splinefm_location()), computed once
+    per location and then passed to hc_splinefm_evaluate() for each RV. See hc_splinefm() for the arguments.
+    """
+    if transmission is None:
+        transmission = np.ones(cubeobj.data.shape[0])
+    # The RV is not used by the stamp
+    return _hc_splinefm_stamp([0]+list(location), cubeobj, transmission=transmission, star_spectrum=star_spectrum,
+                              boxw=boxw, psfw=psfw, nodes=nodes, badpixfraction=badpixfraction, loc=loc, sparse=sparse,
+                              dtype=dtype)
+
+def hc_splinefm_evaluate(nonlin_paras, stamp, cubeobj, planet_f=None, transmission=None, star_spectrum=None,boxw=1,
+                         psfw=1.2,nodes=20,badpixfraction=0.75,loc=None,fix_parameters=None,split_planet=False,
+                         sparse=False,dtype=np.float64):
+    """
+    Same as hc_splinefm() with the location dependent part (stamp) computed by hc_splinefm_prepare() with the same
+    sparse argument.
+    """
+    if transmission is None:
+        transmission = np.ones(cubeobj.data.shape[0])
+    if fix_parameters is not None:
+        _nonlin_paras = np.array(fix_parameters)
+        _nonlin_paras[np.where(np.array(fix_parameters)==None)] = nonlin_paras
+    else:
+        _nonlin_paras = nonlin_paras
+
+    N_linpara = stamp["N_linpara"]
+    if stamp["d"] is None:
+        # don't bother to do a fit if there are too many bad pixels
+        if split_planet:
+            return np.array([]), np.array([]).reshape(0,N_linpara-1), np.array([]), np.array([])
+        return np.array([]), np.array([]).reshape(0,N_linpara), np.array([])
+
+    rv = _nonlin_paras[0]
+    scaled_psfs = _hc_splinefm_planet(rv, stamp, cubeobj, planet_f=planet_f, transmission=transmission,
+                                      star_spectrum=star_spectrum).astype(dtype, copy=False)
+    if split_planet:
+        return stamp["d"], stamp["M_speckles_r"], np.ravel(scaled_psfs)[stamp["where_finite"][0]], stamp["s"]
+    if sparse:
+        # The speckle model of the stamp is already sparse, only the planet column is added
+        planet_r = np.ravel(scaled_psfs)[stamp["where_finite"][0]]
+        Mr = scipy.sparse.hstack([scipy.sparse.csc_matrix(planet_r[:, None]), stamp["M_speckles_r"]], format="csc")
+        return stamp["d"], Mr, stamp["s"]
+    nz = scaled_psfs.shape[0]
+    # combine planet model with speckle model
+    M = np.concatenate([scaled_psfs[:, :, :, None], stamp["M_speckles"]], axis=3)
+    # Ravel data dimension
+    M = np.reshape(M, (nz * boxw * boxw, N_linpara))
+    # Get rid of bad pixels
+    Mr = M[stamp["where_finite"][0], :]
+
+    return stamp["d"], Mr, stamp["s"]
 
+def hc_splinefm_batched(nonlin_paras_array, cubeobj, planet_f=None, transmission=None, star_spectrum=None,boxw=1,
+                        psfw=1.2,nodes=20,badpixfraction=0.75,loc=None,fix_parameters=None,split_planet=False,
+                        sparse=False,dtype=np.float64):
+    """
+    Batched version of hc_splinefm() used by breads.fit.fitfm_batch().
+    The stamp extraction and the speckle spline model are only computed once for each distinct location in the batch,
+    only the planet model is recomputed for each radial velocity.
+
+    Args:
+        nonlin_paras_array: Non-linear parameters as an array of shape (B, N_nonlin_paras). Each row is defined as
+            nonlin_paras in hc_splinefm().
+        split_planet: Ignored, the planet model is always the first column of M.
+        sparse: Not supported, the batch is a dense array. A NotImplementedError is raised if True.
+        See hc_splinefm() for the other arguments.
+
+    Returns:
+        d: Data as an array of shape (B,Nd) with Nd the largest data size in the batch.
+        M: Linear models as an array of shape (B,Nd,Np).
+        s: Noise as an array of shape (B,Nd).
+        mask: Boolean array of shape (B,Nd) flagging the valid elements of d, M and s.
+    """
+    if sparse:
+        raise NotImplementedError("Sparse linear models cannot be batched.")
+    if transmission is None:
+        transmission = np.ones(cubeobj.data.shape[0])
+
+    stamps = {}
+    batch = []
+    for nonlin_paras in nonlin_paras_array:
+        if fix_parameters is not None:
+            _nonlin_paras = np.array(fix_parameters)
+            _nonlin_paras[np.where(np.array(fix_parameters)==None)] = nonlin_paras
+        else:
+            _nonlin_paras = nonlin_paras
+        location = tuple(_nonlin_paras[1::])
+        if location not in stamps:
+            stamps[location] = _hc_splinefm_stamp(_nonlin_paras, cubeobj, transmission=transmission,
+                                                  star_spectrum=star_spectrum, boxw=boxw, psfw=psfw, nodes=nodes,
+                                                  badpixfraction=badpixfraction, loc=loc, dtype=dtype)
+        batch.append((_nonlin_paras[0], stamps[location]))
+
+    N_linpara = batch[0][1]["N_linpara"]
+    Nd = np.max([0]+[np.size(stamp["d"]) for _, stamp in batch if stamp["d"] is not None])
+    d = np.zeros((len(batch), Nd), dtype=dtype)
+    M = np.zeros((len(batch), Nd, N_linpara), dtype=dtype)
+    s = np.ones((len(batch), Nd), dtype=dtype)
+    mask = np.zeros((len(batch), Nd), dtype=bool)
+    for b, (rv, stamp) in enumerate(batch):
+        if stamp["d"] is None:
+            continue
+        _Nd = np.size(stamp["d"])
+        scaled_psfs = _hc_splinefm_planet(rv, stamp, cubeobj, planet_f=planet_f, transmission=transmission,
+                                          star_spectrum=star_spectrum)
+        d[b, 0:_Nd] = stamp["d"]
+        s[b, 0:_Nd] = stamp["s"]
+        M[b, 0:_Nd, 0] = np.ravel(scaled_psfs)[stamp["where_finite"][0]]
+        M[b, 0:_Nd, 1::] = stamp["M_speckles_r"]
+        mask[b, 0:_Nd] = True
+    return d, M, s, mask
+
+# Opt in to breads.fit.fitfm_batch()
+hc_splinefm.batched = hc_splinefm_batched
+# Opt in to the location-major iteration of breads.grid_search.process_chunk()
+hc_splinefm.location = hc_splinefm_location
+hc_splinefm.prepare = hc_splinefm_prepare
+hc_splinefm.evaluate = hc_splinefm_evaluate
+# Number of linear parameters, used by breads.grid_search.grid_search() to preallocate its outputs
+hc_splinefm.N_linpara = hc_splinefm_N_linpara
+
+def _hc_splinefm_stamp(_nonlin_paras, cubeobj, transmission=None, star_spectrum=None,boxw=1, psfw=1.2,nodes=20,
+                       badpixfraction=0.75,loc=None,sparse=False,dtype=np.float64):
+    """
+    Part of hc_splinefm() that only depends on the location of the planet: stamp extraction, bad pixels, speckle model
+    and PSF. If sparse is True, the speckle model is only stored as the scipy.sparse.csc_matrix "M_speckles_r".
+
+    Returns:
+        Dictionary. "d" is None if the location should not be fitted.
+    """
     # Handle the different data dimensions
     # Convert everything to 3D cubes (wv,y,x) for the followying
     if len(cubeobj.data.shape)==1:
@@ -76,7 +242,6 @@ def hc_splinefm(nonlin_paras, cubeobj, planet_f=None, transmission=None, star_sp
     else:
         refpos = cubeobj.refpos
 
-    rv = _nonlin_paras[0]
     # Defining the position of companion
     # If loc is not defined, then the x,y position is assume to be a non linear parameter.
     if np.size(loc) ==2:
@@ -150,29 +315,55 @@ def hc_splinefm(nonlin_paras, cubeobj, planet_f=None, transmission=None, star_sp
 
 
     where_finite = np.where(np.isfinite(badpixs))
+    stamp = {"N_linpara":N_linpara, "d":None}
     if np.size(where_finite[0]) <= (1-badpixfraction) * np.size(badpixs) or \
             padk > ny+2*w-1 or padk < 0 or padl > nx+2*w-1 or padl < 0:
         # don't bother to do a fit if there are too many bad pixels
-        return np.array([]), np.array([]).reshape(0,N_linpara), np.array([])
+        return stamp
     else:
-        # Get the linear model (ie the matrix) for the spline
-        M_speckles = np.zeros((nz, boxw, boxw, boxw, boxw, N_nodes))
-        for _k in range(boxw):
-            for _l in range(boxw):
-                lwvs = wvs[:,np.clip(k-w+_k,0,nywv-1),np.clip(l-w+_l,0,nxwv-1)]
-                M_spline = get_spline_model(x_knots, lwvs, spline_degree=3)
-                M_speckles[:, _k, _l, _k, _l, :] = M_spline * star_spectrum[:, None]
-        M_speckles = np.reshape(M_speckles, (nz, boxw, boxw, boxw * boxw * N_nodes))
-
-        if fitback:
-            M_background = np.zeros((nz, boxw, boxw, boxw, boxw,3))
+        if sparse:
+            # Only build the non-zero blocks of the speckle model as (rows, columns, values) triplets. The row of
+            # the wavelength z of the spaxel (_k,_l) in the raveled stamp is (z*boxw+_k)*boxw+_l, before removing
+            # the bad pixels.
+            speckles_rows, speckles_cols, speckles_vals = [np.array([],dtype=int)], [np.array([],dtype=int)], \
+                                                          [np.array([])]
+            for _k in range(boxw):
+                for _l in range(boxw):
+                    lwvs = wvs[:,np.clip(k-w+_k,0,nywv-1),np.clip(l-w+_l,0,nxwv-1)]
+                    M_spline = get_spline_model(x_knots, lwvs, spline_degree=3, sparse=True).tocoo()
+                    speckles_rows.append((M_spline.row * boxw + _k) * boxw + _l)
+                    speckles_cols.append((_k * boxw + _l) * N_nodes + M_spline.col)
+                    speckles_vals.append(M_spline.data * star_spectrum[M_spline.row])
+            speckles_rows = np.concatenate(speckles_rows)
+            # Index of each row after removing the bad pixels, -1 for the bad pixels
+            finite_ids = np.zeros(nz * boxw * boxw, dtype=int) - 1
+            finite_ids[where_finite[0]] = np.arange(np.size(where_finite[0]))
+            keep = finite_ids[speckles_rows] >= 0
+            speckles_cols = np.concatenate(speckles_cols)[keep]
+            M_speckles_r = scipy.sparse.csc_matrix((np.concatenate(speckles_vals)[keep],
+                                                    (finite_ids[speckles_rows[keep]], speckles_cols)),
+                                                   shape=(np.size(where_finite[0]), N_linpara-1), dtype=dtype)
+            M_speckles_r.eliminate_zeros()
+        else:
+            # Get the linear model (ie the matrix) for the spline
+            M_speckles = np.zeros((nz, boxw, boxw, boxw, boxw, N_nodes), dtype=dtype)
             for _k in range(boxw):
                 for _l in range(boxw):
                     lwvs = wvs[:,np.clip(k-w+_k,0,nywv-1),np.clip(l-w+_l,0,nxwv-1)]
-                    M_background[:, _k, _l, _k, _l, 0] = 1
-                    M_background[:, _k, _l, _k, _l, 1] = lwvs
-                    M_background[:, _k, _l, _k, _l, 2] = lwvs**2
-            M_background = np.reshape(M_background, (nz, boxw, boxw, 3*boxw**2))
+                    M_spline = get_spline_model(x_knots, lwvs, spline_degree=3)
+                    M_speckles[:, _k, _l, _k, _l, :] = M_spline * star_spectrum[:, None]
+            M_speckles = np.reshape(M_speckles, (nz, boxw, boxw, boxw * boxw * N_nodes))
+
+            if fitback:
+                M_background = np.zeros((nz, boxw, boxw, boxw, boxw,3), dtype=dtype)
+                for _k in range(boxw):
+                    for _l in range(boxw):
+                        lwvs = wvs[:,np.clip(k-w+_k,0,nywv-1),np.clip(l-w+_l,0,nxwv-1)]
+                        M_background[:, _k, _l, _k, _l, 0] = 1
+                        M_background[:, _k, _l, _k, _l, 1] = lwvs
+                        M_background[:, _k, _l, _k, _l, 2] = lwvs**2
+                M_background = np.reshape(M_background, (nz, boxw, boxw, 3*boxw**2))
+                M_speckles = np.concatenate([M_speckles,M_background], axis=3)
 
         psfs = np.zeros((nz, boxw, boxw))
         # Technically allows super sampled PSF to account for a true 2d gaussian integration of the area of a pixel.
@@ -183,31 +374,38 @@ def hc_splinefm(nonlin_paras, cubeobj, planet_f=None, transmission=None, star_sp
         psfs += pixgauss2d([1., w+dx, w+dy, psfw, 0.], (boxw, boxw), xhdgrid=xhdgrid, yhdgrid=yhdgrid)[None, :, :]
         psfs = psfs / np.nansum(psfs, axis=(1, 2))[:, None, None]
 
-        # flux ratio normalization
-        star_flux = np.nanmean(star_spectrum) * np.size(star_spectrum)
-
-        scaled_psfs = np.zeros((nz,boxw,boxw))+np.nan
-        for _k in range(boxw):
-            for _l in range(boxw):
-                lwvs = wvs[:,np.clip(k-w+_k,0,nywv-1),np.clip(l-w+_l,0,nxwv-1)]
-                # The planet spectrum model is RV shifted and multiplied by the tranmission
-                planet_spec = transmission * planet_f(lwvs * (1 - (rv - cubeobj.bary_RV) / const.c.to('km/s').value))
-                scaled_psfs[:,_k,_l] = psfs[:, _k,_l] * planet_spec
+        # Get rid of bad pixels
+        stamp["d"] = d[where_finite].astype(dtype, copy=False)
+        stamp["s"] = s[where_finite].astype(dtype, copy=False)
+        stamp["where_finite"] = where_finite
+        if sparse:
+            stamp["M_speckles_r"] = M_speckles_r
+        else:
+            stamp["M_speckles"] = M_speckles
+            stamp["M_speckles_r"] = np.reshape(M_speckles, (nz * boxw * boxw, N_linpara-1))[where_finite[0], :]
+        stamp["psfs"] = psfs
+        stamp["lwvs_list"] = [[wvs[:,np.clip(k-w+_k,0,nywv-1),np.clip(l-w+_l,0,nxwv-1)] for _l in range(boxw)]
+                              for _k in range(boxw)]
+        return stamp
 
-        planet_flux = np.size(scaled_psfs) * np.nanmean(scaled_psfs)
-        scaled_psfs = scaled_psfs / planet_flux * star_flux
-        # print(np.nansum(scaled_psfs))
+def _hc_splinefm_planet(rv, stamp, cubeobj, planet_f=None, transmission=None, star_spectrum=None):
+    """
+    Part of hc_splinefm() that depends on the radial velocity: the planet model as a stamp cube (nz,boxw,boxw).
+    """
+    psfs = stamp["psfs"]
+    nz, boxw, _ = psfs.shape
+    # flux ratio normalization
+    star_flux = np.nanmean(star_spectrum) * np.size(star_spectrum)
 
-        # combine planet model with speckle model
-        if fitback:
-            M = np.concatenate([scaled_psfs[:, :, :, None], M_speckles,M_background], axis=3)
-        else:
-            M = np.concatenate([scaled_psfs[:, :, :, None], M_speckles], axis=3)
-        # Ravel data dimension
-        M = np.reshape(M, (nz * boxw * boxw, N_linpara))
-        # Get rid of bad pixels
-        sr = s[where_finite]
-        dr = d[where_finite]
-        Mr = M[where_finite[0], :]
+    scaled_psfs = np.zeros((nz,boxw,boxw))+np.nan
+    for _k in range(boxw):
+        for _l in range(boxw):
+            lwvs = stamp["lwvs_list"][_k][_l]
+            # The planet spectrum model is RV shifted and multiplied by the tranmission
+            planet_spec = transmission * planet_f(lwvs * (1 - (rv - cubeobj.bary_RV) / const.c.to('km/s').value))
+            scaled_psfs[:,_k,_l] = psfs[:, _k,_l] * planet_spec
 
-        return dr, Mr, sr
\ No newline at end of file
+    planet_flux = np.size(scaled_psfs) * np.nanmean(scaled_psfs)
+    scaled_psfs = scaled_psfs / planet_flux * star_flux
+    # print(np.nansum(scaled_psfs))
+    return scaled_psfs
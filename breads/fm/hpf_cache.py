@@ -0,0 +1,185 @@
+"""
+Cache of the high-pass filtered data for the HPF forward models (hc_hpffm, hc_atmgrid_hpffm, iso_hpffm,
+iso_atmgrid_hpffm and iso_atmgrid_doppler_hpffm).
+
+The low- and high-pass filtered data, and the speckle model derived from the star spectrum, do not depend on the
+non-linear parameters (RV, vsini, atmosphere...). Computing them once for the whole data object lets the forward models
+only filter the planet model:
+
+    compute_hpf_cache(dataobj, star_spectrum=star_spectrum, transmission=transmission, hpf_mode="gauss", res_hpf=50)
+    out = grid_search(para_vecs, dataobj, hc_hpffm, fm_paras, ...)
+
+The forward models use dataobj.hpf_cache automatically if it was computed with the same star spectrum, transmission and
+high-pass filter parameters. It must be recomputed (or removed with dataobj.hpf_cache = None) if the data or the bad
+pixels are modified.
+"""
+import hashlib
+import itertools
+import json
+
+import numpy as np
+
+from breads.utils import LPFvsHPF, broaden
+
+__all__ = ('compute_hpf_cache', 'hpf_cache_stamp', 'save_hpf_cache', 'load_hpf_cache')
+
+
+def _hash(arr):
+    if arr is None:
+        return None
+    return hashlib.sha1(np.ascontiguousarray(arr, dtype=float).tobytes()).hexdigest()
+
+
+def _hpf_cache_key(star_spectrum, transmission, hpf_mode, res_hpf, cutoff, fft_bounds):
+    # Only the nans of the transmission define the bad pixels, its values do not matter
+    transmission_nans = None if transmission is None else np.isnan(transmission)
+    return (hpf_mode, _hash(res_hpf), int(cutoff), tuple(int(b) for b in fft_bounds), _hash(star_spectrum),
+            _hash(transmission_nans))
+
+
+def _as_cubes(cubeobj):
+    """ Data, bad pixels and wavelengths of cubeobj as 3d cubes (wv,y,x), as in the forward models. """
+    return tuple(np.reshape(arr, arr.shape + (1,) * (3 - arr.ndim))
+                 for arr in [cubeobj.data, cubeobj.bad_pixels, cubeobj.wavelengths])
+
+
+def _filter_spaxels(lwvs, data_vecs, badpix_vecs, star_spectrum, hpf_mode, res_hpf, cutoff, fft_bounds):
+    """
+    High-pass filter the data of a spaxel and compute its speckle model exactly as in the forward models.
+    In fft mode, data_vecs and badpix_vecs can be (N_spaxels, nz) arrays, which are filtered at once.
+    """
+    data_lpf = np.zeros(data_vecs.shape) + np.nan
+    data_hpf = np.zeros(data_vecs.shape) + np.nan
+    M_speckles_hpf = None if star_spectrum is None else np.zeros(data_vecs.shape) + np.nan
+    if hpf_mode == "gauss":
+        data_lpf = broaden(lwvs, data_vecs * badpix_vecs, res_hpf)
+        data_hpf = data_vecs - data_lpf
+        if star_spectrum is not None:
+            star_spectrum_lpf = broaden(lwvs, star_spectrum * badpix_vecs, res_hpf)
+            M_speckles_hpf = (star_spectrum - star_spectrum_lpf) / star_spectrum_lpf * data_lpf
+    elif hpf_mode == "fft":
+        for lb, rb in zip(fft_bounds[0:-1], fft_bounds[1::]):
+            data_lpf[..., lb:rb], data_hpf[..., lb:rb] = LPFvsHPF(data_vecs[..., lb:rb] * badpix_vecs[..., lb:rb],
+                                                                  cutoff)
+            if star_spectrum is not None:
+                star_spectrum_lpf, star_spectrum_hpf = LPFvsHPF(star_spectrum[lb:rb] * badpix_vecs[..., lb:rb], cutoff)
+                M_speckles_hpf[..., lb:rb] = LPFvsHPF(star_spectrum_hpf / star_spectrum_lpf * data_lpf[..., lb:rb],
+                                                      cutoff)[1]
+    return data_lpf, data_hpf, M_speckles_hpf
+
+
+def _task_hpf_cache_row(args):
+    """ Filtered data of a row of the cube as (nz, nx) arrays. """
+    wvs_row, data_row, badpix_row, star_spectrum, hpf_mode, res_hpf, cutoff, fft_bounds = args
+    if hpf_mode == "fft":
+        # The fft filter does not depend on the wavelengths, so that the whole row is filtered at once
+        out = _filter_spaxels(None, data_row.T, badpix_row.T, star_spectrum, hpf_mode, res_hpf, cutoff, fft_bounds)
+        return tuple(None if arr is None else arr.T for arr in out)
+    spaxels = [_filter_spaxels(wvs_row[:, min(_l, wvs_row.shape[1] - 1)], data_row[:, _l], badpix_row[:, _l],
+                               star_spectrum, hpf_mode, res_hpf, cutoff, fft_bounds) for _l in range(data_row.shape[1])]
+    return tuple(None if spaxels[0][i] is None else np.stack([spaxel[i] for spaxel in spaxels], axis=1)
+                 for i in range(3))
+
+
+def compute_hpf_cache(cubeobj, star_spectrum=None, transmission=None, hpf_mode=None, res_hpf=50, cutoff=5,
+                      fft_bounds=None, mppool=None):
+    """
+    Compute the high-pass filtered data of every spaxel of cubeobj and store it in cubeobj.hpf_cache.
+
+    Args:
+        cubeobj: Data object. Must inherit breads.instruments.instrument.Instrument.
+        star_spectrum: Star spectrum as in the forward model (hc_* models). None for the iso_* models.
+        transmission: Transmission spectrum as in the forward model.
+        hpf_mode, res_hpf, cutoff, fft_bounds: High-pass filter parameters as in the forward model.
+        mppool: Multiprocessing pool to parallelize the computation (one task per row). Default None.
+
+    Returns:
+        Dictionary with the cubes (wv,y,x) "data_lpf", "data_hpf" and "M_speckles_hpf" (None without star_spectrum),
+        and the "key" identifying the parameters.
+    """
+    if hpf_mode is None:
+        hpf_mode = "gauss"
+    data, bad_pixels, wvs = _as_cubes(cubeobj)
+    nz, ny, nx = data.shape
+    if fft_bounds is None:
+        fft_bounds = np.array([0, nz])
+    # Same bad pixels as in the forward models
+    bad_pixels = np.array(bad_pixels)
+    if transmission is not None:
+        bad_pixels[np.where(np.isnan(transmission if star_spectrum is None else star_spectrum * transmission))[0], :,
+                   :] = np.nan
+
+    args = zip([wvs[:, min(_k, wvs.shape[1] - 1), :] for _k in range(ny)],
+               [data[:, _k, :] for _k in range(ny)],
+               [bad_pixels[:, _k, :] for _k in range(ny)],
+               itertools.repeat(star_spectrum),
+               itertools.repeat(hpf_mode),
+               itertools.repeat(res_hpf),
+               itertools.repeat(cutoff),
+               itertools.repeat(fft_bounds))
+    if mppool is None:
+        rows = map(_task_hpf_cache_row, args)
+    else:
+        rows = mppool.map(_task_hpf_cache_row, args)
+
+    hpf_cache = {"data_lpf": np.zeros((nz, ny, nx)) + np.nan, "data_hpf": np.zeros((nz, ny, nx)) + np.nan,
+                 "M_speckles_hpf": None if star_spectrum is None else np.zeros((nz, ny, nx)) + np.nan,
+                 "key": _hpf_cache_key(star_spectrum, transmission, hpf_mode, res_hpf, cutoff, fft_bounds)}
+    for _k, (data_lpf, data_hpf, M_speckles_hpf) in enumerate(rows):
+        hpf_cache["data_lpf"][:, _k, :] = data_lpf
+        hpf_cache["data_hpf"][:, _k, :] = data_hpf
+        if M_speckles_hpf is not None:
+            hpf_cache["M_speckles_hpf"][:, _k, :] = M_speckles_hpf
+    cubeobj.hpf_cache = hpf_cache
+    return hpf_cache
+
+
+def hpf_cache_stamp(cubeobj, k, l, w, star_spectrum=None, transmission=None, hpf_mode="gauss", res_hpf=50, cutoff=5,
+                    fft_bounds=None):
+    """
+    Stamps of the cached high-pass filtered data centered on the pixel (k, l) (row, column) with half width w.
+    Used by the HPF forward models.
+
+    Returns:
+        data_lpf, data_hpf, M_speckles_hpf as (nz, 2w+1, 2w+1) arrays (nans outside of the data), or None if cubeobj
+        has no cache matching the parameters.
+    """
+    hpf_cache = getattr(cubeobj, "hpf_cache", None)
+    if hpf_cache is None:
+        return None
+    nz, ny, nx = hpf_cache["data_lpf"].shape
+    if fft_bounds is None:
+        fft_bounds = np.array([0, nz])
+    if hpf_cache["key"] != _hpf_cache_key(star_spectrum, transmission, hpf_mode, res_hpf, cutoff, fft_bounds):
+        return None
+    stamps = []
+    for name in ["data_lpf", "data_hpf", "M_speckles_hpf"]:
+        if hpf_cache[name] is None:
+            stamps.append(None)
+            continue
+        stamp = np.zeros((nz, 2 * w + 1, 2 * w + 1)) + np.nan
+        k0, k1, l0, l1 = max(k - w, 0), min(k + w + 1, ny), max(l - w, 0), min(l + w + 1, nx)
+        if k0 < k1 and l0 < l1:
+            stamp[:, k0 - (k - w):k1 - (k - w), l0 - (l - w):l1 - (l - w)] = hpf_cache[name][:, k0:k1, l0:l1]
+        stamps.append(stamp)
+    return tuple(stamps)
+
+
+def save_hpf_cache(cubeobj, filename):
+    """ Save cubeobj.hpf_cache (see compute_hpf_cache()) to a .npz file. """
+    hpf_cache = cubeobj.hpf_cache
+    out = {name: hpf_cache[name] for name in ["data_lpf", "data_hpf"]}
+    if hpf_cache["M_speckles_hpf"] is not None:
+        out["M_speckles_hpf"] = hpf_cache["M_speckles_hpf"]
+    np.savez(filename, key=np.array(json.dumps(hpf_cache["key"])), **out)
+
+
+def load_hpf_cache(cubeobj, filename):
+    """ Load a cache saved with save_hpf_cache() into cubeobj.hpf_cache and return it. """
+    with np.load(filename) as f:
+        key = json.loads(str(f["key"]))
+        key = tuple(tuple(v) if isinstance(v, list) else v for v in key)
+        hpf_cache = {"data_lpf": f["data_lpf"], "data_hpf": f["data_hpf"],
+                     "M_speckles_hpf": f["M_speckles_hpf"] if "M_speckles_hpf" in f else None, "key": key}
+    cubeobj.hpf_cache = hpf_cache
+    return hpf_cache
@@ -3,6 +3,7 @@ from PyAstronomy import pyasl
 from astropy import constants as const
 from scipy.interpolate import interp1d
 
+from breads.fm.hpf_cache import hpf_cache_stamp
 from breads.utils import LPFvsHPF
 from breads.utils import broaden
 from breads.utils import broaden_kernel
@@ -11,7 +12,8 @@ from breads.utils import get_spline_model, pixgauss2d
 
 # pos: (x,y) or fiber, position of the companion
 def iso_atmgrid_doppler_hpffm(nonlin_paras, cubeobj, atm_grid=None, atm_grid_wvs=None, transmission=None,boxw=1, psfw=1.2,
-             badpixfraction=0.75,hpf_mode=None,res_hpf=50,cutoff=5,fft_bounds=None,loc=None,N_nodes=3,fix_parameters=None):
+             badpixfraction=0.75,hpf_mode=None,res_hpf=50,cutoff=5,fft_bounds=None,loc=None,N_nodes=3,fix_parameters=None,
+             dtype=np.float64):
     """
     For high-contrast companions (planet + speckles).
     Generate forward model removing the continuum with a fourier based high pass filter.
@@ -48,6 +50,8 @@ def iso_atmgrid_doppler_hpffm(nonlin_paras, cubeobj, atm_grid=None, atm_grid_wvs
             When loc is not None, the x,y non-linear parameters should not be given.
         fix_parameters: List. Use to fix the value of some non-linear parameters. The values equal to None are being
                     fitted for, other elements will be fixed to the value specified.
+        dtype: Data type of d, M and s (e.g. np.float32 to reduce the memory footprint). The filtering is done in
+            float64. Default np.float64.
 
     Returns:
         d: Data as a 1d vector with bad pixels removed (no nans)
@@ -188,8 +192,8 @@ def iso_atmgrid_doppler_hpffm(nonlin_paras, cubeobj, atm_grid=None, atm_grid_wvs
         # Technically allows super sampled PSF to account for a true 2d gaussian integration of the area of a pixel.
         # But this is disabled for now with hdfactor=1.
         hdfactor = 1#5
-        xhdgrid, yhdgrid = np.meshgrid(np.arange(hdfactor * (boxw)).astype(np.float) / hdfactor,
-                                       np.arange(hdfactor * (boxw)).astype(np.float) / hdfactor)
+        xhdgrid, yhdgrid = np.meshgrid(np.arange(hdfactor * (boxw)).astype(float) / hdfactor,
+                                       np.arange(hdfactor * (boxw)).astype(float) / hdfactor)
         psfs += pixgauss2d([1., w+dx, w+dy, psfw, 0.], (boxw, boxw), xhdgrid=xhdgrid, yhdgrid=yhdgrid)[None, :, :]
         psfs = psfs / np.nansum(psfs, axis=(1, 2))[:, None, None]
 
@@ -199,6 +203,12 @@ def iso_atmgrid_doppler_hpffm(nonlin_paras, cubeobj, atm_grid=None, atm_grid_wvs
         # Stamp cube that will contain the planet model
         scaled_psfs_hpf = np.zeros((nz,boxw,boxw,N_linpara))+np.nan
 
+        # Filtered data precomputed for the whole data object, see breads.fm.hpf_cache
+        hpf_stamp = hpf_cache_stamp(cubeobj, k, l, w, star_spectrum=None, transmission=transmission,
+                                    hpf_mode=hpf_mode, res_hpf=res_hpf, cutoff=cutoff, fft_bounds=fft_bounds)
+        if hpf_stamp is not None:
+            data_lpf, data_hpf = hpf_stamp[0:2]
+
         # Loop over each spaxel in the stamp cube (boxw,boxw)
         for paraid,planet_f in enumerate(planet_f_list):
             for _k in range(boxw):
@@ -212,7 +222,7 @@ def iso_atmgrid_doppler_hpffm(nonlin_paras, cubeobj, atm_grid=None, atm_grid_wvs
 
                     # High pass filter the data and the models
                     if hpf_mode == "gauss":
-                        if paraid == 0:
+                        if paraid == 0 and hpf_stamp is None:
                             data_lpf[:,_k,_l] = broaden(lwvs,cube_stamp[:,_k,_l]*badpix_stamp[:,_k,_l],res_hpf)
                             data_hpf[:,_k,_l] = cube_stamp[:,_k,_l]-data_lpf[:,_k,_l]
 
@@ -220,7 +230,7 @@ def iso_atmgrid_doppler_hpffm(nonlin_paras, cubeobj, atm_grid=None, atm_grid_wvs
                         scaled_psfs_hpf[:,_k,_l,paraid] = scaled_vec-scaled_vec_lpf
                     elif hpf_mode == "fft":
                         for lb,rb in zip(fft_bounds[0:-1],fft_bounds[1::]):
-                            if paraid == 0:
+                            if paraid == 0 and hpf_stamp is None:
                                 data_lpf[lb:rb, _k, _l],data_hpf[lb:rb,_k,_l] = LPFvsHPF(cube_stamp[lb:rb,_k,_l]*badpix_stamp[lb:rb,_k,_l],cutoff)
 
                             _,scaled_psfs_hpf[lb:rb,_k,_l,paraid] = LPFvsHPF(scaled_vec[lb:rb]*badpix_stamp[lb:rb,_k,_l],cutoff)
@@ -233,8 +243,8 @@ def iso_atmgrid_doppler_hpffm(nonlin_paras, cubeobj, atm_grid=None, atm_grid_wvs
         # Ravel data dimension
         M = np.reshape(M, (nz * boxw * boxw, N_linpara))
         # Get rid of bad pixels
-        sr = s[where_finite]
-        dr = d[where_finite]
-        Mr = M[where_finite[0], :]
+        sr = s[where_finite].astype(dtype, copy=False)
+        dr = d[where_finite].astype(dtype, copy=False)
+        Mr = M[where_finite[0], :].astype(dtype, copy=False)
 
         return dr, Mr, sr
\ No newline at end of file
@@ -1,12 +1,14 @@
 import numpy as np
 from astropy import constants as const
 
+from breads.fm.hpf_cache import hpf_cache_stamp
 from breads.utils import LPFvsHPF
 from breads.utils import broaden, pixgauss2d
 
 
 def iso_hpffm(nonlin_paras, cubeobj, planet_f=None, transmission=None,boxw=1, psfw=1.2,badpixfraction=0.75,
-             hpf_mode=None,res_hpf=50,cutoff=5,fft_bounds=None,loc=None,fix_parameters=None):
+             hpf_mode=None,res_hpf=50,cutoff=5,fft_bounds=None,loc=None,fix_parameters=None,
+             dtype=np.float64):
     """
     For isolated objects, so no speckle.
     Generate forward model removing the continuum with a fourier based high pass filter.
@@ -40,6 +42,8 @@ def iso_hpffm(nonlin_paras, cubeobj, planet_f=None, transmission=None,boxw=1, ps
             When loc is not None, the x,y non-linear parameters should not be given.
         fix_parameters: List. Use to fix the value of some non-linear parameters. The values equal to None are being
                     fitted for, other elements will be fixed to the value specified.
+        dtype: Data type of d, M and s (e.g. np.float32 to reduce the memory footprint). The filtering is done in
+            float64. Default np.float64.
 
     Returns:
         d: Data as a 1d vector with bad pixels removed (no nans)
@@ -139,8 +143,8 @@ def iso_hpffm(nonlin_paras, cubeobj, planet_f=None, transmission=None,boxw=1, ps
         # Technically allows super sampled PSF to account for a true 2d gaussian integration of the area of a pixel.
         # But this is disabled for now with hdfactor=1.
         hdfactor = 1#5
-        xhdgrid, yhdgrid = np.meshgrid(np.arange(hdfactor * (boxw)).astype(np.float) / hdfactor,
-                                       np.arange(hdfactor * (boxw)).astype(np.float) / hdfactor)
+        xhdgrid, yhdgrid = np.meshgrid(np.arange(hdfactor * (boxw)).astype(float) / hdfactor,
+                                       np.arange(hdfactor * (boxw)).astype(float) / hdfactor)
         psfs += pixgauss2d([1., w+dx, w+dy, psfw, 0.], (boxw, boxw), xhdgrid=xhdgrid, yhdgrid=yhdgrid)[None, :, :]
         psfs = psfs / np.nansum(psfs, axis=(1, 2))[:, None, None]
 
@@ -150,6 +154,12 @@ def iso_hpffm(nonlin_paras, cubeobj, planet_f=None, transmission=None,boxw=1, ps
         # Stamp cube that will contain the planet model
         scaled_psfs_hpf = np.zeros((nz,boxw,boxw))+np.nan
 
+        # Filtered data precomputed for the whole data object, see breads.fm.hpf_cache
+        hpf_stamp = hpf_cache_stamp(cubeobj, k, l, w, star_spectrum=None, transmission=transmission,
+                                    hpf_mode=hpf_mode, res_hpf=res_hpf, cutoff=cutoff, fft_bounds=fft_bounds)
+        if hpf_stamp is not None:
+            data_lpf, data_hpf = hpf_stamp[0:2]
+
         # Loop over each spaxel in the stamp cube (boxw,boxw)
         for _k in range(boxw):
             for _l in range(boxw):
@@ -162,14 +172,16 @@ def iso_hpffm(nonlin_paras, cubeobj, planet_f=None, transmission=None,boxw=1, ps
 
                 # High pass filter the data and the models
                 if hpf_mode == "gauss":
-                    data_lpf[:,_k,_l] = broaden(lwvs,cube_stamp[:,_k,_l]*badpix_stamp[:,_k,_l],res_hpf)
-                    data_hpf[:,_k,_l] = cube_stamp[:,_k,_l]-data_lpf[:,_k,_l]
+                    if hpf_stamp is None:
+                        data_lpf[:,_k,_l] = broaden(lwvs,cube_stamp[:,_k,_l]*badpix_stamp[:,_k,_l],res_hpf)
+                        data_hpf[:,_k,_l] = cube_stamp[:,_k,_l]-data_lpf[:,_k,_l]
 
                     scaled_vec_lpf = broaden(lwvs,scaled_vec*badpix_stamp[:,_k,_l],res_hpf)
                     scaled_psfs_hpf[:,_k,_l] = scaled_vec-scaled_vec_lpf
                 elif hpf_mode == "fft":
                     for lb,rb in zip(fft_bounds[0:-1],fft_bounds[1::]):
-                        data_lpf[lb:rb, _k, _l],data_hpf[lb:rb,_k,_l] = LPFvsHPF(cube_stamp[lb:rb,_k,_l]*badpix_stamp[lb:rb,_k,_l],cutoff)
+                        if hpf_stamp is None:
+                            data_lpf[lb:rb, _k, _l],data_hpf[lb:rb,_k,_l] = LPFvsHPF(cube_stamp[lb:rb,_k,_l]*badpix_stamp[lb:rb,_k,_l],cutoff)
 
                         _,scaled_psfs_hpf[lb:rb,_k,_l] = LPFvsHPF(scaled_vec[lb:rb]*badpix_stamp[lb:rb,_k,_l],cutoff)
 
@@ -181,8 +193,8 @@ def iso_hpffm(nonlin_paras, cubeobj, planet_f=None, transmission=None,boxw=1, ps
         # Ravel data dimension
         M = np.reshape(M, (nz * boxw * boxw, N_linpara))
         # Get rid of bad pixels
-        sr = s[where_finite]
-        dr = d[where_finite]
-        Mr = M[where_finite[0], :]
+        sr = s[where_finite].astype(dtype, copy=False)
+        dr = d[where_finite].astype(dtype, copy=False)
+        Mr = M[where_finite[0], :].astype(dtype, copy=False)
 
         return dr, Mr, sr
\ No newline at end of file
@@ -1,15 +1,34 @@
 import multiprocessing as mp
 import numpy as np
 import itertools
+import pickle
+import inspect
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
 
 from scipy.optimize import lsq_linear
 from scipy.special import loggamma
 from scipy.interpolate import InterpolatedUnivariateSpline
+from scipy.ndimage import uniform_filter
 from astropy import constants as const
 
-from breads.fit import fitfm
+from breads import profiling
+from breads.adaptive import adaptive_grid_search
+from breads.fit import fitfm, fitfm_batch, STATUS_EXCEPTION, STATUS_MASKED, STATUS_NOT_COMPUTED
+from breads.parallel import (Executor, SharedArrays, blas_thread_limit, resolve, set_worker_blas_threads,
+                             thread_split)
+from breads.progress import make_reporter
+from breads.shards import _save_shard, merge_shards
+from breads.storage import (_MAX_ERRORS, _checkpoint_output_store, _failure_report, _new_output_file,
+                            _open_output_store, _split_output, _store_outputs, load_grid_search,
+                            load_grid_search_done, load_grid_search_status)
+from breads.utils import LRUCache
 
-__all__ = ('grid_search', 'process_chunk')
+__all__ = ('grid_search', 'adaptive_grid_search', 'process_chunk', 'validate_precision', 'load_grid_search',
+           'load_grid_search_done', 'load_grid_search_status', 'valid_pixel_count', 'stamp_valid_mask',
+           'merge_shards')
 
 try:
     import mkl
@@ -18,66 +37,203 @@ except ImportError:
     mkl_exists = False
 
 
-
 def process_chunk(args):
     """
     Process for grid_search()
+
+    args is the tuple (nonlin_paras_list, dataobj, fm_func, fm_paras, bounds, computeH0, scale_noise,
+    marginalize_noise_scaling) optionally followed by a dictionary of options:
+        reuse_nuisance: If True, reuse the factorization of the nuisance part of the linear model between points
+            sharing the same nuisance model. See nuisance_cache in breads.fit.fitfm().
+        nuisance_cache_size: Maximum number of nuisance factorizations kept in memory (default 128).
+        dtype: Precision of the forward model. See dtype in breads.fit.fitfm().
+        profile: If True, collect the profiling data of the chunk (see breads.profiling) and return it with the output
+            as (out_chunk, breads.profiling.snapshot()). Used by grid_search() for worker processes.
+        location_major: If True (default) and fm_func supports it, use the location-major iteration described below.
+        verbose: If False, do not print the errors (default True).
+        return_status: If True, return (out_chunk, status_chunk, errors) instead of out_chunk, with status_chunk the
+            status code of each point (see breads.fit.STATUS_NAMES) and errors a list of at most 10 failures
+            (nonlin_paras, status code, error message or traceback).
+        blas_threads: If not None, limit the number of BLAS/LAPACK threads of the (worker) process to this value.
+            See breads.parallel.set_worker_blas_threads().
+        N_linpara: If not None, number of linear parameters of the forward model, used to preallocate the output.
+        batch_size: Maximum number of points solved at once by breads.fit.fitfm_batch() (default 32). The stacked
+            linear models of a batch take batch_size*Nd*Np*8 bytes.
+
+    Location-major protocol: a forward model can opt in by defining the attributes
+        fm_func.location(nonlin_paras, **fm_paras): Hashable location of the point, e.g. the (y, x) position.
+        fm_func.prepare(location, dataobj, **fm_paras): Part of the model only depending on the location (e.g. stamp
+            extraction and speckle model), computed once per location in the chunk.
+        fm_func.evaluate(nonlin_paras, prepared, dataobj, **fm_paras): Same output as fm_func(nonlin_paras, dataobj,
+            **fm_paras) given the output of prepare().
+    See breads.fm.hc_splinefm.hc_splinefm for an example.
+
+    If fm_func also supports batching (fm_func.batched, see breads.fit.fitfm_batch()) and there are no bounds or
+    nuisance cache, the points are solved by batches of at most batch_size points taken within each location, such that
+    the location dependent part of the model is computed once per batch. If fm_func.batched raises a
+    NotImplementedError (e.g. for a sparse model) or a batch fails, the points left are fitted one by one.
     """
-    nonlin_paras_list, dataobj, fm_func, fm_paras, bounds,computeH0,scale_noise, marginalize_noise_scaling = args
+    nonlin_paras_list, dataobj, fm_func, fm_paras, bounds,computeH0,scale_noise, marginalize_noise_scaling = args[0:8]
+    # dataobj and fm_paras might be installed in the worker already (see breads.parallel.Executor)
+    dataobj, fm_paras = resolve(dataobj), resolve(fm_paras)
+    if len(args) > 8:
+        options = args[8]
+    else:
+        options = {}
+    set_worker_blas_threads(options.get("blas_threads", None))
 
-    outarr_not_created = True
-    for k, nonlin_paras in enumerate(zip(*nonlin_paras_list)):
-        try:
-        # if 1:
-            log_prob,log_prob_H0,rchi2,linparas,linparas_err = fitfm(nonlin_paras,dataobj,fm_func,fm_paras,bounds=bounds,
-                                                                     computeH0=computeH0,scale_noise=scale_noise,
-                                                                     marginalize_noise_scaling=marginalize_noise_scaling)
-            new_N_linpara = np.size(linparas)
-            # if k == 0:
-            #     out_chunk = np.zeros((np.size(nonlin_paras_list[0]),1+1+1+2*N_linpara))+np.nan
-            # out_chunk[k,0] = log_prob
-            # out_chunk[k,1] = log_prob_H0
-            # out_chunk[k,2] = rchi2
-            # out_chunk[k,3:(N_linpara+3)] = linparas
-            # out_chunk[k,(N_linpara+3):(2*N_linpara+3)] = linparas_err
-
-            if outarr_not_created:
-                out_chunk = np.zeros((np.size(nonlin_paras_list[0]),1+1+1+2*new_N_linpara))+np.nan
-                outarr_not_created = False
-            old_N_linpara = int((out_chunk.shape[-1] - 3) / 2)
-            # print(old_N_linpara,new_N_linpara)
-            if old_N_linpara >= new_N_linpara:
-                # If the out array has more parameters than the current fit
-                out_chunk[k,0] = log_prob
-                out_chunk[k,1] = log_prob_H0
-                out_chunk[k,2] = rchi2
-                out_chunk[k,3:3 + new_N_linpara] = linparas
-                out_chunk[k,3 + old_N_linpara:3 + old_N_linpara + new_N_linpara] = linparas_err
-            elif old_N_linpara < new_N_linpara:
-                # If we made the out array too small, then make it bigger
-                new_out_shape = (np.size(nonlin_paras_list[0]),new_N_linpara-old_N_linpara)
-                list2concatenate = []
-                list2concatenate.append(out_chunk[:,0:3 + old_N_linpara])
-                list2concatenate.append(np.zeros(new_out_shape))
-                list2concatenate.append(out_chunk[:,3 + old_N_linpara::])
-                list2concatenate.append(np.zeros(new_out_shape))
-                out_chunk = np.concatenate(list2concatenate, axis=1)
-                out_chunk[k,0] = log_prob
-                out_chunk[k,1] = log_prob_H0
-                out_chunk[k,2] = rchi2
-                out_chunk[k,3:3 + new_N_linpara] = linparas
-                out_chunk[k,3 + new_N_linpara::] = linparas_err
-        except Exception as e:
-            print(nonlin_paras,e)
-    try:
-    # if 1:
-        return out_chunk
-    except Exception as e:
-        print(nonlin_paras,e)
-        return None
+    if options.get("profile", False):
+        # Worker process: collect the profiling data of this chunk only and send it back with the output
+        profiling.reset()
+        profiling.enable()
+        with profiling.stage("grid_search.process_chunk"):
+            out_chunk = process_chunk(tuple(args[0:8]) + (dict(options, profile=False),))
+        return out_chunk, profiling.snapshot()
 
+    dtype = options.get("dtype", None)
+    verbose = options.get("verbose", True)
+    N_points = np.size(nonlin_paras_list[0])
+    status_chunk = np.zeros(N_points, dtype=np.int8) + STATUS_NOT_COMPUTED
+    errors = []
+    if options.get("reuse_nuisance", False):
+        nuisance_cache = LRUCache(maxsize=options.get("nuisance_cache_size", 128))
+        # Visit the points sorted by the last non-linear parameters (usually the position) so that the points sharing
+        # the same nuisance model are processed consecutively.
+        order = np.lexsort([np.asarray(pgrid, dtype=float) for pgrid in nonlin_paras_list])
+    else:
+        nuisance_cache = None
+        order = np.arange(np.size(nonlin_paras_list[0]))
+
+    out_chunk = None
+    if options.get("N_linpara", None) is not None:
+        out_chunk = np.zeros((N_points,1+1+1+2*options["N_linpara"]))+np.nan
+    nonlin_paras_points = list(zip(*nonlin_paras_list))
+    if hasattr(fm_func, "prepare") and options.get("location_major", True):
+        # Location-major iteration: the part of the forward model that only depends on the location is prepared once
+        # for all the points at that location. The points keep the order defined above within each location.
+        groups = {}
+        for k in order:
+            groups.setdefault(fm_func.location(nonlin_paras_points[k], **fm_paras), []).append(k)
+        groups = list(groups.items())
+    else:
+        groups = [(None, order)]
 
-def grid_search(para_vecs,dataobj,fm_func,fm_paras,numthreads=None,bounds=None,computeH0=False,scale_noise=True,marginalize_noise_scaling=False):
+    if bounds is None and hasattr(fm_func, "batched") and nuisance_cache is None:
+        # The forward model supports batching: solve the points by batches of at most batch_size points taken within
+        # each location, so that the location dependent part of the model is still computed once per batch.
+        batch_size = options.get("batch_size", 32)
+        nonlin_paras_array = np.array(nonlin_paras_list).T
+        batches = [np.array(group[start:start + batch_size]) for _, group in groups
+                   for start in range(0, len(group), batch_size)]
+        for batch in batches:
+            try:
+                fit_status = {}
+                log_prob,log_prob_H0,rchi2,linparas,linparas_err = fitfm_batch(
+                    nonlin_paras_array[batch],dataobj,fm_func,fm_paras,computeH0=computeH0,scale_noise=scale_noise,
+                    marginalize_noise_scaling=marginalize_noise_scaling,dtype=dtype,status=fit_status)
+            except NotImplementedError:
+                # Options of the forward model not supported in batched mode (e.g. sparse=True)
+                break
+            except Exception as e:
+                if verbose:
+                    print("Batched fit failed, fitting the points one by one instead:", e)
+                break
+            out_chunk = _store_points(out_chunk, N_points, batch, log_prob, log_prob_H0, rchi2, linparas,
+                                      linparas_err)
+            status_chunk[batch] = fit_status["code"]
+            for b, message in fit_status["message"].items():
+                _record_error(errors, nonlin_paras_array[batch[b]], status_chunk[batch[b]], message)
+        # The points left (if a batch failed) are fitted one by one below
+        groups = [(location, [k for k in group if status_chunk[k] == STATUS_NOT_COMPUTED])
+                  for location, group in groups]
+        groups = [(location, group) for location, group in groups if len(group) != 0]
+
+    for location, group in groups:
+        _fm_func = fm_func
+        if location is not None:
+            try:
+                prepared = fm_func.prepare(location, dataobj, **(fm_paras if dtype is None else
+                                                                 dict(fm_paras, dtype=dtype)))
+                _fm_func = _prepared_fm(fm_func, prepared)
+            except Exception as e:
+                if verbose:
+                    print(location, e)
+                status_chunk[group] = STATUS_EXCEPTION
+                _record_error(errors, nonlin_paras_points[group[0]], STATUS_EXCEPTION, traceback.format_exc())
+                continue
+        for k in group:
+            nonlin_paras = nonlin_paras_points[k]
+            try:
+            # if 1:
+                fit_status = {}
+                log_prob,log_prob_H0,rchi2,linparas,linparas_err = fitfm(nonlin_paras,dataobj,_fm_func,fm_paras,bounds=bounds,
+                                                                         computeH0=computeH0,scale_noise=scale_noise,
+                                                                         marginalize_noise_scaling=marginalize_noise_scaling,
+                                                                         nuisance_cache=nuisance_cache,dtype=dtype,
+                                                                         status=fit_status,verbose=verbose)
+                status_chunk[k] = fit_status["code"]
+                if "message" in fit_status:
+                    _record_error(errors, nonlin_paras, fit_status["code"], fit_status["message"])
+                out_chunk = _store_points(out_chunk, N_points, [k], log_prob, log_prob_H0, rchi2, linparas,
+                                          linparas_err)
+            except Exception as e:
+                if verbose:
+                    print(nonlin_paras,e)
+                status_chunk[k] = STATUS_EXCEPTION
+                _record_error(errors, nonlin_paras, STATUS_EXCEPTION, traceback.format_exc())
+    # out_chunk is None if none of the points could be fitted
+    return _chunk_output(out_chunk, status_chunk, errors, options)
+
+def _record_error(errors, nonlin_paras, code, message):
+    if len(errors) < _MAX_ERRORS:
+        nonlin_paras = None if nonlin_paras is None else [float(p) for p in nonlin_paras]
+        errors.append((nonlin_paras, int(code), message))
+
+def _store_points(out_chunk, N_points, rows, log_prob, log_prob_H0, rchi2, linparas, linparas_err):
+    """
+    Save the outputs of the points at the indices rows of the chunk in out_chunk, which is created if None, or made
+    bigger if the forward model returned more linear parameters than it has room for. Returns out_chunk.
+    """
+    linparas, linparas_err = np.atleast_2d(linparas), np.atleast_2d(linparas_err)
+    new_N_linpara = linparas.shape[1]
+    if out_chunk is None:
+        out_chunk = np.zeros((N_points,1+1+1+2*new_N_linpara))+np.nan
+    old_N_linpara = int((out_chunk.shape[-1] - 3) / 2)
+    if old_N_linpara < new_N_linpara:
+        # If we made the out array too small, then make it bigger
+        new_out_shape = (N_points,new_N_linpara-old_N_linpara)
+        list2concatenate = []
+        list2concatenate.append(out_chunk[:,0:3 + old_N_linpara])
+        list2concatenate.append(np.zeros(new_out_shape))
+        list2concatenate.append(out_chunk[:,3 + old_N_linpara::])
+        list2concatenate.append(np.zeros(new_out_shape))
+        out_chunk = np.concatenate(list2concatenate, axis=1)
+        old_N_linpara = new_N_linpara
+    # If the out array has more parameters than the current fit, the last ones are left as they are
+    out_chunk[rows,0] = log_prob
+    out_chunk[rows,1] = log_prob_H0
+    out_chunk[rows,2] = rchi2
+    out_chunk[rows,3:3 + new_N_linpara] = linparas
+    out_chunk[rows,3 + old_N_linpara:3 + old_N_linpara + new_N_linpara] = linparas_err
+    return out_chunk
+
+def _chunk_output(out_chunk, status_chunk, errors, options):
+    if options.get("return_status", False):
+        return out_chunk, status_chunk, errors
+    return out_chunk
+
+
+def _prepared_fm(fm_func, prepared):
+    """ Forward model at a prepared location, see the location-major protocol in process_chunk(). """
+    def fm(nonlin_paras, dataobj, **kwargs):
+        return fm_func.evaluate(nonlin_paras, prepared, dataobj, **kwargs)
+    return fm
+
+def grid_search(para_vecs,dataobj,fm_func,fm_paras,numthreads=None,bounds=None,computeH0=False,scale_noise=True,marginalize_noise_scaling=False,
+                reuse_nuisance=False,dtype=None,profile=False,shared_memory=True,mypool=None,out_path=None,
+                resume=False,cost=None,chunks_per_thread=3,valid_mask=None,num_shards=None,shard_index=None,
+                shard_file=None,verbose=True,return_status=False,progress=None,backend="processes",
+                blas_threads=None,N_linpara=None,batch_size=32):
     """
     Planet detection, CCF, or grid search routine.
     It fits for the non linear parameters of a forward model over a user-specified grid of values while marginalizing
@@ -98,10 +254,70 @@ def grid_search(para_vecs,dataobj,fm_func,fm_paras,numthreads=None,bounds=None,c
         fm_func: A forward model function. See breads.fm.template.template() for an example.
         fm_paras: Additional parameters for fm_func (other than non-linear parameters and dataobj)
         numthreads: Number of processes to be used in parallelization. Non parallization if defined as None (default).
+            If "auto", use one worker per core (see breads.parallel.thread_split()).
         bounds: (/!\ Caution: the calculation of log prob is only theoretically accurate if no bounds are used.)
             Bounds on the linear parameters used in lsq_linear as a tuple of arrays (min_vals, maxvals).
             e.g. ([0,0,...], [np.inf,np.inf,...]). default no bounds.
             Each numpy array must have shape (N_linear_parameters,).
+        reuse_nuisance: If True, fm_func must support split_planet=True (see nuisance_cache in breads.fit.fitfm()).
+            The factorization of the nuisance (e.g. speckle) part of the linear model is then computed once and reused
+            for all the points sharing it, for example when exploring RVs or atmospheric parameters at each position.
+        dtype: If not None, precision of the data and linear model built by fm_func (e.g. np.float32). fm_func must
+            accept a dtype keyword argument, otherwise a ValueError is raised. See dtype in breads.fit.fitfm() and
+            validate_precision().
+        profile: If True, collect timings and counters for this call, including in the worker processes. The
+            aggregated report is then available from breads.profiling.report(). Same as calling
+            breads.profiling.enable() beforehand.
+        shared_memory: If True (default), the large arrays of dataobj and fm_paras are copied once in shared memory
+            and the worker processes attach to them, instead of receiving a pickled copy with every chunk.
+            See breads.parallel.SharedArrays. Only used if numthreads is not None. The arrays are then shared between
+            all the workers, as they would be in a non-parallelized search.
+        mypool: Existing multiprocessing pool to be used instead of starting a new one, for example when calling
+            grid_search() repeatedly. If mypool is a breads.parallel.Executor in which dataobj and/or fm_paras are
+            installed, they are not sent to the workers again (call mypool.reinstall() after modifying them).
+            numthreads is ignored if mypool is defined.
+        out_path: If not None, directory where the results are saved as the chunks are completed, together with a
+            completion bitmap, such that a search that was interrupted can be resumed. The outputs are then returned as
+            read-only memory mapped arrays. See breads.storage.load_grid_search() to read the results (e.g. of a search
+            still running) and breads.storage.load_grid_search_done() for the completion bitmap.
+        resume: If True and out_path contains a previous search of the same grid, only compute the points that are not
+            done yet. Otherwise, the content of out_path is overwritten.
+        cost: Optional estimate of the relative computation time of each point, as an array broadcastable to the
+            shape of the grid. For example, valid_pixel_count(dataobj,boxw)[None,:,:] for a grid [rvs,ys,xs] over the
+            spaxels of a cube. The points are then grouped in chunks of similar total cost, starting with the most
+            expensive ones, instead of chunks with the same number of points.
+        chunks_per_thread: Number of chunks per process (default 3). The chunks are dispatched to the processes as
+            they become available, so more (smaller) chunks balance the load better at the cost of more overhead.
+        valid_mask: Optional boolean array broadcastable to the shape of the grid. The points where it is False are
+            not evaluated, and their outputs are set as for a point rejected by the forward model: log_prob and
+            log_prob_H0 = -inf, rchi2 = inf, linparas and linparas_err = nan. See stamp_valid_mask() to skip the
+            positions outside of the field of view or with too many bad pixels.
+        num_shards, shard_index: If defined, only evaluate the shard shard_index (0 <= shard_index < num_shards) of
+            the grid, i.e. the points at the flat indices shard_index, shard_index+num_shards, ... This splits a search
+            into independent jobs (e.g. on different nodes) which can be reassembled with
+            breads.shards.merge_shards().
+            The outputs are then returned for the points of the shard only (first axis).
+        shard_file: If not None, save the outputs of the shard, together with the grid definition, in this .npz file
+            to be read by breads.shards.merge_shards().
+        verbose: If False, do not print the errors of the individual fits (see return_status). Default True.
+        return_status: If True, also return the status codes of the points and a summary of the failures.
+        progress: If True, print the progress, throughput, worker utilisation and ETA of the search at most every few
+            seconds. Can also be a function receiving the telemetry dictionary (see breads.progress), or a
+            breads.progress.ProgressReporter. A non parallelized search is then split in 100 chunks. Default None.
+        backend: "processes" (default) or "threads". Most of the time of a fit is spent in BLAS/LAPACK calls which
+            release the GIL, so that a pool of threads is often as fast as processes, without copying or pickling the
+            data object. The forward model must then be thread safe. Ignored if mypool is defined
+            (multiprocessing.pool.ThreadPool instances use threads).
+        blas_threads: Maximum number of BLAS/LAPACK threads per worker (or for the whole search with threads). Default,
+            the cores left to each worker for a parallel search (see breads.parallel.thread_split()), and no limit
+            otherwise. Requires threadpoolctl (or mkl) to have an effect.
+        N_linpara: Number of linear parameters of the forward model, used to allocate the outputs once before the
+            search. If "probe", it is determined by evaluating fm_func on the first valid point of the grid (see
+            valid_mask). By default, it is read from fm_func.N_linpara(**fm_paras) if the forward model defines it (e.g.
+            breads.fm.hc_splinefm.hc_splinefm), and the outputs are otherwise grown as larger linear models are found.
+        batch_size: Maximum number of points solved at once if fm_func supports batching (default 32), see
+            breads.fit.fitfm_batch() and process_chunk(). The stacked linear models of a batch take batch_size*Nd*Np*8
+            bytes, with Nd the size of the data vector and Np the number of linear parameters.
 
     Returns:
         log_prob: Probability of the model marginalized over linear parameters.
@@ -109,73 +325,370 @@ def grid_search(para_vecs,dataobj,fm_func,fm_paras,numthreads=None,bounds=None,c
         rchi2: noise scaling factor
         linparas: Best fit linear parameters
         linparas_err: Uncertainties of best fit linear parameters
+        status: (Only if return_status is True) Status code of each point of the grid. See breads.fit.STATUS_NAMES for
+            the meaning of the codes (ok, empty_data, singular, exception, masked...).
+        failures: (Only if return_status is True) Dictionary with the number of points for each status ("counts") and
+            a sample of the errors ("errors", list of (nonlin_paras, status code, message or traceback)).
 
     """
     para_grids = [np.ravel(pgrid) for pgrid in np.meshgrid(*para_vecs,indexing="ij")]
+    grid_shape = [np.size(v) for v in para_vecs]
+    if num_shards is not None:
+        if out_path is not None:
+            raise ValueError("out_path cannot be used with num_shards, use shard_file instead.")
+        if shard_index is None or not (0 <= shard_index < num_shards):
+            raise ValueError("shard_index must be defined and between 0 and num_shards-1.")
+        # Interleave the shards so that they have a similar mix of cheap and expensive points
+        indices = np.arange(shard_index, np.size(para_grids[0]), num_shards)
+        if cost is not None:
+            cost = np.ravel(np.broadcast_to(cost, grid_shape))[indices]
+        if valid_mask is not None:
+            valid_mask = np.ravel(np.broadcast_to(valid_mask, grid_shape))[indices]
+        out, status, errors = _search([pgrid[indices] for pgrid in para_grids],[np.size(indices)],dataobj,fm_func,
+                                      fm_paras,numthreads=numthreads,bounds=bounds,computeH0=computeH0,
+                                      scale_noise=scale_noise,marginalize_noise_scaling=marginalize_noise_scaling,
+                                      reuse_nuisance=reuse_nuisance,dtype=dtype,profile=profile,
+                                      shared_memory=shared_memory,mypool=mypool,cost=cost,
+                                      chunks_per_thread=chunks_per_thread,valid_mask=valid_mask,verbose=verbose,
+                                      progress=progress,backend=backend,blas_threads=blas_threads,
+                                      N_linpara=N_linpara,batch_size=batch_size)
+        if out is None:
+            # Nothing could be fitted in this shard
+            out = _store_rejected_points(None, np.arange(np.size(indices)), [np.size(indices)])
+        if shard_file is not None:
+            _save_shard(shard_file, num_shards, shard_index, indices, out, status, errors, para_vecs)
+        if return_status:
+            return _split_output(out) + (status, _failure_report(status, errors))
+        return _split_output(out)
+    out, status, errors = _search(para_grids,grid_shape,dataobj,fm_func,fm_paras,numthreads=numthreads,bounds=bounds,
+                                  computeH0=computeH0,scale_noise=scale_noise,
+                                  marginalize_noise_scaling=marginalize_noise_scaling,reuse_nuisance=reuse_nuisance,
+                                  dtype=dtype,profile=profile,shared_memory=shared_memory,mypool=mypool,
+                                  out_path=out_path,resume=resume,para_vecs=para_vecs,cost=cost,
+                                  chunks_per_thread=chunks_per_thread,valid_mask=valid_mask,verbose=verbose,
+                                  progress=progress,backend=backend,blas_threads=blas_threads,
+                                  N_linpara=N_linpara,batch_size=batch_size)
+    if out_path is not None:
+        out = load_grid_search(out_path)
+    else:
+        out = _split_output(out)
+    if return_status:
+        return out + (status, _failure_report(status, errors))
+    return out
+
 
-    if numthreads is None:
-        _out = process_chunk((para_grids,dataobj,fm_func,fm_paras,bounds,computeH0,scale_noise,marginalize_noise_scaling))
-        out_shape = [np.size(v) for v in para_vecs]+[_out.shape[-1],]
+def _search(para_grids,grid_shape,dataobj,fm_func,fm_paras,numthreads=None,bounds=None,computeH0=False,scale_noise=True,
+            marginalize_noise_scaling=False,reuse_nuisance=False,dtype=None,profile=False,shared_memory=True,mypool=None,
+            out_path=None,resume=False,para_vecs=None,cost=None,chunks_per_thread=3,valid_mask=None,verbose=True,
+            progress=None,backend="processes",blas_threads=None,N_linpara=None,batch_size=32):
+    """
+    Evaluate the points (para_grids[0][k], para_grids[1][k], ...) and return the outputs in an array of shape
+    grid_shape + (3+2*N_linpara,), the status codes of the points (shape grid_shape) and a list of errors (see
+    return_status in process_chunk()). If out_path is not None, the outputs are saved there instead (see
+    _open_output_store()) and None is returned in place of the outputs. See grid_search() for the other arguments.
+    """
+    stop_profiling = profile and not profiling.is_enabled()
+    if profile:
+        profiling.enable()
+    if dtype is not None and not _accepts_dtype(fm_func):
+        raise ValueError("{0} does not accept a dtype argument, it cannot be used with dtype.".format(
+            getattr(fm_func, "__name__", "fm_func")))
+    N_linpara = _declared_N_linpara(N_linpara, para_grids, grid_shape, dataobj, fm_func, fm_paras,
+                                    valid_mask=valid_mask, dtype=dtype)
+    options = {"reuse_nuisance": reuse_nuisance, "dtype": dtype, "verbose": verbose, "return_status": True,
+               "N_linpara": N_linpara, "batch_size": batch_size}
+
+    if backend not in ("processes", "threads"):
+        raise ValueError("backend must be \"processes\" or \"threads\".")
+    if isinstance(mypool, ThreadPool):
+        backend = "threads"
+    elif mypool is not None:
+        backend = "processes"
+    if numthreads == "auto" or (mypool is None and numthreads is not None and blas_threads is None):
+        numthreads, default_blas_threads = thread_split(numthreads)
+        if blas_threads is None:
+            blas_threads = default_blas_threads
+    elif mypool is not None and blas_threads is None:
+        blas_threads = thread_split(mypool._processes)[1]
+
+    if numthreads is None and mypool is None and out_path is None and valid_mask is None and not progress:
+        with profiling.stage("grid_search.process_chunk"), blas_thread_limit(blas_threads):
+            _out, status, errors = process_chunk((para_grids,dataobj,fm_func,fm_paras,bounds,computeH0,scale_noise,
+                                                  marginalize_noise_scaling,options))
+        out_shape = grid_shape+[_out.shape[-1],]
         out = np.reshape(_out,out_shape)
+        status = np.reshape(status,grid_shape)
     else:
-        mypool = mp.Pool(processes=numthreads)
-        chunk_size = np.max([1,np.size(para_grids[0])//(3*numthreads)])
-        N_chunks = np.size(para_grids[0])//chunk_size
-        nonlin_paras_lists = []
-        indices_lists = []
-        for k in range(N_chunks-1):
-            nonlin_paras_lists.append([pgrid[(k*chunk_size):((k+1)*chunk_size)] for pgrid in para_grids])
-            indices_lists.append(np.arange((k*chunk_size),((k+1)*chunk_size)))
-        nonlin_paras_lists.append([pgrid[((N_chunks-1)*chunk_size):np.size(para_grids[0])] for pgrid in para_grids])
-        indices_lists.append(np.arange(((N_chunks-1)*chunk_size),np.size(para_grids[0])))
-
-        output_lists = mypool.map(process_chunk, zip(nonlin_paras_lists,
-                                                     itertools.repeat(dataobj),
-                                                     itertools.repeat(fm_func),
-                                                     itertools.repeat(fm_paras),
-                                                     itertools.repeat(bounds),
-                                                     itertools.repeat(computeH0),
-                                                     itertools.repeat(scale_noise),
-                                                     itertools.repeat(marginalize_noise_scaling)))
-
-        outarr_not_created = True
-        for k,(indices, output_list) in enumerate(zip(indices_lists,output_lists)):
-            if output_list is None:
-                continue
-            for l,outvec in zip(indices,output_list):
-                if outarr_not_created:
-                    out_shape = [np.size(v) for v in para_vecs]+[np.size(output_list[0]),]
-                    out = np.zeros(out_shape)
-                    outarr_not_created = False
-                if out.shape[-1] >= np.size(output_list[0]):
-                    # If the out array has more parameters than the current fit
-                    old_N_linpara = int((out.shape[-1]-3)/2)
-                    new_N_linpara = int((np.size(outvec)-3)/2)
-                    out[np.unravel_index(l, out_shape[0:len(para_vecs)])][0:3+new_N_linpara] = outvec[0:3+new_N_linpara]
-                    out[np.unravel_index(l, out_shape[0:len(para_vecs)])][3+old_N_linpara:3+old_N_linpara+new_N_linpara] = outvec[3+new_N_linpara::]
-                elif out.shape[-1] < np.size(output_list[0]):
-                    # If we made the out array too small, then make it bigger
-                    new_out_shape = [np.size(v) for v in para_vecs]+[(np.size(output_list[0])-out.shape[-1])//2,]
-                    old_N_linpara = int((out.shape[-1]-3)/2)
-                    out = out.T
-                    list2concatenate = []
-                    list2concatenate.append(out[0:3+old_N_linpara])
-                    list2concatenate.append(np.zeros(new_out_shape).T)
-                    list2concatenate.append(out[3+old_N_linpara::])
-                    list2concatenate.append(np.zeros(new_out_shape).T)
-                    out = np.concatenate(list2concatenate,axis=0)
-                    out = out.T
-                    out[np.unravel_index(l, out_shape[0:len(para_vecs)])] = outvec
-
-        mypool.close()
-        mypool.join()
-
-    N_linpara = int((out.shape[-1]-3)/2)
-    out = np.moveaxis(out, -1, 0)
-    log_prob = out[0]
-    log_prob_H0 = out[1]
-    rchi2 = out[2]
-    linparas = np.moveaxis(out[3:3+N_linpara], 0, -1)
-    linparas_err = np.moveaxis(out[3+N_linpara:3+2*N_linpara], 0, -1)
-
-    return log_prob,log_prob_H0,rchi2,linparas,linparas_err
+        errors = []
+        if out_path is not None:
+            meta, done, out, status = _open_output_store(out_path, para_vecs, resume)
+            todo = np.where(np.logical_not(np.ravel(done)))[0]
+            if out is None and N_linpara is not None:
+                out = _new_output_file(out_path, list(grid_shape)+[3+2*N_linpara])
+        else:
+            out = None if N_linpara is None else np.zeros(list(grid_shape)+[3+2*N_linpara])
+            status = np.zeros(grid_shape, dtype=np.int8) + STATUS_NOT_COMPUTED
+            todo = np.arange(np.size(para_grids[0]))
+        if valid_mask is not None:
+            # The masked points are not dispatched, see _store_rejected_points()
+            valid = np.ravel(np.broadcast_to(valid_mask, grid_shape))
+            rejected = todo[np.logical_not(valid[todo])]
+            todo = todo[valid[todo]]
+
+        parallel = numthreads is not None or mypool is not None
+        threads = parallel and backend == "threads"
+        own_pool = parallel and mypool is None
+        if own_pool:
+            with profiling.stage("grid_search.pool_start"):
+                if threads:
+                    mypool = ThreadPool(processes=numthreads)
+                else:
+                    mypool = mp.Pool(processes=numthreads)
+        elif parallel:
+            numthreads = mypool._processes
+        if parallel:
+            N_tasks = chunks_per_thread*numthreads
+        elif out_path is not None or progress:
+            # Non parallelized search saved to disk or reporting its progress: checkpoint every percent of the grid
+            N_tasks = 100
+        else:
+            N_tasks = 1
+        if cost is None:
+            chunk_size = np.max([1,np.size(todo)//N_tasks])
+            N_chunks = np.size(todo)//chunk_size
+            indices_lists = []
+            for k in range(N_chunks-1):
+                indices_lists.append(todo[(k*chunk_size):((k+1)*chunk_size)])
+            if N_chunks > 0:
+                indices_lists.append(todo[((N_chunks-1)*chunk_size)::])
+        else:
+            indices_lists = _balance_chunks(todo, np.ravel(np.broadcast_to(cost, grid_shape))[todo], N_tasks)
+        nonlin_paras_lists = [[pgrid[indices] for pgrid in para_grids] for indices in indices_lists]
+        reporter = make_reporter(progress, np.size(todo), total_tasks=len(indices_lists), label="grid_search",
+                                 numthreads=numthreads if parallel else 1)
+
+        worker_dataobj, worker_fm_paras = dataobj, fm_paras
+        if isinstance(mypool, Executor):
+            worker_dataobj = mypool.reference(dataobj)
+            worker_fm_paras = mypool.reference(fm_paras)
+        shared = SharedArrays()
+        if parallel and shared_memory and not threads:
+            with profiling.stage("grid_search.shared_memory"):
+                worker_dataobj = shared.share(worker_dataobj)
+                worker_fm_paras = shared.share(worker_fm_paras)
+            profiling.count("grid_search.shared_bytes", shared.nbytes())
+
+        # The worker processes limit their own BLAS threads, threads share the limit of the current process
+        options["blas_threads"] = blas_threads if parallel and not threads else None
+        parent_blas_threads = None if options["blas_threads"] is not None else blas_threads
+        options["profile"] = parallel and not threads and profiling.is_enabled()
+        chunk_args = list(zip(nonlin_paras_lists,
+                              itertools.repeat(worker_dataobj),
+                              itertools.repeat(fm_func),
+                              itertools.repeat(worker_fm_paras),
+                              itertools.repeat(bounds),
+                              itertools.repeat(computeH0),
+                              itertools.repeat(scale_noise),
+                              itertools.repeat(marginalize_noise_scaling),
+                              itertools.repeat(options)))
+        if options["profile"]:
+            # Measure the cost of sending the arguments to the workers, which are pickled once per chunk
+            for args in chunk_args:
+                with profiling.stage("grid_search.serialization"):
+                    profiling.count("grid_search.serialized_bytes", len(pickle.dumps(args)))
+
+        try:
+            # The chunks are processed in any order by the first available worker, and their outputs are written back
+            # (or saved) as soon as they are done.
+            if parallel:
+                output_lists = mypool.imap_unordered(_process_indexed_chunk, enumerate(chunk_args))
+            else:
+                output_lists = map(_process_indexed_chunk, enumerate(chunk_args))
+
+            with profiling.stage("grid_search.map"), blas_thread_limit(parent_blas_threads):
+                for k, output_list, (worker, busy_time) in output_lists:
+                    indices = indices_lists[k]
+                    if options["profile"]:
+                        output_list, worker_profile = output_list
+                        profiling.merge(worker_profile)
+                    output_list, status_list, chunk_errors = output_list
+                    errors.extend(chunk_errors[0:_MAX_ERRORS-len(errors)])
+                    with profiling.stage("grid_search.gather"):
+                        np.reshape(status, (np.size(status),))[indices] = status_list
+                        if output_list is not None:
+                            if out_path is None:
+                                out = _store_outputs(out, indices, output_list, grid_shape)
+                            else:
+                                out = _store_outputs(out, indices, output_list, grid_shape,
+                                                     new_array=lambda shape: _new_output_file(out_path, shape))
+                        if out_path is not None:
+                            _checkpoint_output_store(out_path, meta, done, out, indices, status)
+                    if reporter is not None:
+                        reporter.update(np.size(indices), worker=worker, busy_time=busy_time)
+            if reporter is not None:
+                reporter.close()
+            if valid_mask is not None and np.size(rejected) != 0:
+                np.reshape(status, (np.size(status),))[rejected] = STATUS_MASKED
+                if out_path is None:
+                    out = _store_rejected_points(out, rejected, grid_shape)
+                else:
+                    out = _store_rejected_points(out, rejected, grid_shape,
+                                                 new_array=lambda shape: _new_output_file(out_path, shape))
+                    _checkpoint_output_store(out_path, meta, done, out, rejected, status)
+        finally:
+            del chunk_args, worker_dataobj, worker_fm_paras
+            shared.close()
+            if own_pool:
+                mypool.close()
+                mypool.join()
+    if stop_profiling:
+        profiling.disable()
+
+    if out_path is not None:
+        return None, np.array(status), errors
+    return out, status, errors
+
+
+def _declared_N_linpara(N_linpara, para_grids, grid_shape, dataobj, fm_func, fm_paras, valid_mask=None, dtype=None):
+    """
+    Number of linear parameters of the search (see N_linpara in grid_search()), or None if unknown. When probing, the
+    forward model is evaluated at the first point of the grid allowed by valid_mask. If the probe fails, None is
+    returned and the outputs are allocated once the first point has been fitted (the error of that point, if any, is
+    reported by process_chunk()).
+    """
+    if N_linpara is None and hasattr(fm_func, "N_linpara"):
+        N_linpara = fm_func.N_linpara(**fm_paras)
+    if N_linpara == "probe":
+        first = 0
+        if valid_mask is not None:
+            valid = np.flatnonzero(np.ravel(np.broadcast_to(valid_mask, grid_shape)))
+            first = valid[0] if np.size(valid) != 0 else None
+        N_linpara = None
+        if first is not None:
+            try:
+                N_linpara = fm_func([pgrid[first] for pgrid in para_grids], dataobj,
+                                    **(fm_paras if dtype is None else dict(fm_paras, dtype=dtype)))[1].shape[1]
+            except Exception:
+                N_linpara = None
+    return None if N_linpara is None else int(N_linpara)
+
+
+def _accepts_dtype(fm_func):
+    """ True if fm_func takes a dtype keyword argument (see dtype in grid_search()), or if it cannot be inspected. """
+    try:
+        parameters = inspect.signature(fm_func).parameters.values()
+    except (TypeError, ValueError):
+        return True
+    return any(p.name == "dtype" or p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters)
+
+
+def _store_rejected_points(out, indices, grid_shape, new_array=np.zeros):
+    """ Set the outputs at the flat indices to the values returned by fitfm() for a point rejected by fm_func. """
+    N_linpara = 0 if out is None else int((out.shape[-1]-3)/2)
+    outvec = np.concatenate([[-np.inf, -np.inf, np.inf], np.zeros(2*N_linpara)+np.nan])
+    return _store_outputs(out, indices, np.tile(outvec, (np.size(indices), 1)), grid_shape, new_array=new_array)
+
+
+def stamp_valid_mask(dataobj, ys, xs, boxw=1, badpixfraction=0.75):
+    """
+    Positions of a data cube where a stamp based forward model (e.g. breads.fm.hc_splinefm.hc_splinefm) can be fitted,
+    to be used as valid_mask in grid_search(). A position is invalid if the boxw x boxw stamp centered on it falls
+    outside of the cube or if it has more than a fraction badpixfraction of bad pixels, like in the forward models.
+    Only dataobj.bad_pixels is checked, so the forward model might still reject some of the valid positions.
+
+    Args:
+        dataobj: Data object with bad_pixels of shape (nz, ny, nx) and refpos.
+        ys, xs: Positions (relative to dataobj.refpos) as in the grid of grid_search().
+        boxw: Width of the stamp in spaxels.
+        badpixfraction: Max fraction of bad pixels in the stamp.
+
+    Returns:
+        Boolean array of shape (np.size(ys), np.size(xs)). For example, use valid_mask=mask[None,:,:] for a grid
+        [rvs, ys, xs].
+    """
+    nz, ny, nx = dataobj.bad_pixels.shape
+    refpos = (0, 0) if dataobj.refpos is None else dataobj.refpos
+    w = int((boxw - 1) // 2)
+    # Number of valid pixels in the stamps centered on the padded cube, the padding counting as bad pixels
+    count = np.pad(np.sum(np.isfinite(dataobj.bad_pixels), axis=0).astype(float), w, mode="constant")
+    count = np.round(uniform_filter(count, size=boxw, mode="constant", cval=0.0) * boxw ** 2)
+    padk = np.round(refpos[1] + np.asarray(ys, dtype=float)).astype(int) + w
+    padl = np.round(refpos[0] + np.asarray(xs, dtype=float)).astype(int) + w
+    in_cube_k = (padk >= 0) * (padk <= ny + 2 * w - 1)
+    in_cube_l = (padl >= 0) * (padl <= nx + 2 * w - 1)
+    mask = in_cube_k[:, None] * in_cube_l[None, :]
+    where_in_cube = np.where(mask)
+    mask[where_in_cube] = count[padk[where_in_cube[0]], padl[where_in_cube[1]]] > \
+                          (1 - badpixfraction) * nz * boxw ** 2
+    return mask
+
+
+def _process_indexed_chunk(args):
+    k, chunk_args = args
+    t0 = time.perf_counter()
+    out = process_chunk(chunk_args)
+    return k, out, (threading.get_native_id(), time.perf_counter() - t0)
+
+
+def _balance_chunks(indices, cost, N_tasks):
+    """
+    Split the points indices into (at most) N_tasks chunks of similar total cost. The most expensive points are in the
+    first chunks, which are dispatched first, so that the cheap points fill the gaps at the end of the search.
+    """
+    order = np.argsort(-cost, kind="stable")
+    indices, cost = indices[order], cost[order]
+    cum_cost = np.cumsum(cost)
+    if np.size(cum_cost) == 0 or cum_cost[-1] <= 0:
+        return [chunk for chunk in np.array_split(indices, N_tasks) if np.size(chunk) != 0]
+    boundaries = np.searchsorted(cum_cost, cum_cost[-1]*np.arange(1, N_tasks)/N_tasks, side="right")
+    return [chunk for chunk in np.split(indices, np.unique(boundaries)) if np.size(chunk) != 0]
+
+
+def valid_pixel_count(dataobj, boxw=1):
+    """
+    Number of valid pixels (finite data and bad_pixels) in the boxw x boxw stamp centered on each spaxel of a data cube
+    (nz, ny, nx). It is a good proxy for the cost of fitting a forward model at a given position, see cost in
+    grid_search().
+
+    Args:
+        dataobj: Data object with data (and optionally bad_pixels) of shape (nz, ny, nx).
+        boxw: Width of the stamp in spaxels.
+
+    Returns:
+        Array of shape (ny, nx).
+    """
+    valid = np.isfinite(dataobj.data)
+    if dataobj.bad_pixels is not None:
+        valid = valid * np.isfinite(dataobj.bad_pixels)
+    count = np.sum(valid, axis=0).astype(float)
+    # Sum over the stamps, the outside of the cube counting as invalid
+    return np.round(uniform_filter(count, size=boxw, mode="constant", cval=0.0) * boxw ** 2)
+
+
+def validate_precision(para_vecs,dataobj,fm_func,fm_paras,dtype=np.float32,**kwargs):
+    """
+    Check that a reduced precision grid search (see dtype in grid_search()) is accurate enough on a given dataset by
+    comparing it to the float64 reference.
+
+    Args:
+        para_vecs, dataobj, fm_func, fm_paras: See grid_search(). Use a representative subset of the grid as this
+            runs the grid search twice.
+        dtype: Reduced precision to be validated. Default np.float32.
+        kwargs: Other arguments passed to grid_search().
+
+    Returns:
+        Dictionary with the maximum absolute deviations from the float64 reference of the log probabilities
+        ("log_prob" and "log_prob_H0") and of the SNR of the first linear parameter ("snr").
+    """
+    ref = grid_search(para_vecs,dataobj,fm_func,fm_paras,dtype=np.float64,**kwargs)
+    out = grid_search(para_vecs,dataobj,fm_func,fm_paras,dtype=dtype,**kwargs)
+    deviations = {}
+    for name, ref_val, out_val in [("log_prob", ref[0], out[0]), ("log_prob_H0", ref[1], out[1]),
+                                   ("snr", ref[3][..., 0] / ref[4][..., 0], out[3][..., 0] / out[4][..., 0])]:
+        where_finite = np.where(np.isfinite(ref_val) * np.isfinite(out_val))
+        if np.size(where_finite[0]) == 0:
+            deviations[name] = np.nan
+        else:
+            deviations[name] = np.max(np.abs(out_val[where_finite] - ref_val[where_finite]))
+    return deviations
+
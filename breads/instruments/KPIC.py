@@ -8,7 +8,6 @@ import numpy as np
 from scipy.interpolate import interp1d
 
 from breads.instruments.instrument import Instrument
-from breads.utils import broaden
 from breads.utils import findbadpix
 
 
@@ -203,15 +202,31 @@ class KPIC(Instrument):
             wvs: Wavelength sampling of the spectrum to be broadened.
             spectrum: 1D spectrum to be broadened.
             loc: Fiber index to be used.
-            mypool: Multiprocessing pool to parallelize the code. If None (default), non parallelization is applied.
-                E.g. mppool = mp.Pool(processes=10) # 10 is the number processes
+            mypool: Deprecated and ignored. The spectrum is broadened with the operator of the fiber cached by
+                lsf_operator().
 
         Return:
             Broadened spectrum
         """
+        if mppool is not None:
+            warn("The mppool argument of broaden() is deprecated and ignored, the spectrum is broadened with the "
+                 "operator cached by lsf_operator().", DeprecationWarning)
+        return self.broaden_spectra(wvs, spectrum, loc=loc)
+
+    def lsf_resolution(self, wvs, loc=None):
+        """
+        Resolution of the fiber loc interpolated at the wavelengths wvs.
+
+        Args:
+            wvs: Wavelength sampling.
+            loc: Fiber index to be used.
+
+        Return:
+            Resolution vector of the same size as wvs.
+        """
         fill_value = (self.resolution[:,loc][5],self.resolution[:,loc][-5])
         res_func = interp1d(self.wavelengths[:,loc], self.resolution[:,loc], bounds_error=False, fill_value=fill_value)
-        return broaden(wvs, spectrum, res_func(wvs), mppool=mppool)
+        return res_func(wvs)
 
     def selec_order(self,orders):
         nz,nfib = self.data.shape
@@ -8,7 +8,6 @@ from warnings import warn
 import astropy.io.fits as pyfits
 import astropy.units as u
 import numpy as np
-import pandas as pd
 import ctypes
 from astropy.coordinates import SkyCoord, EarthLocation
 from astropy.time import Time
@@ -16,7 +15,6 @@ from astropy.time import Time
 import breads.utils as utils
 from breads.calibration import SkyCalibration
 from breads.instruments.instrument import Instrument
-from breads.utils import broaden
 
 
 class OSIRIS(Instrument):
@@ -175,13 +173,15 @@ class OSIRIS(Instrument):
             spectrum: 1D spectrum to be broadened.
             loc: To be ignored. Could be used in the future to specify (x,y) position if field dependent resolution is
                 available.
-            mypool: Multiprocessing pool to parallelize the code. If None (default), non parallelization is applied.
-                E.g. mppool = mp.Pool(processes=10) # 10 is the number processes
+            mypool: Deprecated and ignored. The spectrum is broadened with the operator cached by lsf_operator().
 
         Return:
             Broadened spectrum
         """
-        return broaden(wvs, spectrum, self.R, mppool=mppool)
+        if mppool is not None:
+            warn("The mppool argument of broaden() is deprecated and ignored, the spectrum is broadened with the "
+                 "operator cached by lsf_operator().", DeprecationWarning)
+        return self.broaden_spectra(wvs, spectrum, loc=None)
 
     def set_noise(self, method="sqrt_cont", num_threads = 16, wid_mov=None, noise_floor=True):
         try:
@@ -221,12 +221,9 @@ def get_noise_floor(dataobj):
 
 def set_continnuum(args):
     data, window = args
-    tmp = np.array(pd.DataFrame(np.concatenate([data, data[::-1]], axis=0)).interpolate(method="linear").fillna(method="bfill").fillna(method="ffill"))
-    myvec_cp_lpf = np.array(pd.DataFrame(tmp).rolling(window=window, center=True).median().interpolate(method="linear").fillna(method="bfill").fillna(method="ffill"))[0:np.size(data), 0]
-    data = data[::-1]
-    tmp = np.array(pd.DataFrame(np.concatenate([data, data[::-1]], axis=0)).interpolate(method="linear").fillna(method="bfill").fillna(method="ffill"))
-    myvec_cp_lpf_r = np.array(pd.DataFrame(tmp).rolling(window=window, center=True).median().interpolate(method="linear").fillna(method="bfill").fillna(method="ffill"))[0:np.size(data), 0]
-    return (myvec_cp_lpf + myvec_cp_lpf_r[::-1]) / 2
+    myvec_cp_lpf = utils.mirrored_running_median(data, window)
+    myvec_cp_lpf_r = utils.mirrored_running_median(data[..., ::-1], window)
+    return (myvec_cp_lpf + myvec_cp_lpf_r[..., ::-1]) / 2
 
 def return_64x19(cube):
     """
@@ -1,10 +1,16 @@
+import hashlib
 import os
 from warnings import warn
 
+import numpy as np
+
 import breads.utils as utils
 
 
 class Instrument:
+    # Maximum number of operators kept by lsf_operator()
+    lsf_cache_size = 64
+
     def __init__(self, ins_type="custom", verbose=True):
         """Initialize instrument
 
@@ -78,6 +84,90 @@ class Instrument:
     def broaden(self, wvs,spectrum):
         return None
 
+    def lsf_resolution(self, wvs, loc=None):
+        """ Resolution of the line spread function at the wavelengths wvs (self.R by default).
+        Instruments with a wavelength or location dependent resolution override it.
+
+        Parameters
+        ----------
+        wvs : ndarray
+            Wavelength sampling.
+        loc : None
+            Location (e.g. fiber index) of the resolution calibration.
+
+        Returns
+        -------
+        Scalar resolution or ndarray of the same size as wvs.
+        """
+        R = getattr(self, "R", None)
+        if R is None:
+            raise NotImplementedError("The resolution of the {0} instrument is not defined.".format(self.ins_type))
+        return R
+
+    def lsf_operator(self, wvs, loc=None):
+        """ Sparse matrix broadening a spectrum sampled at wvs to the resolution of this data object.
+        The operators are cached for each location and wavelength sampling, so that broadening a new spectrum is a
+        single sparse matrix product (see broaden_spectra()). Call clear_lsf_operators() if the resolution changes.
+
+        Parameters
+        ----------
+        wvs : ndarray
+            Wavelength sampling of the spectra to be broadened.
+        loc : None
+            Location (e.g. fiber index) of the resolution calibration, see lsf_resolution().
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix (see breads.utils.broaden_operator()), or None if it would have more than
+        breads.utils.broaden_max_nnz elements (e.g. high resolution model and constant resolution).
+        """
+        wvs = np.asarray(wvs, dtype=float)
+        if getattr(self, "_lsf_operators", None) is None:
+            self._lsf_operators = utils.LRUCache(maxsize=self.lsf_cache_size)
+        key = (loc if np.ndim(loc) == 0 else tuple(np.ravel(loc)), hashlib.sha1(wvs.tobytes()).hexdigest(),
+               np.size(wvs))
+        if key not in self._lsf_operators:
+            R = self.lsf_resolution(wvs, loc=loc)
+            if utils.broaden_operator_nnz(wvs, R) > utils.broaden_max_nnz:
+                self._lsf_operators[key] = None
+            else:
+                self._lsf_operators[key] = utils.broaden_operator(wvs, R, cache=False)
+        return self._lsf_operators.get(key)
+
+    def broaden_spectra(self, wvs, spectra, loc=None):
+        """ Broaden one or many spectra to the resolution of this data object with the cached operator of
+        lsf_operator(). Same result as breads.utils.broaden().
+        If the operator would be too large to be cached, it is built and applied by blocks of rows instead.
+
+        Parameters
+        ----------
+        wvs : ndarray
+            Wavelength sampling of the spectra.
+        spectra : ndarray
+            Spectrum of the same size as wvs, or array of spectra of shape (number of spectra, size of wvs).
+        loc : None
+            Location (e.g. fiber index) of the resolution calibration, see lsf_resolution().
+
+        Returns
+        -------
+        Broadened spectra with the same shape as spectra.
+        """
+        A = self.lsf_operator(wvs, loc=loc)
+        if A is not None:
+            return utils.apply_broaden_operator(A, spectra)
+        # Exact broadening by blocks of rows of the operator, without caching it
+        return utils.broaden(wvs, spectra, self.lsf_resolution(np.asarray(wvs, dtype=float), loc=loc), method="sparse")
+
+    def clear_lsf_operators(self):
+        """ Empty the cache of lsf_operator(). """
+        self._lsf_operators = None
+
+    def __getstate__(self):
+        # The cached operators are rebuilt where needed rather than sent to the worker processes
+        state = self.__dict__.copy()
+        state["_lsf_operators"] = None
+        return state
+
     def remove_bad_pixels(self, chunks=20, mypool=None, med_spec=None, nan_mask_boxsize=3):
         return None
     
\ No newline at end of file
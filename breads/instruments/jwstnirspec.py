@@ -10,11 +10,9 @@ from astropy.coordinates import SkyCoord, EarthLocation
 import astropy.units as u
 from astropy.time import Time
 from copy import copy
-from breads.utils import broaden
 from breads.calibration import SkyCalibration
 import multiprocessing as mp
 from itertools import repeat
-import pandas as pd
 import astropy
 
 #NIRSPEC Wavelengths
@@ -158,13 +156,15 @@ class JWSTNirspec(Instrument):
             spectrum: 1D spectrum to be broadened.
             loc: To be ignored. Could be used in the future to specify (x,y) position if field dependent resolution is
                 available.
-            mypool: Multiprocessing pool to parallelize the code. If None (default), non parallelization is applied.
-                E.g. mppool = mp.Pool(processes=10) # 10 is the number processes
+            mypool: Deprecated and ignored. The spectrum is broadened with the operator cached by lsf_operator().
 
         Return:
             Broadened spectrum
         """
-        return broaden(wvs, spectrum, self.R, mppool=mppool)
+        if mppool is not None:
+            warn("The mppool argument of broaden() is deprecated and ignored, the spectrum is broadened with the "
+                 "operator cached by lsf_operator().", DeprecationWarning)
+        return self.broaden_spectra(wvs, spectrum, loc=None)
 
     def set_noise(self, method="sqrt_cont", num_threads = 16, wid_mov=None):
         nz, ny, nx = self.data.shape
@@ -188,6 +188,4 @@ class JWSTNirspec(Instrument):
 
 def set_continnuum(args):
     data, window = args
-    tmp = np.array(pd.DataFrame(np.concatenate([data, data[::-1]], axis=0)).interpolate(method="linear").fillna(method="bfill").fillna(method="ffill"))
-    myvec_cp_lpf = np.array(pd.DataFrame(tmp).rolling(window=window, center=True).median().interpolate(method="linear").fillna(method="bfill").fillna(method="ffill"))[0:np.size(data), 0]
-    return myvec_cp_lpf
+    return utils.mirrored_running_median(data, window)
@@ -23,7 +23,8 @@ from scipy.stats import median_abs_deviation
 
 import breads.utils as utils
 from breads.instruments.instrument import Instrument
-from breads.utils import broaden, rotate_coordinates, find_closest_leftnright_elements
+from breads.progress import call_timed, make_reporter
+from breads.utils import rotate_coordinates, find_closest_leftnright_elements
 from breads.utils import get_spline_model
 
 
@@ -1740,14 +1741,16 @@ class JWSTNirspec_cal(Instrument):
             To be ignored. Could be used in the future to specify (x,y) position if field dependent resolution is
             available.
         mppool : multiprocessing Pool
-            Multiprocessing pool to parallelize the code. If None (default), no parallelization is applied.
-            E.g. mppool = mp.Pool(processes=10) # 10 is the number processes
+            Deprecated and ignored. The spectrum is broadened with the operator cached by lsf_operator().
 
         Return:
             Broadened spectrum
 
         """
-        return broaden(wvs, spectrum, self.R, mppool=mppool)
+        if mppool is not None:
+            warn("The mppool argument of broaden() is deprecated and ignored, the spectrum is broadened with the "
+                 "operator cached by lsf_operator().", DeprecationWarning)
+        return self.broaden_spectra(wvs, spectrum, loc=None)
 
     def get_regwvs_sampling(self):
         """ Get a regular wavelength sampling
@@ -2799,7 +2802,7 @@ def fitpsf(combdataobj, psfs, psfX, psfY, out_filename=None, IWA=0, OWA=np.inf,
            init_centroid=None, fit_cen=True, fit_angle = False,
            ann_width=None, padding=None, sector_area=None, RDI_folder_suffix=None,
            linear_interp=True, rotate_psf=0.0, flipx=False, psf_spaxel_area=None,
-           debug_init=None,debug_end=None,save_combined_boolean=False):
+           debug_init=None,debug_end=None,save_combined_boolean=False,progress=None):
     """
     Fit a model PSF (psfs, psfX, psfY) to a combined dataset (dataobj_list).
 
@@ -2823,6 +2826,8 @@ def fitpsf(combdataobj, psfs, psfX, psfY, out_filename=None, IWA=0, OWA=np.inf,
         rotate_psf:
         flipx:
         psf_spaxel_area:
+        progress: True or a callback function to report the progress and ETA of the fit instead of printing each
+            wavelength (see breads.progress). Default None.
 
     Returns:
 
@@ -2870,16 +2875,22 @@ def fitpsf(combdataobj, psfs, psfX, psfY, out_filename=None, IWA=0, OWA=np.inf,
 
     wpsf_angle_offset = 0
     bestfit_coords_defined = False
+    N_tasks = np.size(all_interp_ra.T[debug_init:debug_end], axis=0)
+    reporter = make_reporter(progress, N_tasks, label="fitpsf",
+                             numthreads=1 if mppool is None else mppool._processes)
     if 0 or mppool is None:
 
         for wv_id, wv in enumerate(wv_sampling):
             if not (wv_id >= debug_init and wv_id < debug_end):
                 continue
-            print(wv_id, wv, np.size(wv_sampling))
+            if reporter is None:
+                print(wv_id, wv, np.size(wv_sampling))
             paras = linear_interp, psfs[wv_id], psfX[wv_id], psfY[wv_id], rotate_psf - wpsf_angle_offset,flipx, \
                 all_interp_ra[:, wv_id], all_interp_dec[:, wv_id], all_interp_flux[:, wv_id], all_interp_err[:,wv_id], all_interp_badpix[:, wv_id], \
                 IWA, OWA, fit_cen, fit_angle, init_paras, ann_width, padding, sector_area
-            out = _fit_wpsf_task(paras)
+            worker, busy_time, out = call_timed((_fit_wpsf_task, paras))
+            if reporter is not None:
+                reporter.update(worker=worker, busy_time=busy_time)
             if not bestfit_coords_defined:
                 bestfit_coords = np.zeros((out[0].shape[0],np.size(wv_sampling), 5)) + np.nan  # flux_init, flux,ra,dec,angle
                 bestfit_coords_defined=True
@@ -2888,33 +2899,39 @@ def fitpsf(combdataobj, psfs, psfX, psfY, out_filename=None, IWA=0, OWA=np.inf,
             all_interp_psfsub[:, wv_id] = all_interp_flux[:, wv_id] - out[1]
 
     else:
-        output_lists = mppool.map(_fit_wpsf_task,
-                                  zip(itertools.repeat(linear_interp),
-                                      psfs, psfX, psfY,
-                                      itertools.repeat(rotate_psf - wpsf_angle_offset),
-                                      itertools.repeat(flipx),
-                                      all_interp_ra.T[debug_init:debug_end],
-                                      all_interp_dec.T[debug_init:debug_end],
-                                      all_interp_flux.T[debug_init:debug_end],
-                                      all_interp_err.T[debug_init:debug_end],
-                                      all_interp_badpix.T[debug_init:debug_end],
-                                      itertools.repeat(IWA),
-                                      itertools.repeat(OWA),
-                                      itertools.repeat(fit_cen),
-                                      itertools.repeat(fit_angle),
-                                      itertools.repeat(init_paras),
-                                      itertools.repeat(ann_width),
-                                      itertools.repeat(padding),
-                                      itertools.repeat(sector_area)))
-
-        for out_id,out in enumerate(output_lists):
-            print(out_id, len(output_lists))
+        output_lists = mppool.imap(call_timed,
+                                   zip(itertools.repeat(_fit_wpsf_task),
+                                       zip(itertools.repeat(linear_interp),
+                                           psfs, psfX, psfY,
+                                           itertools.repeat(rotate_psf - wpsf_angle_offset),
+                                           itertools.repeat(flipx),
+                                           all_interp_ra.T[debug_init:debug_end],
+                                           all_interp_dec.T[debug_init:debug_end],
+                                           all_interp_flux.T[debug_init:debug_end],
+                                           all_interp_err.T[debug_init:debug_end],
+                                           all_interp_badpix.T[debug_init:debug_end],
+                                           itertools.repeat(IWA),
+                                           itertools.repeat(OWA),
+                                           itertools.repeat(fit_cen),
+                                           itertools.repeat(fit_angle),
+                                           itertools.repeat(init_paras),
+                                           itertools.repeat(ann_width),
+                                           itertools.repeat(padding),
+                                           itertools.repeat(sector_area))))
+
+        for out_id,(worker, busy_time, out) in enumerate(output_lists):
+            if reporter is None:
+                print(out_id, N_tasks)
+            else:
+                reporter.update(worker=worker, busy_time=busy_time)
             if not bestfit_coords_defined:
                 bestfit_coords = np.zeros((out[0].shape[0],np.size(wv_sampling), 5)) + np.nan  # flux_init, flux,ra,dec,angle
                 bestfit_coords_defined=True
             bestfit_coords[:,debug_init+out_id, :] = out[0]
             all_interp_psfmodel[:, debug_init+out_id] = out[1]
             all_interp_psfsub[:, debug_init+out_id] = all_interp_flux[:, debug_init+out_id] - out[1]
+    if reporter is not None:
+        reporter.close()
 
     all_interp_psfsub = all_interp_psfsub*all_interp_area2d/psf_spaxel_area
     all_interp_psfmodel = all_interp_psfmodel*all_interp_area2d/psf_spaxel_area
@@ -3153,7 +3170,7 @@ def _build_cube_task(inputs):
 
 def build_cube(combdataobj,psfs, psfX, psfY, ra_vec, dec_vec, out_filename=None,
                     linear_interp=True, mppool=None, aper_radius=0.5,
-                    debug_init=None,debug_end=None,N_pix_min=None):
+                    debug_init=None,debug_end=None,N_pix_min=None,progress=None):
     if "regwvs" not in combdataobj.coords:
         raise Exception("This data object needs to be interpolated on regular wavelength grid. See dataobj.compute_interpdata_regwvs")
         
@@ -3213,14 +3230,22 @@ def build_cube(combdataobj,psfs, psfX, psfY, ra_vec, dec_vec, out_filename=None,
     print() 
 
     #step 2 map _build_cube_task over input list 
+    # progress: True or a callback function to report the progress and ETA (see breads.progress)
+    reporter = make_reporter(progress, len(inputs), label="build_cube",
+                             numthreads=mppool._processes if parallel_flag else 1)
     if parallel_flag:        
         print('starting parallel _build_cube_task...')
-        outputs = mppool.map(_build_cube_task,inputs)
+        timed_outputs = mppool.imap(call_timed, zip(itertools.repeat(_build_cube_task), inputs))
     else:
         print('starting serial _build_cube_task...')
-        outputs = []
-        for inp in inputs:
-            outputs.append(_build_cube_task(inp))
+        timed_outputs = map(call_timed, zip(itertools.repeat(_build_cube_task), inputs))
+    outputs = []
+    for worker, busy_time, out in timed_outputs:
+        outputs.append(out)
+        if reporter is not None:
+            reporter.update(worker=worker, busy_time=busy_time)
+    if reporter is not None:
+        reporter.close()
     print()
     
     #step 3 iterate over outputs and save values
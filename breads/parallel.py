@@ -0,0 +1,395 @@
+"""
+Helpers for running the forward models in worker processes.
+
+Executor is a process pool whose workers keep the data object and the forward model parameters in memory between
+calls, so that repeated grid searches only send the new parameter grids:
+
+    with Executor(numthreads, dataobj=dataobj, fm_paras=fm_paras) as mypool:
+        out = grid_search(para_vecs, dataobj, fm_func, fm_paras, mypool=mypool)
+        best = grid_search(best_para_vecs, dataobj, fm_func, fm_paras, mypool=mypool)
+
+Within each worker, the BLAS/LAPACK libraries (MKL, OpenBLAS...) should not start more threads than the cores left to
+it, see thread_split() and blas_thread_limit().
+
+SharedArrays publishes the large numpy arrays of a data object (or of the fm_paras dictionary) once in shared memory.
+The published copy of the object pickles these arrays as lightweight handles, which are attached as zero-copy views in
+the worker processes instead of being serialized with every chunk of the grid search:
+
+    with SharedArrays() as shared:
+        shared_dataobj = shared.share(dataobj)
+        shared_fm_paras = shared.share(fm_paras)
+        out = mypool.map(process_chunk, zip(..., itertools.repeat(shared_dataobj), ...))
+"""
+import contextlib
+import copy
+import os
+import types
+import warnings
+import zlib
+from multiprocessing import pool, resource_tracker, shared_memory
+
+import numpy as np
+
+try:
+    import threadpoolctl
+    threadpoolctl_exists = True
+except ImportError:
+    threadpoolctl_exists = False
+try:
+    import mkl
+    mkl_exists = True
+except ImportError:
+    mkl_exists = False
+
+__all__ = ('SharedArrays', 'Executor', 'resolve', 'thread_split', 'blas_thread_limit', 'set_worker_blas_threads')
+
+# Shared memory blocks attached in the current process, by name. They need to stay open as long as the views exist.
+_attached_blocks = {}
+# Process id -> whether the process started its own resource tracker (Python < 3.13)
+_own_tracker = {}
+# Objects installed in a worker process of an Executor, by name
+_worker_objects = {}
+# Process id -> BLAS thread limit set by set_worker_blas_threads()
+_worker_blas_threads = {}
+
+
+def _attach_shared_array(name, shape, dtype):
+    if name not in _attached_blocks:
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13 always registers the block with the resource tracker. If this process started its own
+            # tracker, it would unlink the block (and warn about a leak) when the worker exits, although the block
+            # belongs to the parent process. A tracker inherited from the parent is left alone.
+            pid = os.getpid()
+            if pid not in _own_tracker:
+                _own_tracker[pid] = getattr(resource_tracker._resource_tracker, "_fd", None) is None
+            shm = shared_memory.SharedMemory(name=name)
+            if _own_tracker[pid]:
+                resource_tracker.unregister(shm._name, "shared_memory")
+        _attached_blocks[name] = shm
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=_attached_blocks[name].buf)
+
+
+class _SharedArray(np.ndarray):
+    """
+    Numpy array backed by a shared memory block. It is pickled as a reference to the block, and unpickled as a
+    regular numpy array viewing the block.
+    """
+    def __reduce__(self):
+        name = getattr(self, "_shm_name", None)
+        if name is None:
+            # View or result of an operation on a shared array: the data is not (entirely) in the block
+            return np.array(self).__reduce__()
+        return _attach_shared_array, (name, self.shape, self.dtype.str)
+
+    def __reduce_ex__(self, protocol):
+        return self.__reduce__()
+
+    def __array_finalize__(self, obj):
+        self._shm_name = None
+
+
+class SharedArrays:
+    """
+    Store of shared memory blocks. Use it as a context manager, or call close() once the workers are done, to free
+    the shared memory.
+
+    Args:
+        min_nbytes: Only the arrays larger than min_nbytes bytes are moved to shared memory. Default 64 kB.
+        max_depth: Maximum depth of the search for arrays in nested objects, dictionaries, lists and tuples.
+            For example, dataobj.data has depth 1, and fm_paras["atm_grid"].values has depth 2. Default 3.
+    """
+    def __init__(self, min_nbytes=2 ** 16, max_depth=3):
+        self.min_nbytes = min_nbytes
+        self.max_depth = max_depth
+        self._blocks = []
+        # id of the original array -> (original array, shared array), so that arrays referenced several times are only
+        # copied once
+        self._shared = {}
+
+    def share(self, obj):
+        """
+        Return a shallow copy of obj in which the large numpy arrays have been replaced with shared memory arrays.
+        The original object is not modified. Objects without large arrays are returned as is.
+
+        Args:
+            obj: Data object, dictionary (e.g. fm_paras), list, tuple or numpy array.
+
+        Returns:
+            Copy of obj to be sent to the worker processes.
+        """
+        return self._share(obj, 0, {})
+
+    def _share_array(self, arr):
+        if id(arr) in self._shared:
+            return self._shared[id(arr)][1]
+        shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+        self._blocks.append(shm)
+        shared_arr = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf).view(_SharedArray)
+        shared_arr[...] = arr
+        shared_arr._shm_name = shm.name
+        self._shared[id(arr)] = (arr, shared_arr)
+        return shared_arr
+
+    def _share(self, obj, depth, memo):
+        if isinstance(obj, np.ndarray):
+            if type(obj) is np.ndarray and obj.nbytes >= self.min_nbytes and not obj.dtype.hasobject:
+                return self._share_array(obj)
+            return obj
+        if depth >= self.max_depth or id(obj) in memo:
+            return memo.get(id(obj), obj)
+        memo[id(obj)] = obj
+        if isinstance(obj, dict):
+            items = {key: self._share(val, depth + 1, memo) for key, val in obj.items()}
+            if all(items[key] is obj[key] for key in obj):
+                return obj
+            new_obj = copy.copy(obj)
+            new_obj.update(items)
+        elif isinstance(obj, (list, tuple)):
+            items = [self._share(val, depth + 1, memo) for val in obj]
+            if all(new is old for new, old in zip(items, obj)):
+                return obj
+            if type(obj) in (list, tuple):
+                new_obj = type(obj)(items)
+            else:
+                # Named tuples and other subclasses are left as is
+                return obj
+        elif hasattr(obj, "__dict__") and not isinstance(obj, (type, types.ModuleType, types.FunctionType,
+                                                                 types.MethodType, types.BuiltinFunctionType)):
+            attrs = {key: self._share(val, depth + 1, memo) for key, val in vars(obj).items()}
+            if all(attrs[key] is val for key, val in vars(obj).items()):
+                return obj
+            try:
+                new_obj = copy.copy(obj)
+                vars(new_obj).update(attrs)
+            except Exception:
+                return obj
+        else:
+            return obj
+        memo[id(obj)] = new_obj
+        return new_obj
+
+    def nbytes(self):
+        """ Total size of the shared memory blocks in bytes. """
+        return int(np.sum([shm.size for shm in self._blocks]))
+
+    def close(self):
+        """ Free the shared memory. The shared copies must not be used afterwards. """
+        for shm in self._blocks:
+            shm.unlink()
+            try:
+                shm.close()
+            except BufferError:
+                # Shared arrays still referenced in this process. The memory is released with the last of them.
+                pass
+        self._blocks = []
+        self._shared = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class _WorkerObject:
+    """
+    Reference to an object installed in the worker processes of an Executor. See resolve().
+    After Executor.reinstall(), the reference carries the new (shared memory) copy of the object.
+    """
+    def __init__(self, name, obj=None):
+        self.name = name
+        self.obj = obj
+
+
+def _install_worker_objects(objects):
+    _worker_objects.clear()
+    _worker_objects.update(objects)
+
+
+def resolve(obj):
+    """
+    Return the object installed in the current worker process if obj is a reference created by
+    Executor.reference(), and obj itself otherwise.
+    """
+    if isinstance(obj, _WorkerObject):
+        return _worker_objects[obj.name] if obj.obj is None else obj.obj
+    return obj
+
+
+def _fingerprint(obj, depth=0):
+    """
+    Cheap fingerprint of the content of a data object or of a dictionary (e.g. fm_paras) to detect modifications: the
+    identity of each attribute (or item), and the checksum of the numpy arrays, which are often modified in place
+    (e.g. dataobj.bad_pixels). The dictionaries, lists, tuples and objects found in the attributes are fingerprinted
+    the same way one level down (e.g. fm_paras["atm_grid"].values); deeper containers are only compared by identity.
+    It costs one checksum pass over the arrays (a fraction of a copy of the arrays) per call.
+    """
+    if isinstance(obj, dict):
+        items = obj.items()
+    elif isinstance(obj, (list, tuple)):
+        items = enumerate(obj)
+    elif hasattr(obj, "__dict__") and not isinstance(obj, (type, types.ModuleType, types.FunctionType,
+                                                             types.MethodType, types.BuiltinFunctionType)):
+        items = vars(obj).items()
+    else:
+        items = [(None, obj)]
+    fingerprint = []
+    for key, val in items:
+        if isinstance(val, np.ndarray) and not val.dtype.hasobject:
+            fingerprint.append((key, val.shape, val.dtype.str, zlib.adler32(np.ascontiguousarray(val).data)))
+        elif depth < 1 and not isinstance(val, np.ndarray) and (isinstance(val, (dict, list, tuple)) or
+                                                                hasattr(val, "__dict__")):
+            fingerprint.append((key, id(val), _fingerprint(val, depth + 1)))
+        else:
+            fingerprint.append((key, id(val)))
+    return fingerprint
+
+
+class Executor(pool.Pool):
+    """
+    Persistent process pool for grid_search() and the other functions accepting a mypool argument.
+    The data object and the forward model parameters are installed once in each worker when the pool starts.
+    grid_search() then only sends a small reference to them instead of the objects themselves, as long as it is called
+    with the same objects (checked by identity). The large arrays are shared between the workers through shared memory
+    (see SharedArrays).
+
+    The workers hold a copy of the objects as they were when they were installed. If an installed object is modified
+    afterwards (e.g. dataobj.set_noise() or new bad pixels), reference() detects it with a fingerprint of its
+    attributes and arrays (down to the arrays held by its attributes, e.g. fm_paras["atm_grid"].values), and returns the object itself with a warning so that the modified object is sent with every
+    task. Call reinstall() after modifying the objects to share them again instead:
+
+        dataobj.bad_pixels[...] = np.nan
+        mypool.reinstall(dataobj=dataobj)
+
+    Use it as a context manager, or call close() and join() when done.
+
+    Args:
+        numthreads: Number of worker processes. Default os.cpu_count().
+        dataobj: Data object to be installed in the workers. Optional.
+        fm_paras: Forward model parameters to be installed in the workers. Optional.
+        shared_memory: If True (default), move the large arrays of dataobj and fm_paras to shared memory.
+    """
+    def __init__(self, numthreads=None, dataobj=None, fm_paras=None, shared_memory=True):
+        self._shared = SharedArrays()
+        self._shared_memory = shared_memory
+        self._reinstalled = []
+        # name -> (installed object, fingerprint, copy sent with the references or None if installed at startup)
+        self._installed = {}
+        worker_objects = {}
+        for name, obj in [("dataobj", dataobj), ("fm_paras", fm_paras)]:
+            if obj is None:
+                continue
+            self._installed[name] = (obj, _fingerprint(obj), None)
+            worker_objects[name] = self._shared.share(obj) if shared_memory else obj
+        super().__init__(processes=numthreads, initializer=_install_worker_objects, initargs=(worker_objects,))
+
+    def reinstall(self, dataobj=None, fm_paras=None):
+        """
+        Install new or modified objects in the workers. The references then carry the new copies, which only consist
+        of shared memory handles and the small attributes of the objects if shared_memory is True.
+
+        Args:
+            dataobj: Data object to be installed in the workers. The current one is kept if None.
+            fm_paras: Forward model parameters to be installed in the workers. The current ones are kept if None.
+        """
+        for name, obj in [("dataobj", dataobj), ("fm_paras", fm_paras)]:
+            if obj is None:
+                continue
+            worker_obj = obj
+            if self._shared_memory:
+                # New store, the arrays modified in place would otherwise map to their previous copy. The previous
+                # copies might still be used by running tasks, they are freed by join().
+                shared = SharedArrays()
+                self._reinstalled.append(shared)
+                worker_obj = shared.share(obj)
+            self._installed[name] = (obj, _fingerprint(obj), worker_obj)
+
+    def reference(self, obj):
+        """ Return a reference to obj if it is installed in the workers, or obj itself otherwise. """
+        for name, (installed_obj, fingerprint, worker_obj) in self._installed.items():
+            if obj is installed_obj:
+                if _fingerprint(obj) != fingerprint:
+                    warnings.warn("{0} was modified since it was installed in the Executor, it is sent with every "
+                                  "task. Call reinstall() after modifying it.".format(name))
+                    return obj
+                return _WorkerObject(name, worker_obj)
+        return obj
+
+    def join(self):
+        super().join()
+        self._shared.close()
+        for shared in self._reinstalled:
+            shared.close()
+
+    def __exit__(self, *exc):
+        self.close()
+        self.join()
+        return False
+
+
+def _available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def thread_split(numthreads=None, n_cores=None):
+    """
+    Split the cores between parallel workers and the BLAS threads of each worker.
+    The linear models of a grid search are small, so that it is more efficient to use all the cores as workers
+    running single threaded BLAS than the other way around. If the number of workers is fixed, the remaining cores are
+    shared between their BLAS threads.
+
+    Args:
+        numthreads: Number of workers. Default (None or "auto"), one per core.
+        n_cores: Number of cores available. Default, the cores available to the current process.
+
+    Returns:
+        numthreads, blas_threads
+    """
+    if n_cores is None:
+        n_cores = _available_cores()
+    if numthreads is None or numthreads == "auto":
+        return n_cores, 1
+    return numthreads, max(1, n_cores // numthreads)
+
+
+@contextlib.contextmanager
+def blas_thread_limit(blas_threads):
+    """
+    Context manager limiting the number of threads of the BLAS/LAPACK libraries of the current process.
+    Requires threadpoolctl (or mkl for MKL only). Does nothing if blas_threads is None or neither is installed.
+    """
+    if blas_threads is None:
+        yield
+    elif threadpoolctl_exists:
+        with threadpoolctl.threadpool_limits(limits=blas_threads, user_api="blas"):
+            yield
+    elif mkl_exists:
+        previous = mkl.get_max_threads()
+        mkl.set_num_threads(blas_threads)
+        try:
+            yield
+        finally:
+            mkl.set_num_threads(previous)
+    else:
+        yield
+
+
+def set_worker_blas_threads(blas_threads):
+    """
+    Limit the number of BLAS/LAPACK threads of the current worker process for its lifetime (see blas_thread_limit()).
+    Only the first call with a given value has an effect, so that it can be called before each task.
+    """
+    pid = os.getpid()
+    if blas_threads is None or _worker_blas_threads.get(pid) == blas_threads:
+        return
+    _worker_blas_threads[pid] = blas_threads
+    if threadpoolctl_exists:
+        threadpoolctl.threadpool_limits(limits=blas_threads, user_api="blas")
+    elif mkl_exists:
+        mkl.set_num_threads(blas_threads)
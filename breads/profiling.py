@@ -0,0 +1,192 @@
+"""
+Opt-in timing and counters for fitfm() and grid_search().
+
+Usage:
+    import breads.profiling as profiling
+    profiling.enable()
+    out = grid_search(...)
+    print(profiling.report())
+    profiling.report().to_json("profile.json")
+
+When profiling is disabled (default), the instrumentation only costs a function call per stage.
+"""
+import json
+import time
+
+__all__ = ('enable', 'disable', 'is_enabled', 'reset', 'stage', 'timer', 'add_time', 'record_shape', 'count',
+           'snapshot', 'merge', 'report', 'ProfilingReport')
+
+_enabled = False
+# stage name -> [number of calls, total wall time in seconds]
+_stages = {}
+# (Nd, Np) -> number of calls
+_shapes = {}
+# counter name -> value
+_counters = {}
+
+
+def enable():
+    """ Start collecting timings and counters. """
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """ Stop collecting timings and counters. The collected data is kept until reset() is called. """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """ Discard all the collected timings and counters. """
+    _stages.clear()
+    _shapes.clear()
+    _counters.clear()
+
+
+def add_time(name, elapsed, calls=1):
+    """ Add elapsed wall time (in seconds) to a stage. """
+    if name in _stages:
+        _stages[name][0] += calls
+        _stages[name][1] += elapsed
+    else:
+        _stages[name] = [calls, elapsed]
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add_time(self.name, time.perf_counter() - self.t0)
+        return False
+
+
+class _Timer:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.t0 = time.perf_counter()
+
+    def lap(self, name):
+        t = time.perf_counter()
+        add_time(self.prefix + "." + name, t - self.t0)
+        self.t0 = t
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def lap(self, name):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name):
+    """
+    Context manager timing a block of code as the stage name.
+
+        with profiling.stage("grid_search.map"):
+            ...
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def timer(prefix):
+    """
+    Timer for consecutive stages of a function. Each call to lap(name) records the time elapsed since the previous lap
+    (or the creation of the timer) as the stage prefix.name.
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Timer(prefix)
+
+
+def record_shape(Nd, Np):
+    """ Count the fits with Nd data points and Np linear parameters. """
+    if _enabled:
+        key = (int(Nd), int(Np))
+        _shapes[key] = _shapes.get(key, 0) + 1
+
+
+def count(name, value=1):
+    """ Increment the counter name by value. """
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def snapshot():
+    """ Picklable copy of the collected data, e.g. to send it back from a worker process. See merge(). """
+    return {"stages": {name: list(val) for name, val in _stages.items()},
+            "shapes": dict(_shapes),
+            "counters": dict(_counters)}
+
+
+def merge(other):
+    """ Add the data of a snapshot() (e.g. from a worker process) to the current process. """
+    for name, (calls, elapsed) in other["stages"].items():
+        add_time(name, elapsed, calls=calls)
+    for key, calls in other["shapes"].items():
+        _shapes[key] = _shapes.get(key, 0) + calls
+    for name, value in other["counters"].items():
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def report():
+    """ Aggregated report of the data collected so far as a ProfilingReport. """
+    return ProfilingReport(snapshot())
+
+
+class ProfilingReport:
+    """
+    Aggregated timings and counters.
+
+    Attributes:
+        stages: Dictionary stage name -> {"calls", "total_time", "mean_time"}. Times are wall times in seconds summed
+            over all processes.
+        shapes: List of {"Nd", "Np", "calls"} for the linear models fitted.
+        counters: Dictionary counter name -> value.
+    """
+    def __init__(self, data):
+        self.stages = {name: {"calls": calls, "total_time": elapsed, "mean_time": elapsed / calls if calls else 0.0}
+                       for name, (calls, elapsed) in sorted(data["stages"].items())}
+        self.shapes = [{"Nd": Nd, "Np": Np, "calls": calls} for (Nd, Np), calls in sorted(data["shapes"].items())]
+        self.counters = dict(sorted(data["counters"].items()))
+
+    def to_dict(self):
+        return {"stages": self.stages, "shapes": self.shapes, "counters": self.counters}
+
+    def to_json(self, filename=None, indent=2):
+        """ Return the report as a JSON string, and also save it to filename if not None. """
+        out = json.dumps(self.to_dict(), indent=indent)
+        if filename is not None:
+            with open(filename, "w") as f:
+                f.write(out)
+        return out
+
+    def __str__(self):
+        lines = ["{0:40s} {1:>10s} {2:>12s} {3:>12s}".format("stage", "calls", "total (s)", "mean (s)")]
+        for name, val in self.stages.items():
+            lines.append("{0:40s} {1:10d} {2:12.4f} {3:12.6f}".format(name, val["calls"], val["total_time"],
+                                                                     val["mean_time"]))
+        for name, value in self.counters.items():
+            lines.append("{0:40s} {1}".format(name, value))
+        if len(self.shapes) != 0:
+            lines.append("(Nd,Np): " + ", ".join(["({0},{1})x{2}".format(s["Nd"], s["Np"], s["calls"])
+                                                  for s in self.shapes]))
+        return "\n".join(lines)
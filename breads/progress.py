@@ -0,0 +1,146 @@
+"""
+Progress, throughput and ETA reporting for long running loops (grid_search(), fitpsf(), build_cube()).
+
+Usage:
+    out = grid_search(..., progress=True)  # prints a status line at most every few seconds
+
+    def my_callback(telemetry):
+        logger.info("{done}/{total} points, {rate:.1f} points/s".format(**telemetry))
+    out = grid_search(..., progress=my_callback)
+
+The callback receives a dictionary with the keys:
+    label: Name of the loop.
+    done, total: Number of points completed and total number of points.
+    tasks_done, tasks_total: Number of tasks (chunks) completed and total number of tasks.
+    elapsed: Wall time in seconds since the start.
+    rate: Points per second.
+    eta: Estimated remaining time in seconds (None until the first task is done).
+    utilisation: Dictionary worker process id -> fraction of the elapsed time the worker spent on the tasks.
+    mean_utilisation: Sum of the busy times divided by (elapsed time x number of workers).
+    final: True for the last report.
+
+The reports are throttled (see min_interval in ProgressReporter), so that updating the reporter after every task is
+cheap.
+"""
+import os
+import sys
+import time
+
+__all__ = ('ProgressReporter', 'make_reporter', 'print_progress', 'format_progress', 'call_timed')
+
+
+def format_progress(telemetry):
+    """ One line summary of a telemetry dictionary. """
+    line = "{0}: {1}/{2} ({3:.1f}%) {4:.1f} points/s".format(telemetry["label"], telemetry["done"],
+                                                           telemetry["total"],
+                                                           100 * telemetry["done"] / max(telemetry["total"], 1),
+                                                           telemetry["rate"])
+    if len(telemetry["utilisation"]) != 0:
+        line += " workers {0}x{1:.0f}%".format(len(telemetry["utilisation"]), 100 * telemetry["mean_utilisation"])
+    if telemetry["final"]:
+        line += " done in {0:.1f}s".format(telemetry["elapsed"])
+    elif telemetry["eta"] is not None:
+        line += " ETA {0:.0f}s".format(telemetry["eta"])
+    return line
+
+
+def print_progress(telemetry):
+    """ Default callback: overwrite a single status line on stdout. """
+    sys.stdout.write("\r" + format_progress(telemetry) + ("\n" if telemetry["final"] else ""))
+    sys.stdout.flush()
+
+
+class ProgressReporter:
+    """
+    Accumulate the completed tasks of a loop and call callback(telemetry) at most every min_interval seconds.
+    See the module docstring for the content of telemetry.
+
+    Args:
+        total: Total number of points.
+        total_tasks: Total number of tasks. Default total (one point per task).
+        callback: Function called with the telemetry dictionary. Default print_progress().
+        min_interval: Minimum time in seconds between two reports. Default 2.
+        label: Name of the loop in the reports.
+        numthreads: Number of worker processes, used for mean_utilisation. Default 1.
+    """
+    def __init__(self, total, total_tasks=None, callback=None, min_interval=2.0, label="progress", numthreads=1):
+        self.total = int(total)
+        self.total_tasks = self.total if total_tasks is None else int(total_tasks)
+        self.callback = print_progress if callback is None else callback
+        self.min_interval = min_interval
+        self.label = label
+        self.numthreads = 1 if numthreads is None else numthreads
+        self.done = 0
+        self.tasks_done = 0
+        # worker process id -> busy time in seconds
+        self.busy = {}
+        self.t0 = time.perf_counter()
+        self._last_report = self.t0
+
+    def update(self, points=1, worker=None, busy_time=None, tasks=1):
+        """
+        Record completed tasks.
+
+        Args:
+            points: Number of points completed.
+            worker: Id of the process that computed them (e.g. its pid). Default, the current process.
+            busy_time: Time in seconds spent by the worker on these tasks. Optional, used for the utilisation.
+            tasks: Number of tasks completed.
+        """
+        self.done += points
+        self.tasks_done += tasks
+        if busy_time is not None:
+            worker = os.getpid() if worker is None else worker
+            self.busy[worker] = self.busy.get(worker, 0.0) + busy_time
+        now = time.perf_counter()
+        if now - self._last_report >= self.min_interval:
+            self._last_report = now
+            self.callback(self.telemetry(now))
+
+    def telemetry(self, now=None, final=False):
+        """ Current state of the loop as a dictionary (see the module docstring). """
+        now = time.perf_counter() if now is None else now
+        elapsed = now - self.t0
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else None
+        utilisation = {worker: busy / elapsed if elapsed > 0 else 0.0 for worker, busy in self.busy.items()}
+        numthreads = max(self.numthreads, len(self.busy), 1)
+        mean_utilisation = sum(self.busy.values()) / (elapsed * numthreads) if elapsed > 0 else 0.0
+        return {"label": self.label, "done": self.done, "total": self.total, "tasks_done": self.tasks_done,
+                "tasks_total": self.total_tasks, "elapsed": elapsed, "rate": rate, "eta": eta,
+                "utilisation": utilisation, "mean_utilisation": mean_utilisation, "final": final}
+
+    def close(self):
+        """ Send the final report. """
+        self.callback(self.telemetry(final=True))
+
+
+def make_reporter(progress, total, total_tasks=None, label="progress", numthreads=1):
+    """
+    Build the reporter for the progress argument of grid_search(), fitpsf() and build_cube().
+
+    Args:
+        progress: None or False (no reporting), True (print_progress()), a callback function, or a ProgressReporter
+            (returned as is).
+        total, total_tasks, label, numthreads: See ProgressReporter.
+
+    Returns:
+        A ProgressReporter, or None.
+    """
+    if progress is None or progress is False:
+        return None
+    if isinstance(progress, ProgressReporter):
+        return progress
+    return ProgressReporter(total, total_tasks=total_tasks, callback=None if progress is True else progress,
+                            label=label, numthreads=numthreads)
+
+
+def call_timed(args):
+    """
+    Call func(task) for args = (func, task) and return (pid, busy time in seconds, output).
+    Use it with pool.imap() to report the utilisation of the workers.
+    """
+    func, task = args
+    t0 = time.perf_counter()
+    out = func(task)
+    return os.getpid(), time.perf_counter() - t0, out
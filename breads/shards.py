@@ -0,0 +1,70 @@
+"""
+Sharding of breads.grid_search.grid_search() into independent jobs, e.g. on the nodes of a cluster. Each job evaluates
+one shard of the grid and saves it in a file, and the shards are then reassembled with merge_shards():
+
+    # Job k out of 8
+    grid_search(para_vecs, dataobj, fm_func, fm_paras, num_shards=8, shard_index=k, shard_file="shard{0}.npz".format(k))
+    # Once all the jobs are done
+    log_prob, log_prob_H0, rchi2, linparas, linparas_err = merge_shards(["shard{0}.npz".format(k) for k in range(8)])
+"""
+import json
+
+import numpy as np
+
+from breads.fit import STATUS_NOT_COMPUTED
+from breads.storage import _MAX_ERRORS, _failure_report, _para_vecs_key, _split_output, _store_outputs
+
+__all__ = ('merge_shards',)
+
+
+def _save_shard(shard_file, num_shards, shard_index, indices, out, status, errors, para_vecs):
+    """ Save the outputs of a shard of grid_search(), with the definition of the grid, to be read by merge_shards(). """
+    shard = {"num_shards": num_shards, "shard_index": shard_index, "indices": indices, "out": out,
+             "status": status, "errors": json.dumps(errors), "para_vecs_key": _para_vecs_key(para_vecs),
+             "N_para_vecs": len(para_vecs)}
+    for k, v in enumerate(para_vecs):
+        shard["para_vec{0}".format(k)] = np.asarray(v)
+    np.savez(shard_file, **shard)
+
+
+def merge_shards(paths, return_status=False):
+    """
+    Reassemble the outputs of a grid_search() split in shards (see num_shards in grid_search()).
+
+    Args:
+        paths: List of the shard files (shard_file in grid_search()), in any order.
+        return_status: If True, also return the status codes and the failure summary (see grid_search()).
+
+    Returns:
+        log_prob, log_prob_H0, rchi2, linparas, linparas_err on the full grid, as in grid_search().
+        The grid itself can be read from any of the shard files (para_vec0, para_vec1, ...).
+    """
+    out = None
+    errors = []
+    shard_indices = []
+    for path in paths:
+        with np.load(path) as shard:
+            if out is None:
+                num_shards = int(shard["num_shards"])
+                para_vecs_key = str(shard["para_vecs_key"])
+                grid_shape = [np.size(shard["para_vec{0}".format(k)]) for k in range(int(shard["N_para_vecs"]))]
+                covered = np.zeros(int(np.prod(grid_shape)), dtype=int)
+                status = np.zeros(int(np.prod(grid_shape)), dtype=np.int8) + STATUS_NOT_COMPUTED
+            if int(shard["num_shards"]) != num_shards or str(shard["para_vecs_key"]) != para_vecs_key:
+                raise ValueError("{0} is not a shard of the same grid search.".format(path))
+            shard_indices.append(int(shard["shard_index"]))
+            covered[shard["indices"]] += 1
+            out = _store_outputs(out, shard["indices"], shard["out"], grid_shape)
+            status[shard["indices"]] = shard["status"]
+            errors.extend(json.loads(str(shard["errors"]))[0:_MAX_ERRORS-len(errors)])
+    if out is None:
+        raise ValueError("No shard to merge.")
+    missing = sorted(set(range(num_shards)) - set(shard_indices))
+    if len(missing) != 0:
+        raise ValueError("Missing shards {0} out of {1}.".format(missing, num_shards))
+    if np.any(covered != 1):
+        raise ValueError("The shards do not cover the grid exactly once (duplicated shard files?).")
+    if return_status:
+        status = np.reshape(status, grid_shape)
+        return _split_output(out) + (status, _failure_report(status, errors))
+    return _split_output(out)
@@ -0,0 +1,191 @@
+"""
+Outputs of breads.grid_search.grid_search(): assembly of the outputs of the chunks in a single array, and on-disk
+store of a search saved with out_path, which can be resumed or read while the search is still running:
+
+    out = grid_search(para_vecs, dataobj, fm_func, fm_paras, numthreads=16, out_path="search/")
+    # In another process, or after an interruption
+    log_prob = load_grid_search("search/")[0]
+    done = load_grid_search_done("search/")
+    out = grid_search(para_vecs, dataobj, fm_func, fm_paras, numthreads=16, out_path="search/", resume=True)
+
+The directory contains the metadata (grid_search.json), the completion bitmap (done.npy), the status codes
+(status.npy) and the outputs as an array of shape grid_shape + (3+2*N_linpara,) (out_<3+2*N_linpara>.npy).
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from breads.fit import STATUS_NAMES, STATUS_NOT_COMPUTED
+
+__all__ = ('load_grid_search', 'load_grid_search_done', 'load_grid_search_status')
+
+# Maximum number of errors (with their traceback) kept per chunk, see return_status in grid_search()
+_MAX_ERRORS = 10
+
+
+def _failure_report(status, errors):
+    """ Summary of the status codes of a search, see return_status in grid_search(). """
+    codes, counts = np.unique(status, return_counts=True)
+    return {"counts": {STATUS_NAMES[int(code)]: int(count) for code, count in zip(codes, counts)},
+            "errors": list(errors)}
+
+
+def _split_output(out):
+    N_linpara = int((out.shape[-1]-3)/2)
+    out = np.moveaxis(out, -1, 0)
+    log_prob = out[0]
+    log_prob_H0 = out[1]
+    rchi2 = out[2]
+    linparas = np.moveaxis(out[3:3+N_linpara], 0, -1)
+    linparas_err = np.moveaxis(out[3+N_linpara:3+2*N_linpara], 0, -1)
+
+    return log_prob,log_prob_H0,rchi2,linparas,linparas_err
+
+
+def _store_outputs(out, indices, output_list, grid_shape, new_array=np.zeros):
+    """
+    Copy the outputs of a chunk of grid_search() into out (shape grid_shape + (3+2*N_linpara,)) at the flat indices.
+    out is created with new_array(shape) if None, and replaced with a larger array if the chunk has more linear
+    parameters than out. Returns out.
+    """
+    if np.size(indices) == 0:
+        return out
+    output_list = np.asarray(output_list)
+    new_N_linpara = int((output_list.shape[-1]-3)/2)
+    if out is None:
+        out = new_array(list(grid_shape)+[output_list.shape[-1],])
+    old_N_linpara = int((out.shape[-1]-3)/2)
+    if new_N_linpara > old_N_linpara:
+        # If we made the out array too small, then make it bigger
+        new_out = new_array(list(grid_shape)+[output_list.shape[-1],])
+        new_out[..., 0:3+old_N_linpara] = out[..., 0:3+old_N_linpara]
+        new_out[..., 3+new_N_linpara:3+new_N_linpara+old_N_linpara] = out[..., 3+old_N_linpara::]
+        out = new_out
+        old_N_linpara = new_N_linpara
+    # Scatter the whole chunk at once. If the out array has more parameters than the chunk, the extra ones are left
+    # untouched.
+    grid_indices = np.unravel_index(indices, grid_shape)
+    out[grid_indices + (slice(0, 3+new_N_linpara),)] = output_list[:, 0:3+new_N_linpara]
+    out[grid_indices + (slice(3+old_N_linpara, 3+old_N_linpara+new_N_linpara),)] = output_list[:, 3+new_N_linpara::]
+    return out
+
+
+def _para_vecs_key(para_vecs):
+    sha = hashlib.sha1()
+    for v in para_vecs:
+        v = np.asarray(v, dtype=float)
+        sha.update(np.array(v.shape).tobytes())
+        sha.update(np.ascontiguousarray(v).tobytes())
+    return sha.hexdigest()
+
+
+def _write_store_metadata(out_path, meta):
+    # Write then rename so that the metadata is never left half written
+    filename = os.path.join(out_path, "grid_search.json")
+    with open(filename + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(filename + ".tmp", filename)
+
+
+def _open_output_store(out_path, para_vecs, resume):
+    """
+    Open (resume=True) or create the on-disk output of grid_search() in the directory out_path.
+    Returns the metadata dictionary, the completion bitmap (boolean memmap with the shape of the grid), the output
+    memmap (None if nothing has been saved yet) and the status codes (int8 memmap with the shape of the grid).
+    """
+    grid_shape = [np.size(v) for v in para_vecs]
+    meta_filename = os.path.join(out_path, "grid_search.json")
+    if resume and os.path.exists(meta_filename):
+        with open(meta_filename) as f:
+            meta = json.load(f)
+        if meta["para_vecs_key"] != _para_vecs_key(para_vecs):
+            raise ValueError("{0} was created for a different grid (para_vecs), it cannot be resumed.".format(out_path))
+        done = np.load(os.path.join(out_path, "done.npy"), mmap_mode="r+")
+        out = None
+        if meta["out_file"] is not None:
+            out = np.load(os.path.join(out_path, meta["out_file"]), mmap_mode="r+")
+        return meta, done, out, _open_status_file(out_path, grid_shape)
+
+    os.makedirs(out_path, exist_ok=True)
+    if os.path.exists(meta_filename):
+        # Previous search in the same directory
+        with open(meta_filename) as f:
+            old_meta = json.load(f)
+        os.remove(meta_filename)
+        if old_meta["out_file"] is not None and os.path.exists(os.path.join(out_path, old_meta["out_file"])):
+            os.remove(os.path.join(out_path, old_meta["out_file"]))
+    done = np.lib.format.open_memmap(os.path.join(out_path, "done.npy"), mode="w+", dtype=bool,
+                                     shape=tuple(grid_shape))
+    if os.path.exists(os.path.join(out_path, "status.npy")):
+        os.remove(os.path.join(out_path, "status.npy"))
+    meta = {"grid_shape": grid_shape, "para_vecs_key": _para_vecs_key(para_vecs), "out_file": None}
+    _write_store_metadata(out_path, meta)
+    return meta, done, None, _open_status_file(out_path, grid_shape)
+
+
+def _open_status_file(out_path, grid_shape):
+    filename = os.path.join(out_path, "status.npy")
+    if os.path.exists(filename):
+        return np.load(filename, mmap_mode="r+")
+    status = np.lib.format.open_memmap(filename, mode="w+", dtype=np.int8, shape=tuple(grid_shape))
+    status[...] = STATUS_NOT_COMPUTED
+    status.flush()
+    return status
+
+
+def _new_output_file(out_path, shape):
+    # The name depends on the number of linear parameters so that the output can be enlarged without overwriting the
+    # current file.
+    filename = os.path.join(out_path, "out_{0}.npy".format(shape[-1]))
+    out = np.lib.format.open_memmap(filename, mode="w+", dtype=np.float64, shape=tuple(shape))
+    # The points not computed yet must not be mistaken for results, see load_grid_search()
+    out[...] = np.nan
+    return out
+
+
+def _checkpoint_output_store(out_path, meta, done, out, indices, status):
+    """ Flush the output of a chunk to disk, and then mark its points as done in the completion bitmap. """
+    status.flush()
+    if out is not None:
+        out.flush()
+        out_file = os.path.basename(out.filename)
+        if out_file != meta["out_file"]:
+            old_out_file = meta["out_file"]
+            meta["out_file"] = out_file
+            _write_store_metadata(out_path, meta)
+            if old_out_file is not None:
+                os.remove(os.path.join(out_path, old_out_file))
+    np.reshape(done, (np.size(done),))[indices] = True
+    done.flush()
+
+
+def load_grid_search(out_path, mmap_mode="r"):
+    """
+    Read the output of grid_search() saved in out_path (see out_path in grid_search()) without loading it in memory.
+    The points not computed yet (see load_grid_search_done()) are set to nan.
+
+    Args:
+        out_path: Directory defined as out_path in grid_search().
+        mmap_mode: Memory map mode, see numpy.load(). Default read only.
+
+    Returns:
+        log_prob, log_prob_H0, rchi2, linparas, linparas_err as in grid_search(), as memory mapped arrays.
+    """
+    with open(os.path.join(out_path, "grid_search.json")) as f:
+        meta = json.load(f)
+    if meta["out_file"] is None:
+        raise ValueError("No output saved in {0} yet.".format(out_path))
+    out = np.load(os.path.join(out_path, meta["out_file"]), mmap_mode=mmap_mode)
+    return _split_output(out)
+
+
+def load_grid_search_done(out_path):
+    """ Completion bitmap of a grid_search() saved in out_path: boolean array with the shape of the grid. """
+    return np.load(os.path.join(out_path, "done.npy"))
+
+
+def load_grid_search_status(out_path):
+    """ Status codes of a grid_search() saved in out_path, see return_status in grid_search(). """
+    return np.load(os.path.join(out_path, "status.npy"))
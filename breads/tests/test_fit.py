@@ -0,0 +1,253 @@
+import gc
+import pickle
+from types import SimpleNamespace
+
+import numpy as np
+import scipy.sparse
+
+import breads.fit
+from breads import profiling
+from breads.fit import (STATUS_EMPTY_DATA, STATUS_OK, STATUS_SINGULAR, LogProbCache, _bordered_factorization, fitfm,
+                        fitfm_batch, log_prob, nlog_prob)
+from breads.utils import LRUCache
+
+
+def _linear_fm(nonlin_paras, dataobj, N_poly=10, split_planet=False, dtype=np.float64):
+    """Toy forward model: a sinusoidal "planet" on top of a Chebyshev continuum."""
+    x = dataobj["x"]
+    cheb = np.polynomial.chebyshev.chebvander(2 * x - 1, N_poly - 1).astype(dtype)
+    planet = np.sin(40 * x + nonlin_paras[0]).astype(dtype)
+    d, s = dataobj["d"].astype(dtype), dataobj["s"].astype(dtype)
+    if split_planet:
+        return d, cheb, planet, s
+    return d, np.concatenate([planet[:, None], cheb], axis=1), s
+
+
+def _toy_dataobj(N_poly=10, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, 500)
+    dataobj = {"x": x, "d": np.zeros(x.shape), "s": np.zeros(x.shape) + 0.1}
+    M = _linear_fm([0.3], dataobj, N_poly=N_poly)[1]
+    dataobj["d"] = np.dot(M, rng.normal(size=M.shape[1])) + rng.normal(size=x.size) * 0.1
+    return dataobj
+
+
+def test_fitfm_closed_form_matches_lsq_linear():
+    dataobj = _toy_dataobj()
+    N_linpara = 11
+    no_bounds = ([-np.inf] * N_linpara, [np.inf] * N_linpara)
+    for kwargs in [{}, {"scale_noise": False}, {"marginalize_noise_scaling": True}]:
+        closed_form = fitfm([0.3], dataobj, _linear_fm, {}, computeH0=True, **kwargs)
+        reference = fitfm([0.3], dataobj, _linear_fm, {}, computeH0=True, bounds=no_bounds, **kwargs)
+        for out, ref in zip(closed_form, reference):
+            assert np.allclose(out, ref, rtol=1e-9, atol=0)
+
+
+def test_fitfm_H0_from_H1_factorization():
+    dataobj = _toy_dataobj(seed=2)
+    N_linpara = 11
+    no_bounds = ([-np.inf] * N_linpara, [np.inf] * N_linpara)
+    res_H0, ref_res_H0 = np.zeros(500), np.zeros(500)
+    log_prob, log_prob_H0 = fitfm([0.3], dataobj, _linear_fm, {}, computeH0=True, residuals_H0=res_H0)[0:2]
+    ref_log_prob, ref_log_prob_H0 = fitfm([0.3], dataobj, _linear_fm, {}, computeH0=True, bounds=no_bounds,
+                                          residuals_H0=ref_res_H0)[0:2]
+    assert np.isclose(log_prob - log_prob_H0, ref_log_prob - ref_log_prob_H0, rtol=1e-9)
+    assert np.allclose(res_H0, ref_res_H0, rtol=1e-9, atol=1e-12)
+
+
+def test_fitfm_ill_conditioned():
+    # Monomials are very poorly conditioned. Compare the uncertainties to an SVD based reference.
+    x = np.linspace(0, 1, 500)
+    M = np.concatenate([np.sin(40 * x)[:, None], x[:, None] ** np.arange(12)[None, :]], axis=1)
+    d = np.dot(M, np.ones(M.shape[1])) + np.random.default_rng(1).normal(size=x.size)
+
+    def fm(nonlin_paras, dataobj):
+        return d, M, np.ones(x.size)
+
+    _, _, rchi2, linparas, linparas_err = fitfm([0], None, fm, {}, computeH0=False, scale_noise=False)
+    U, S, Vt = np.linalg.svd(M, full_matrices=False)
+    assert np.allclose(linparas_err, np.sqrt(np.sum((Vt.T / S) ** 2, axis=1)), rtol=1e-6)
+    assert np.allclose(linparas, np.dot(Vt.T, np.dot(U.T, d) / S), rtol=1e-6, atol=1e-6)
+
+
+def test_fitfm_batch_matches_fitfm():
+    dataobj = _toy_dataobj(seed=3)
+    nonlin_paras_array = np.linspace(-1, 1, 11)[:, None]
+
+    def fm(nonlin_paras, dataobj):
+        d, M, s = _linear_fm(nonlin_paras, dataobj)
+        # Mask part of the data and an entire column for some of the elements
+        if nonlin_paras[0] < 0:
+            d, M, s = d[100::], M[100::], s[100::]
+        if nonlin_paras[0] > 0.5:
+            M[:, 5] = 0
+        # Ill-conditioned (monomials), singular (fewer data than parameters) and empty elements
+        if 0.1 < nonlin_paras[0] < 0.5:
+            power = 2 if nonlin_paras[0] < 0.3 else 4
+            M[:, 1::] = dataobj["x"][:, None] ** np.arange(power, power + M.shape[1] - 1)[None, :]
+        if -0.9 < nonlin_paras[0] < -0.7:
+            d, M, s = d[0:5], M[0:5], s[0:5]
+        if nonlin_paras[0] == -1:
+            d, M, s = d[0:0], M[0:0], s[0:0]
+        return d, M, s
+
+    def batched(nonlin_paras_array, dataobj):
+        B = len(nonlin_paras_array)
+        d, s, mask = np.zeros((B, 500)), np.ones((B, 500)), np.zeros((B, 500), dtype=bool)
+        M = np.zeros((B, 500, 11))
+        for k, nonlin_paras in enumerate(nonlin_paras_array):
+            _d, _M, _s = fm(nonlin_paras, dataobj)
+            d[k, 0:_d.size], M[k, 0:_d.size], s[k, 0:_d.size], mask[k, 0:_d.size] = _d, _M, _s, True
+        return d, M, s, mask
+
+    reference, ref_status = [], []
+    for nonlin_paras in nonlin_paras_array:
+        fit_status = {}
+        reference.append(fitfm(nonlin_paras, dataobj, fm, {}, computeH0=True, status=fit_status, verbose=False))
+        ref_status.append(fit_status["code"])
+    assert set(ref_status) == {STATUS_OK, STATUS_EMPTY_DATA, STATUS_SINGULAR}
+    fm.batched = batched
+    batch_status = {}
+    out = fitfm_batch(nonlin_paras_array, dataobj, fm, {}, computeH0=True, status=batch_status)
+    for out_arr, ref_arr in zip(out, zip(*reference)):
+        assert np.allclose(out_arr, np.array(ref_arr), rtol=1e-7, equal_nan=True)
+    assert np.array_equal(batch_status["code"], ref_status)
+    assert list(batch_status["message"].keys()) == [1]
+
+
+def test_fitfm_nuisance_cache():
+    dataobj = _toy_dataobj(seed=4)
+    nuisance_cache = LRUCache()
+    for phase in np.linspace(-1, 1, 5):
+        for kwargs in [{}, {"marginalize_noise_scaling": True}]:
+            out = fitfm([phase], dataobj, _linear_fm, {}, computeH0=True, nuisance_cache=nuisance_cache, **kwargs)
+            reference = fitfm([phase], dataobj, _linear_fm, {}, computeH0=True, **kwargs)
+            for out_arr, ref_arr in zip(out, reference):
+                assert np.allclose(out_arr, ref_arr, rtol=1e-9)
+    # The continuum is only factorized once
+    assert len(nuisance_cache) == 1 and nuisance_cache.misses == 1
+
+
+    # Nuisance models with the same column sums and the same projection on a ramp are not confused
+    nuisance_cache = LRUCache()
+    m, d = np.array([1.0, -1.0, 0.5]), np.array([1.0, 2.0, 3.0])
+    for M_fixed in [np.array([[1.0], [2.0], [4.0]]), np.array([[2.0], [0.0], [5.0]])]:
+        R, z, colnorms, iMTM = _bordered_factorization(M_fixed, m, d, nuisance_cache)
+        M = np.concatenate([M_fixed, m[:, None]], axis=1)
+        assert np.allclose(np.dot(R.T, R) * np.outer(colnorms, colnorms), np.dot(M.T, M))
+    assert len(nuisance_cache) == 2
+
+
+def test_fitfm_sparse_matches_dense():
+    # Planet column on top of a block diagonal continuum model, similar to a row by row spline model
+    x = np.linspace(0, 1, 50)
+    blocks = scipy.sparse.block_diag([np.polynomial.chebyshev.chebvander(2 * x - 1, 5)] * 20, format="csc")
+    planet = np.sin(40 * np.tile(x, 20) + np.repeat(np.arange(20), 50))
+    M = scipy.sparse.hstack([scipy.sparse.csc_matrix(planet[:, None]), blocks], format="csc")
+    rng = np.random.default_rng(5)
+    d = M @ rng.normal(size=M.shape[1]) + rng.normal(size=M.shape[0])
+    s = np.ones(d.size) * 0.5
+
+    residuals_H0, ref_residuals_H0 = np.zeros(d.size), np.zeros(d.size)
+    out = fitfm([0], None, lambda p, o: (d, M, s), {}, computeH0=True, residuals_H0=residuals_H0)
+    reference = fitfm([0], None, lambda p, o: (d, M.toarray(), s), {}, computeH0=True, residuals_H0=ref_residuals_H0)
+    for out_arr, ref_arr in zip(out, reference):
+        assert np.allclose(out_arr, ref_arr, rtol=1e-9)
+    assert np.allclose(residuals_H0, ref_residuals_H0, rtol=1e-9, atol=1e-12)
+
+
+
+def test_fitfm_sparse_planet_only():
+    # The continuum columns are all empty and dropped, leaving the planet column alone
+    x = np.linspace(0, 1, 200)
+    planet = np.sin(40 * x)
+    M = scipy.sparse.hstack([scipy.sparse.csc_matrix(planet[:, None]), scipy.sparse.csc_matrix((200, 3))], format="csc")
+    d = 2 * planet + np.random.default_rng(8).normal(size=200)
+    s = np.ones(d.size)
+
+    out = fitfm([0], None, lambda p, o: (d, M, s), {}, computeH0=True)
+    reference = fitfm([0], None, lambda p, o: (d, M.toarray(), s), {}, computeH0=True)
+    for out_arr, ref_arr in zip(out, reference):
+        assert np.allclose(out_arr, ref_arr, equal_nan=True)
+    assert np.isfinite(out[0]) and np.isfinite(out[3][0])
+
+
+def test_hc_splinefm_sparse_matches_dense():
+    from scipy.interpolate import interp1d
+    from breads.fm.hc_splinefm import hc_splinefm
+
+    rng = np.random.default_rng(9)
+    wvs = np.linspace(2, 2.2, 100)
+    data = rng.normal(size=(100, 7, 7)) + 10
+    bad_pixels = np.ones(data.shape)
+    bad_pixels[5, 3, 3], bad_pixels[10, 2, 4] = np.nan, np.nan
+    cubeobj = SimpleNamespace(data=data, noise=np.ones(data.shape), bad_pixels=bad_pixels, wavelengths=wvs,
+                              refpos=None, bary_RV=0)
+    planet_f = interp1d(wvs, 1 + 0.1 * np.sin(300 * wvs), bounds_error=False, fill_value=1)
+    fm_paras = {"planet_f": planet_f, "star_spectrum": np.ones(100) * 2, "boxw": 3, "nodes": 10}
+    for split_planet in [False, True]:
+        dense = hc_splinefm([1., 3, 3], cubeobj, split_planet=split_planet, **fm_paras)
+        sparse = hc_splinefm([1., 3, 3], cubeobj, split_planet=split_planet, sparse=True, **fm_paras)
+        assert scipy.sparse.issparse(sparse[1]) and np.array_equal(sparse[1].toarray(), dense[1])
+        assert sparse[1].nnz == np.count_nonzero(dense[1])
+        for sparse_arr, dense_arr in zip(sparse[::2], dense[::2]):
+            assert np.array_equal(sparse_arr, dense_arr)
+    out = fitfm([1., 3, 3], cubeobj, hc_splinefm, dict(fm_paras, sparse=True), computeH0=True)
+    reference = fitfm([1., 3, 3], cubeobj, hc_splinefm, fm_paras, computeH0=True)
+    for out_arr, ref_arr in zip(out, reference):
+        assert np.allclose(out_arr, ref_arr, rtol=1e-6)
+
+def test_fitfm_float32():
+    dataobj = _toy_dataobj(seed=6)
+    reference = fitfm([0.3], dataobj, _linear_fm, {}, computeH0=True)
+    out = fitfm([0.3], dataobj, _linear_fm, {}, computeH0=True, dtype=np.float32)
+    assert np.abs(out[0] - reference[0]) < 1e-3 and np.abs(out[1] - reference[1]) < 1e-3
+    assert np.allclose(out[3] / out[4], reference[3] / reference[4], rtol=1e-4)
+
+
+def test_fitfm_profiling():
+    dataobj = _toy_dataobj(seed=7)
+    profiling.reset()
+    fitfm([0.3], dataobj, _linear_fm, {}, computeH0=True)
+    assert len(profiling.report().stages) == 0
+    profiling.enable()
+    try:
+        for phase in np.linspace(-1, 1, 3):
+            fitfm([phase], dataobj, _linear_fm, {}, computeH0=True)
+    finally:
+        profiling.disable()
+    report = profiling.report()
+    profiling.reset()
+    assert report.stages["fitfm.solve"]["calls"] == 3
+    assert report.shapes == [{"Nd": 500, "Np": 11, "calls": 3}]
+    assert '"fitfm.forward_model"' in report.to_json()
+
+
+def test_log_prob_cache():
+    dataobj = _toy_dataobj(seed=8)
+    calls = []
+
+    def fm(nonlin_paras, dataobj):
+        calls.append(nonlin_paras)
+        return _linear_fm(nonlin_paras, dataobj)
+
+    cache = LogProbCache(maxsize=2, decimals=6)
+    reference = log_prob([0.3], dataobj, _linear_fm, {})
+    assert log_prob([0.3], dataobj, fm, {}, cache=cache) == reference
+    assert log_prob([0.3 + 1e-9], dataobj, fm, {}, cache=cache) == reference
+    assert nlog_prob([0.3], dataobj, fm, {}, cache=cache, nonlin_lnprior_func=lambda p: 1.0) == -reference - 1.0
+    assert len(calls) == 1 and cache.hits == 2 and cache.misses == 1
+    for phase in [0.1, 0.2, 0.3]:
+        log_prob([phase], dataobj, fm, {}, cache=cache)
+    # 0.3 was evicted by the two other values
+    assert len(cache) == 2 and len(calls) == 4 and np.isclose(cache.hit_rate(), 2 / 6)
+    # Only the definition of the cache is pickled, each process keeps its own entries
+    assert len(pickle.loads(pickle.dumps(cache))) == 2
+    cache.clear()
+    assert cache.stats()["size"] == 0
+    # The entries are released with the cache
+    cache.set(cache.key([0.3]), reference)
+    name = cache.name
+    del cache
+    gc.collect()
+    assert name not in breads.fit._log_prob_caches
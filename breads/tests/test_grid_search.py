@@ -0,0 +1,269 @@
+import numpy as np
+import pytest
+
+from breads.adaptive import _interp_axis
+from breads.fit import STATUS_EMPTY_DATA, STATUS_EXCEPTION, STATUS_MASKED, STATUS_OK
+from breads.grid_search import adaptive_grid_search, grid_search, merge_shards, process_chunk
+from breads.parallel import thread_split
+from breads.progress import ProgressReporter
+from breads.storage import _new_output_file, load_grid_search, load_grid_search_done
+
+
+def _sine_fm(nonlin_paras, dataobj):
+    x = dataobj["x"]
+    M = np.concatenate([np.sin(nonlin_paras[0] * x + nonlin_paras[1])[:, None],
+                        np.polynomial.chebyshev.chebvander(2 * x - 1, 4)], axis=1)
+    return dataobj["d"], M, np.ones(x.size)
+
+
+def _toy_dataobj():
+    x = np.linspace(0, 1, 300)
+    d = 2 * np.sin(30 * x + 0.5) + x ** 2 + np.random.default_rng(0).normal(size=x.size) * 0.1
+    return {"x": x, "d": d}
+
+
+def test_grid_search_resume(tmp_path):
+    dataobj = _toy_dataobj()
+    para_vecs = [np.linspace(20, 40, 11), np.linspace(0, 1, 5)]
+    reference = grid_search(para_vecs, dataobj, _sine_fm, {}, computeH0=True)
+    out = grid_search(para_vecs, dataobj, _sine_fm, {}, computeH0=True, out_path=str(tmp_path))
+    for out_arr, ref_arr in zip(out, reference):
+        assert np.allclose(out_arr, ref_arr)
+
+    # Interrupted search: the second half of the grid was not saved
+    done = np.load(tmp_path / "done.npy", mmap_mode="r+")
+    done[6::] = False
+    done.flush()
+    log_prob = load_grid_search(str(tmp_path), mmap_mode="r+")[0]
+    log_prob[6::] = 0
+    log_prob.flush()
+    del done, out, log_prob
+    out = grid_search(para_vecs, dataobj, _sine_fm, {}, computeH0=True, out_path=str(tmp_path), resume=True)
+    assert np.all(load_grid_search_done(str(tmp_path)))
+    for out_arr, ref_arr in zip(out, reference):
+        assert np.allclose(out_arr, ref_arr)
+    # The points not computed yet are nan in a new output file, not a valid looking 0
+    assert np.all(np.isnan(_new_output_file(str(tmp_path), [11, 5, 7])))
+
+
+def test_adaptive_grid_search_finds_peak():
+    dataobj = _toy_dataobj()
+    para_vecs = [np.linspace(20, 40, 81), np.linspace(0, 1, 9)]
+    reference = grid_search(para_vecs, dataobj, _sine_fm, {}, computeH0=True)
+    sparse, dense = adaptive_grid_search(para_vecs, dataobj, _sine_fm, {}, coarse_step=[8, 2], top_k=3,
+                                         computeH0=True)
+    assert len(sparse["log_prob"]) < np.size(reference[0]) // 2
+    best = np.nanargmax(sparse["log_prob"])
+    assert np.ravel_multi_index(sparse["indices"][best], reference[0].shape) == np.nanargmax(reference[0])
+    assert np.allclose(sparse["log_prob"], reference[0][tuple(sparse["indices"].T)])
+    assert dense[0].shape == reference[0].shape and dense[3].shape == reference[3].shape
+    assert np.allclose(dense[0][tuple(sparse["indices"].T)], sparse["log_prob"])
+
+    # The coarse points next to a rejected (-inf) point keep their value
+    arr = np.array([-np.inf, 2.0, 4.0])
+    assert np.array_equal(_interp_axis(arr, 0, np.array([0, 2, 4]), 5), [-np.inf, -np.inf, 2.0, 3.0, 4.0])
+
+
+def test_grid_search_cost_balanced():
+    dataobj = _toy_dataobj()
+    para_vecs = [np.linspace(20, 40, 21), np.linspace(0, 1, 5)]
+    reference = grid_search(para_vecs, dataobj, _sine_fm, {}, computeH0=True)
+    cost = np.linspace(1, 10, 21)[:, None] ** 2
+    out = grid_search(para_vecs, dataobj, _sine_fm, {}, computeH0=True, numthreads=2, cost=cost)
+    for out_arr, ref_arr in zip(out, reference):
+        assert np.allclose(out_arr, ref_arr)
+
+
+def test_grid_search_valid_mask():
+    dataobj = _toy_dataobj()
+    para_vecs = [np.linspace(20, 40, 11), np.linspace(0, 1, 5)]
+    reference = grid_search(para_vecs, dataobj, _sine_fm, {}, computeH0=True)
+    valid_mask = np.arange(11)[:, None] % 3 != 0
+    out = grid_search(para_vecs, dataobj, _sine_fm, {}, computeH0=True, valid_mask=valid_mask)
+    assert np.allclose(out[0][valid_mask[:, 0]], reference[0][valid_mask[:, 0]])
+    assert np.all(out[0][~valid_mask[:, 0]] == -np.inf) and np.all(out[2][~valid_mask[:, 0]] == np.inf)
+    assert np.all(np.isnan(out[3][~valid_mask[:, 0]]))
+
+
+def test_process_chunk_location_major():
+    dataobj = _toy_dataobj()
+    prepared_locations = []
+
+    def fm(nonlin_paras, dataobj):
+        return fm.evaluate(nonlin_paras, fm.prepare(fm.location(nonlin_paras), dataobj), dataobj)
+
+    def prepare(location, dataobj):
+        prepared_locations.append(location)
+        return _sine_fm([1, location[0]], dataobj)
+
+    def evaluate(nonlin_paras, prepared, dataobj):
+        d, M, s = prepared
+        return d, np.concatenate([np.sin(nonlin_paras[0] * dataobj["x"] + nonlin_paras[1])[:, None], M[:, 1::]],
+                                 axis=1), s
+
+    fm.location = lambda nonlin_paras: (nonlin_paras[1],)
+    fm.prepare = prepare
+    fm.evaluate = evaluate
+    para_grids = [np.ravel(pgrid) for pgrid in np.meshgrid(np.linspace(20, 40, 7), np.linspace(0, 1, 3),
+                                                           indexing="ij")]
+    out = process_chunk((para_grids, dataobj, fm, {}, None, True, True, False))
+    assert sorted(prepared_locations) == [(0.0,), (0.5,), (1.0,)]
+    reference = process_chunk((para_grids, dataobj, _sine_fm, {}, None, True, True, False))
+    assert np.allclose(out, reference)
+
+
+
+def test_process_chunk_batched(capsys):
+    dataobj = _toy_dataobj()
+    batches = []
+
+    def fm(nonlin_paras, dataobj):
+        return _sine_fm(nonlin_paras, dataobj)
+
+    def batched(nonlin_paras_array, dataobj):
+        batches.append(nonlin_paras_array)
+        d, M, s = zip(*[_sine_fm(nonlin_paras, dataobj) for nonlin_paras in nonlin_paras_array])
+        return np.array(d), np.array(M), np.array(s), np.ones(np.shape(d), dtype=bool)
+
+    fm.batched = batched
+    fm.location = lambda nonlin_paras: (nonlin_paras[1],)
+    fm.prepare = lambda location, dataobj: None
+    fm.evaluate = lambda nonlin_paras, prepared, dataobj: _sine_fm(nonlin_paras, dataobj)
+    para_grids = [np.ravel(pgrid) for pgrid in np.meshgrid(np.linspace(20, 40, 7), np.linspace(0, 1, 3),
+                                                           indexing="ij")]
+    reference = process_chunk((para_grids, dataobj, _sine_fm, {}, None, True, True, False))
+    out, status, errors = process_chunk((para_grids, dataobj, fm, {}, None, True, True, False,
+                                         {"batch_size": 4, "return_status": True}))
+    assert np.allclose(out, reference) and np.all(status == STATUS_OK) and errors == []
+    # Batches of at most batch_size points within each location
+    assert [len(batch) for batch in batches] == [4, 3] * 3
+    assert all(np.unique(batch[:, 1]).size == 1 for batch in batches)
+
+    # A batch that cannot be solved is not a failure of the points, they are fitted one by one instead
+    def batched(nonlin_paras_array, dataobj):
+        raise MemoryError("batch too large")
+
+    fm.batched = batched
+    out, status, errors = process_chunk((para_grids, dataobj, fm, {}, None, True, True, False,
+                                         {"return_status": True, "verbose": False}))
+    assert np.allclose(out, reference) and np.all(status == STATUS_OK) and errors == []
+    assert capsys.readouterr().out == ''
+
+def test_grid_search_shards(tmp_path):
+    dataobj = _toy_dataobj()
+    para_vecs = [np.linspace(20, 40, 11), np.linspace(0, 1, 5)]
+    reference = grid_search(para_vecs, dataobj, _sine_fm, {}, computeH0=True)
+    paths = [str(tmp_path / "shard{0}.npz".format(k)) for k in range(3)]
+    for k, path in enumerate(paths):
+        grid_search(para_vecs, dataobj, _sine_fm, {}, computeH0=True, num_shards=3, shard_index=k, shard_file=path)
+    out = merge_shards(paths[::-1])
+    for out_arr, ref_arr in zip(out, reference):
+        assert np.allclose(out_arr, ref_arr)
+    with pytest.raises(ValueError):
+        merge_shards(paths[0:2])
+
+
+def test_grid_search_status(tmp_path, capsys):
+    dataobj = _toy_dataobj()
+    para_vecs = [np.linspace(20, 40, 11), np.linspace(0, 1, 5)]
+
+    def fm(nonlin_paras, dataobj):
+        if nonlin_paras[0] > 35:
+            raise RuntimeError("forward model failure")
+        if nonlin_paras[0] < 25:
+            return np.array([]), np.zeros((0, 6)), np.array([])
+        return _sine_fm(nonlin_paras, dataobj)
+
+    valid_mask = np.ones((11, 5), dtype=bool)
+    valid_mask[5, 0] = False
+    out = grid_search(para_vecs, dataobj, fm, {}, computeH0=True, valid_mask=valid_mask, verbose=False,
+                      return_status=True)
+    assert capsys.readouterr().out == ""
+    status, failures = out[5:7]
+    assert np.all(status[8::] == STATUS_EXCEPTION) and np.all(status[0:3] == STATUS_EMPTY_DATA)
+    assert status[5, 0] == STATUS_MASKED and np.all(status[3:8][status[3:8] != STATUS_MASKED] == STATUS_OK)
+    assert failures["counts"] == {"ok": 24, "empty_data": 15, "exception": 15, "masked": 1}
+    assert 0 < len(failures["errors"]) <= 10 and "forward model failure" in failures["errors"][0][2]
+    assert np.all(np.isfinite(out[0][status == STATUS_OK]))
+
+    paths = [str(tmp_path / "shard{0}.npz".format(k)) for k in range(2)]
+    for k, path in enumerate(paths):
+        grid_search(para_vecs, dataobj, fm, {}, valid_mask=valid_mask, verbose=False, num_shards=2, shard_index=k,
+                    shard_file=path)
+    assert np.all(merge_shards(paths, return_status=True)[5] == status)
+
+
+def test_grid_search_progress():
+    dataobj = _toy_dataobj()
+    para_vecs = [np.linspace(20, 40, 11), np.linspace(0, 1, 5)]
+    reference = grid_search(para_vecs, dataobj, _sine_fm, {}, computeH0=True)
+    for numthreads in [None, 2]:
+        reports = []
+        reporter = ProgressReporter(55, callback=reports.append, min_interval=0)
+        out = grid_search(para_vecs, dataobj, _sine_fm, {}, computeH0=True, numthreads=numthreads, progress=reporter)
+        for out_arr, ref_arr in zip(out, reference):
+            assert np.allclose(out_arr, ref_arr)
+        assert reports[-1]["final"] and reports[-1]["done"] == 55 and reports[-1]["eta"] == 0
+        assert len(reports) > 2 and all(r0["done"] <= r1["done"] for r0, r1 in zip(reports[:-1], reports[1:]))
+        assert 0 < len(reports[-1]["utilisation"]) <= (1 if numthreads is None else 2)
+
+
+def test_grid_search_threads():
+    dataobj = _toy_dataobj()
+    para_vecs = [np.linspace(20, 40, 11), np.linspace(0, 1, 5)]
+    reference = grid_search(para_vecs, dataobj, _sine_fm, {}, computeH0=True)
+    for kwargs in [{"numthreads": 2, "backend": "threads", "blas_threads": 1}, {"numthreads": "auto"}]:
+        out = grid_search(para_vecs, dataobj, _sine_fm, {}, computeH0=True, **kwargs)
+        for out_arr, ref_arr in zip(out, reference):
+            assert np.allclose(out_arr, ref_arr)
+    assert thread_split(n_cores=8) == (8, 1) and thread_split(2, n_cores=8) == (2, 4)
+    with pytest.raises(ValueError):
+        grid_search(para_vecs, dataobj, _sine_fm, {}, numthreads=2, backend="mpi")
+
+
+def test_grid_search_N_linpara():
+    dataobj = _toy_dataobj()
+    para_vecs = [np.linspace(20, 40, 11), np.linspace(0, 1, 5)]
+
+    def fm(nonlin_paras, dataobj):
+        # Smaller continuum model for part of the grid
+        d, M, s = _sine_fm(nonlin_paras, dataobj)
+        return (d, M, s) if nonlin_paras[0] < 30 else (d, M[:, 0:4], s)
+
+    reference = grid_search(para_vecs, dataobj, fm, {}, computeH0=True)
+    fm.N_linpara = lambda: 6
+    for kwargs in [{}, {"N_linpara": "probe", "numthreads": 2, "backend": "threads"}]:
+        out = grid_search(para_vecs, dataobj, fm, {}, computeH0=True, **kwargs)
+        assert out[3].shape == (11, 5, 6)
+        for out_arr, ref_arr in zip(out[0:3], reference[0:3]):
+            assert np.allclose(out_arr, ref_arr)
+        assert np.allclose(out[3][0:5], reference[3][0:5])
+        assert np.allclose(out[3][5::, :, 0:4], reference[3][5::, :, 0:4])
+        assert np.all(np.isnan(out[4][5::, :, 4::]))
+
+    # The probe skips the masked points, uses the requested precision and silently falls back to growing the outputs
+    def masked_fm(nonlin_paras, dataobj, dtype=None):
+        if nonlin_paras[0] == 20 or dtype != np.float32:
+            raise ValueError("invalid point")
+        return _sine_fm(nonlin_paras, dataobj)
+
+    valid_mask = (para_vecs[0] != 20)[:, None]
+    for probe_mask in [valid_mask, None]:
+        out = grid_search(para_vecs, dataobj, masked_fm, {}, N_linpara="probe", valid_mask=probe_mask,
+                          dtype=np.float32, numthreads=2, backend="threads", verbose=False)
+        assert out[3].shape == (11, 5, 6)
+        assert not np.any(np.isfinite(out[0][0])) and np.all(np.isfinite(out[0][1::]))
+
+
+def test_grid_search_dtype_support():
+    dataobj = _toy_dataobj()
+    para_vecs = [np.linspace(20, 40, 3), np.linspace(0, 1, 2)]
+    with pytest.raises(ValueError):
+        grid_search(para_vecs, dataobj, _sine_fm, {}, dtype=np.float32)
+
+    def fm(nonlin_paras, dataobj, **kwargs):
+        d, M, s = _sine_fm(nonlin_paras, dataobj)
+        return d.astype(kwargs["dtype"]), M.astype(kwargs["dtype"]), s.astype(kwargs["dtype"])
+
+    out = grid_search(para_vecs, dataobj, fm, {}, dtype=np.float32)
+    assert np.allclose(out[0], grid_search(para_vecs, dataobj, _sine_fm, {})[0], rtol=1e-4)
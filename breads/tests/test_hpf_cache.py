@@ -0,0 +1,56 @@
+import numpy as np
+from scipy.interpolate import interp1d
+
+from breads.fm.hc_hpffm import hc_hpffm
+from breads.fm.hpf_cache import compute_hpf_cache, load_hpf_cache, save_hpf_cache
+from breads.fm.iso_hpffm import iso_hpffm
+from breads.instruments.instrument import Instrument
+
+
+def _toy_cube():
+    rng = np.random.default_rng(0)
+    nz, ny, nx = 400, 5, 6
+    dataobj = Instrument()
+    dataobj.wavelengths = np.linspace(2.0, 2.4, nz)
+    star_spectrum = 1 + 0.1 * np.sin(200 * dataobj.wavelengths)
+    dataobj.data = star_spectrum[:, None, None] * (1 + dataobj.wavelengths[:, None, None]) \
+        + rng.normal(size=(nz, ny, nx)) * 0.01
+    dataobj.noise = np.ones((nz, ny, nx)) * 0.01
+    dataobj.noise[10, 2, 3] = 0
+    dataobj.bad_pixels = np.ones((nz, ny, nx))
+    dataobj.bad_pixels[50:55, 1, 1] = np.nan
+    dataobj.bary_RV = 0
+    transmission = np.ones(nz)
+    transmission[100] = np.nan
+    planet_f = interp1d(dataobj.wavelengths, 1 + 0.2 * np.cos(300 * dataobj.wavelengths), bounds_error=False,
+                        fill_value=np.nan)
+    return dataobj, star_spectrum, transmission, planet_f
+
+
+def test_hpf_cache_matches_forward_model(tmp_path):
+    dataobj, star_spectrum, transmission, planet_f = _toy_cube()
+    for hpf_mode in ["gauss", "fft"]:
+        fm_paras = {"planet_f": planet_f, "transmission": transmission, "star_spectrum": star_spectrum, "boxw": 3,
+                    "hpf_mode": hpf_mode, "res_hpf": 50, "cutoff": 5}
+        iso_fm_paras = {"planet_f": planet_f, "transmission": transmission, "boxw": 3, "hpf_mode": hpf_mode}
+        nonlin_paras = [[5, 2, 3], [-10, 0, 0], [0, 1.2, 4.6]]
+        dataobj.hpf_cache = None
+        reference = [hc_hpffm(paras, dataobj, **fm_paras) for paras in nonlin_paras]
+        iso_reference = [iso_hpffm(paras, dataobj, **iso_fm_paras) for paras in nonlin_paras]
+
+        compute_hpf_cache(dataobj, star_spectrum=star_spectrum, transmission=transmission, hpf_mode=hpf_mode)
+        save_hpf_cache(dataobj, tmp_path / "hpf_cache.npz")
+        for paras, ref in zip(nonlin_paras, reference):
+            for out, ref_out in zip(hc_hpffm(paras, dataobj, **fm_paras), ref):
+                assert np.allclose(out, ref_out, rtol=1e-10, atol=1e-12, equal_nan=True)
+        # The cache of the hc_* models does not apply to the iso_* models (no star spectrum)
+        assert all(np.array_equal(out, ref_out, equal_nan=True) for paras, ref in zip(nonlin_paras, iso_reference)
+                   for out, ref_out in zip(iso_hpffm(paras, dataobj, **iso_fm_paras), ref))
+
+        dataobj.hpf_cache = None
+        load_hpf_cache(dataobj, tmp_path / "hpf_cache.npz")
+        for out, ref_out in zip(hc_hpffm(nonlin_paras[0], dataobj, **fm_paras), reference[0]):
+            assert np.allclose(out, ref_out, rtol=1e-10, atol=1e-12, equal_nan=True)
+        # Reduced precision outputs
+        for out, ref_out in zip(hc_hpffm(nonlin_paras[0], dataobj, dtype=np.float32, **fm_paras), reference[0]):
+            assert out.dtype == np.float32 and np.allclose(out, ref_out, rtol=1e-5, atol=1e-6, equal_nan=True)
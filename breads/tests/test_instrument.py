@@ -0,0 +1,49 @@
+import pickle
+
+import numpy as np
+
+import breads.utils
+from breads.instruments.instrument import Instrument
+from breads.utils import broaden
+
+
+class _FiberInstrument(Instrument):
+    def lsf_resolution(self, wvs, loc=None):
+        return np.linspace(2000, 3000, np.size(wvs)) * (1 + loc)
+
+
+def test_lsf_operator_cache():
+    rng = np.random.default_rng(0)
+    wvs = np.linspace(1.9, 2.4, 800)
+    spectra = 1 + rng.normal(size=(5, wvs.size)) * 0.1
+    spectra[2, 100:110] = np.nan
+
+    dataobj = Instrument()
+    dataobj.R = 2700
+    conv_spectra = dataobj.broaden_spectra(wvs, spectra)
+    for spectrum, conv_spectrum in zip(spectra, conv_spectra):
+        assert np.allclose(conv_spectrum, broaden(wvs, spectrum, 2700, method="loop"), rtol=0, atol=1e-12,
+                           equal_nan=True)
+    assert dataobj.lsf_operator(wvs) is dataobj.lsf_operator(wvs.copy())
+    # The cached operators are not pickled
+    assert pickle.loads(pickle.dumps(dataobj))._lsf_operators is None
+
+    fiberobj = _FiberInstrument()
+    for loc in [0, 1]:
+        assert np.allclose(fiberobj.broaden_spectra(wvs, spectra[0], loc=loc),
+                           broaden(wvs, spectra[0], np.linspace(2000, 3000, wvs.size) * (1 + loc), method="loop"),
+                           rtol=0, atol=1e-12)
+    assert fiberobj.lsf_operator(wvs, loc=0) is not fiberobj.lsf_operator(wvs, loc=1)
+
+
+def test_lsf_operator_too_large(monkeypatch):
+    # Operators too large to be cached are applied by blocks, with the same result
+    wvs = np.linspace(1.9, 2.4, 800)
+    spectra = 1 + np.random.default_rng(0).normal(size=(3, wvs.size)) * 0.1
+    dataobj = Instrument()
+    dataobj.R = 2700
+    reference = dataobj.broaden_spectra(wvs, spectra)
+    dataobj.clear_lsf_operators()
+    monkeypatch.setattr(breads.utils, "broaden_max_nnz", 1000)
+    assert dataobj.lsf_operator(wvs) is None
+    assert np.allclose(dataobj.broaden_spectra(wvs, spectra), reference, rtol=0, atol=1e-12)
@@ -0,0 +1,72 @@
+import pickle
+import warnings
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from breads.parallel import Executor, SharedArrays, resolve
+
+
+def test_shared_arrays_pickle_as_handles():
+    data = np.random.default_rng(0).normal(size=(100, 200))
+    dataobj = SimpleNamespace(data=data, wavelengths=np.arange(10.), name="test")
+    fm_paras = {"grid": (np.arange(5.), data), "boxw": 3}
+    with SharedArrays() as shared:
+        shared_dataobj = shared.share(dataobj)
+        shared_fm_paras = shared.share(fm_paras)
+        # The original objects are not modified, and the small arrays are not moved to shared memory
+        assert dataobj.data is data and fm_paras["grid"][1] is data
+        assert shared_dataobj.wavelengths is dataobj.wavelengths and shared_dataobj.name == "test"
+        assert shared.nbytes() >= data.nbytes
+        buffer = pickle.dumps((shared_dataobj, shared_fm_paras))
+        assert len(buffer) < data.nbytes // 10
+        worker_dataobj, worker_fm_paras = pickle.loads(buffer)
+        assert type(worker_dataobj.data) is np.ndarray
+        assert np.array_equal(worker_dataobj.data, data)
+        assert np.array_equal(worker_fm_paras["grid"][1], data)
+        del worker_dataobj, worker_fm_paras
+
+
+def _read_installed(args):
+    dataobj, index = args
+    return resolve(dataobj)["data"][index]
+
+
+def test_executor_installs_objects():
+    dataobj = {"data": np.arange(2.0 ** 14)}
+    with Executor(2, dataobj=dataobj) as mypool:
+        reference = mypool.reference(dataobj)
+        assert reference is not dataobj
+        assert len(pickle.dumps(reference)) < 200
+        assert mypool.reference({"data": dataobj["data"]}) is not reference
+        assert mypool.map(_read_installed, [(reference, k) for k in range(4)]) == [0.0, 1.0, 2.0, 3.0]
+
+
+def test_executor_reinstall():
+    dataobj = {"data": np.arange(2.0 ** 14)}
+    with Executor(2, dataobj=dataobj) as mypool:
+        # Modified in place after being installed: the stale copy of the workers is not used
+        dataobj["data"][0] = -1
+        with pytest.warns(UserWarning):
+            assert mypool.reference(dataobj) is dataobj
+        mypool.reinstall(dataobj=dataobj)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            reference = mypool.reference(dataobj)
+        assert reference is not dataobj and len(pickle.dumps(reference)) < 2 ** 14
+        assert mypool.map(_read_installed, [(reference, k) for k in range(2)]) == [-1.0, 1.0]
+
+
+def test_executor_nested_modification():
+    fm_paras = {"grid": {"values": np.arange(10.0)}, "star": SimpleNamespace(spectrum=np.ones(10))}
+    with Executor(1, fm_paras=fm_paras) as mypool:
+        assert mypool.reference(fm_paras) is not fm_paras
+        # Arrays held one level down are checked too
+        fm_paras["star"].spectrum[0] = 2
+        with pytest.warns(UserWarning):
+            assert mypool.reference(fm_paras) is fm_paras
+        mypool.reinstall(fm_paras=fm_paras)
+        fm_paras["grid"]["values"][0] = -1
+        with pytest.warns(UserWarning):
+            assert mypool.reference(fm_paras) is fm_paras
@@ -1,6 +1,106 @@
 import breads.utils
 import astropy.coordinates
+import numpy as np
+import pytest
+import scipy.sparse
+from scipy.interpolate import InterpolatedUnivariateSpline
 
 def test_propagate_coordinates_at_epoch():
     result = breads.utils.propagate_coordinates_at_epoch('HD 19467', '2025-01-01')
     assert isinstance(result, astropy.coordinates.SkyCoord), "Function should return a valid SkyCoord object"
+
+def test_get_spline_model_matches_interpolating_splines():
+    x = np.sort(np.random.default_rng(0).uniform(0.9, 2.1, 1000))
+    for nodes in [np.linspace(1, 2, 15), [np.linspace(1, 1.4, 5), np.linspace(1.5, 2, 5)]]:
+        M = breads.utils.get_spline_model(nodes, x)
+        for col, (segment, k) in enumerate([(s, k) for s in np.atleast_2d(nodes) for k in range(np.size(s))]):
+            inbounds = (np.min(segment) < x) & (x < np.max(segment))
+            spl = InterpolatedUnivariateSpline(segment, np.eye(np.size(segment))[k], k=3, ext=0)
+            assert np.allclose(M[inbounds, col], spl(x[inbounds]), rtol=0, atol=1e-12)
+            assert np.all(M[~inbounds, col] == 0)
+        # Cached copy, which can be modified safely
+        M2 = breads.utils.get_spline_model(nodes, x)
+        M2[:] = 0
+        assert np.array_equal(breads.utils.get_spline_model(nodes, x), M)
+        M_sparse = breads.utils.get_spline_model(nodes, x, sparse=True)
+        assert scipy.sparse.issparse(M_sparse) and np.array_equal(M_sparse.toarray(), M)
+
+def test_broaden_methods_match_loop(monkeypatch):
+    rng = np.random.default_rng(0)
+    linear = np.linspace(1.9, 2.4, 2048)
+    log_uniform = np.exp(np.linspace(np.log(1.9), np.log(2.4), 10000))
+    irregular = np.sort(np.concatenate([rng.uniform(1.9, 2.4, 4000), [2.1, 2.1 + 1e-12]]))
+    for wvs, cases in [(linear, [35000, 50, np.linspace(30000, 40000, linear.size)]),
+                       (log_uniform, [2700, 35000, 100]),
+                       (irregular, [2700, np.linspace(2000, 3000, irregular.size)])]:
+        spectrum = 1 + 0.3 * np.sin(300 * wvs) + rng.normal(size=wvs.size) * 0.05
+        spectrum[:15] = np.nan
+        spectrum[wvs.size // 3:wvs.size // 3 + 5] = np.nan
+        spectrum[wvs.size // 2:wvs.size // 2 + 50] = np.nan
+        spectrum[-3:] = np.nan
+        for R in cases:
+            reference = breads.utils.broaden(wvs, spectrum, R, method="loop")
+            for method in [None, "sparse"]:
+                conv_spectrum = breads.utils.broaden(wvs, spectrum, R, method=method)
+                assert np.array_equal(np.isnan(conv_spectrum), np.isnan(reference))
+                assert np.nanmax(np.abs(conv_spectrum - reference)) < 1e-10
+    # Operators too large to be cached are applied by blocks of rows
+    monkeypatch.setattr(breads.utils, "broaden_max_nnz", 10 ** 4)
+    conv_spectrum = breads.utils.broaden(irregular, spectrum, 2700, method="sparse")
+    assert np.nanmax(np.abs(conv_spectrum - breads.utils.broaden(irregular, spectrum, 2700, method="loop"))) < 1e-10
+    # The resampling of the fft method is refused for this sampling (nearly duplicated wavelengths)
+    with pytest.raises(ValueError):
+        breads.utils.broaden(irregular, spectrum, 2700, method="fft")
+    kernel = lambda x: np.exp(-np.abs(x) * 8000)
+    assert np.allclose(breads.utils.broaden(linear, spectrum[:linear.size], 4000, kernel=kernel, method="sparse"),
+                       breads.utils.broaden(linear, spectrum[:linear.size], 4000, kernel=kernel, method="loop"),
+                       rtol=0, atol=1e-10, equal_nan=True)
+
+def test_LPFvsHPF_batch():
+    rng = np.random.default_rng(0)
+    spectra = 1 + rng.normal(size=(6, 1001))
+    spectra[1, :20] = np.nan
+    spectra[2, -7:] = np.nan
+    spectra[3, 100:150] = np.nan
+    spectra[4, ::3] = np.nan
+    spectra[5] = np.nan
+    for cutoff in [1, 4, 40]:
+        LPF, HPF = breads.utils.LPFvsHPF(spectra, cutoff)
+        for spectrum, lpf, hpf in zip(spectra, LPF, HPF):
+            lpf_1d, hpf_1d = breads.utils.LPFvsHPF(spectrum, cutoff)
+            assert np.array_equal(lpf, lpf_1d, equal_nan=True) and np.array_equal(hpf, hpf_1d, equal_nan=True)
+            assert np.array_equal(np.isnan(lpf), np.isnan(spectrum))
+            assert np.allclose(lpf + hpf, spectrum, equal_nan=True)
+
+def test_LPFvsHPF_reference():
+    # Reference computed with the previous pandas based implementation (interpolate, rolling median and complex fft)
+    x = np.linspace(0, 1, 40)
+    spectrum = 1 + x ** 2 + 0.1 * np.sin(37 * x)
+    spectrum[0:3] = np.nan
+    spectrum[15:18] = np.nan
+    spectrum[-2:] = np.nan
+    nan = np.nan
+    ref_lpf = [nan, nan, nan, 1.0162864502685132, 1.0164097157284713, 1.0173622983001198, 1.019558066293653,
+               1.023391562225567, 1.0292010570279617, 1.0372381880059343, 1.0476473516398206, 1.06045699396826,
+               1.0755836780366397, 1.0928484383722274, 1.1120035973148832, nan, nan, nan, 1.2021567164890037,
+               1.2271258000358132, 1.2529901284546388, 1.2798913674163739, 1.3080575827886067, 1.3377722543488404,
+               1.3693323000570254, 1.402998845796869, 1.4389453947857254, 1.477208539217842, 1.5176463563169484,
+               1.5599091306788186, 1.6034260817502464, 1.6474104319647123, 1.6908835477015576, 1.732717168753525,
+               1.771691072067106, 1.8065620494663843, 1.836138956755087, 1.8593579219822591, nan, nan]
+    ref_hpf = [nan, nan, nan, 0.018746676896169046, -0.06666968245309579, -0.10087707296932846, -0.05159843268639952,
+               0.0438493042368584, 0.10940570190963972, 0.09349104913705197, 0.011862764330708986,
+               -0.06564674013225247, -0.07343644166055263, -0.004830703851233187, 0.08247211632164042, nan, nan, nan,
+               -0.0871089715594342, -0.06316305180705672, 0.02244268195847332, 0.09793801912706313,
+               0.10013598744826191, 0.027006137784730155, -0.060825548458646184, -0.09087057972447732,
+               -0.03943925125157777, 0.04849362461299922, 0.096833473408374, 0.06201833614106045,
+               -0.030321409979897407, -0.10628158343761873, -0.10472840280455631, -0.02754314048908091,
+               0.06283181625077927, 0.09645356152837592, 0.05521192893258031, -0.011137825400562074, nan, nan]
+    for lpf, hpf in [breads.utils.LPFvsHPF(spectrum, 5), np.array(breads.utils.LPFvsHPF(spectrum[None, :], 5))[:, 0]]:
+        assert np.allclose(lpf, ref_lpf, rtol=0, atol=1e-14, equal_nan=True)
+        assert np.allclose(hpf, ref_hpf, rtol=0, atol=1e-14, equal_nan=True)
+
+def test_running_median():
+    # Reference: pandas.Series(x).rolling(window, center=True).median().bfill().ffill()
+    x = np.array([3., 1., 4., 1., 5., 9., 2., 6., 5., 3.])
+    assert np.array_equal(breads.utils.running_median(x, 3), [3, 3, 1, 4, 5, 5, 6, 5, 5, 5])
+    assert np.array_equal(breads.utils.running_median(x, 4), [2, 2, 2, 2.5, 4.5, 3.5, 5.5, 5.5, 4, 4])
@@ -1,17 +1,22 @@
+import hashlib
 import itertools
 import os
+import threading
+from collections import OrderedDict
 from copy import copy
 
 import astropy.coordinates
 import astropy.io.fits as fits
 import astropy.units as u
 import numpy as np
-import pandas as pd
 from astropy.time import Time
 from astroquery.simbad import Simbad
+import scipy.signal
+import scipy.sparse
 from py.path import local
-from scipy.interpolate import InterpolatedUnivariateSpline
+from scipy.interpolate import BSpline, InterpolatedUnivariateSpline, make_interp_spline
 from scipy.interpolate import interp1d
+from scipy.ndimage import median_filter, rank_filter
 from scipy.optimize import lsq_linear
 from scipy.signal import correlate2d
 from scipy.stats import median_abs_deviation
@@ -213,7 +218,7 @@ def _task_findbadpix(paras):
         #     plt.plot(new_badpix_arr[where_data_finite[0],k],label="bad pix",linestyle="-")
         #     plt.show()
 
-        new_data_arr[:,k] = np.array(pd.DataFrame(new_data_arr[:,k]).interpolate(method="linear").fillna(method="bfill").fillna(method="ffill"))[:, 0]
+        new_data_arr[:,k] = _interpolate_nans(new_data_arr[None,:,k])[0]
 
     return new_data_arr,new_badpix_arr,res
 
@@ -459,10 +464,13 @@ def findbadpix(cube, noisecube=None, badpixcube=None,chunks=20,mypool=None,med_s
 
 
 
-def broaden(wvs,spectrum,R,mppool=None,kernel=None):
+def broaden(wvs,spectrum,R,mppool=None,kernel=None,method=None):
     """
     Broaden a spectrum to instrument resolution assuming a gaussian line spread function.
 
+    The broadened spectrum at each wavelength is the average of the spectrum weighted by the line spread function
+    (truncated at 10 sigma) and the size of the wavelength bins, ignoring the nans.
+
     Args:
         wvs: Wavelength vector (ndarray).
         spectrum: Spectrum vector (ndarray).
@@ -471,10 +479,34 @@ def broaden(wvs,spectrum,R,mppool=None,kernel=None):
             Or the resolution can be specified at each wavelength if R is a vector of the same size as wvs.
         mypool: Multiprocessing pool to parallelize the code. If None (default), non parallelization is applied.
             E.g. mppool = mp.Pool(processes=10) # 10 is the number processes
+            Only used by method="loop".
+        kernel: Custom line spread function as a function kernel((wvs - wvs_curr) / wvs_curr). Optional.
+        method: Algorithm used for the convolution.
+            "sparse": Sparse banded convolution operator (see broaden_operator()), cached for each wavelength sampling
+                and resolution. Operators with more than broaden_max_nnz elements are not cached but applied by blocks
+                of rows. Exact.
+            "fft": FFT convolution on a grid uniform in log(wavelength). R must be a scalar. Exact if wvs is already
+                uniform in log(wavelength): the wavelengths where the FFT is not accurate enough (small weights near
+                large nan gaps, last bin) are computed directly. Otherwise the spectrum is linearly interpolated on a
+                grid with the finest sampling of wvs (at most broaden_fft_max_factor times the size of wvs), and the
+                result interpolated back to wvs, which is only approximate.
+            "loop": Original implementation looping over the wavelengths.
+            Default (None): "fft" for a scalar R if wvs is uniform in log(wavelength), "sparse" otherwise.
 
     Returns
         Broadened spectrum
     """
+    if method is None:
+        method = _broaden_method(wvs, R)
+    if method == "sparse":
+        if broaden_operator_nnz(wvs, R) > broaden_max_nnz:
+            return _broaden_sparse_blocks(wvs, spectrum, R, kernel=kernel)
+        return apply_broaden_operator(broaden_operator(wvs, R, kernel=kernel), spectrum)
+    elif method == "fft":
+        return _broaden_fft(wvs, spectrum, R, kernel=kernel)
+    elif method != "loop":
+        raise ValueError("Unknown broadening method {0}. Use sparse, fft or loop.".format(method))
+
     if mppool is None:
         # Each wavelength processed sequentially
         return _task_broaden((np.arange(np.size(spectrum)).astype(int),wvs,spectrum,R,kernel))
@@ -500,6 +532,184 @@ def broaden(wvs,spectrum,R,mppool=None,kernel=None):
 
         return conv_spectrum
 
+def _broaden_windows(wvs, R):
+    """ Standard deviation of the LSF, bin sizes and window [lo, hi) of each wavelength, as in _task_broaden(). """
+    wvs = np.asarray(wvs, dtype=float)
+    dwvs = wvs[1::] - wvs[0:(np.size(wvs) - 1)]
+    dwvs = np.append(dwvs,dwvs[-1])    # Size of each wavelength bin
+    sig = wvs / np.asarray(R, dtype=float) / (2 * np.sqrt(2 * np.log(2)))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        w = np.round(sig / dwvs * 10.)
+    w = np.where(np.isfinite(w), w, -1).astype(int)
+    k = np.arange(np.size(wvs))
+    lo = np.clip(k - w, 0, None)
+    hi = np.clip(np.minimum(np.size(wvs), k + w), lo, None)
+    return sig, dwvs, lo, hi
+
+def _is_log_uniform(wvs, rtol=1e-10):
+    if np.size(wvs) < 3 or np.any(np.asarray(wvs) <= 0):
+        return False
+    dlog = np.diff(np.log(wvs))
+    return bool(np.all(np.abs(dlog - dlog[0]) <= rtol * np.abs(dlog[0])) and dlog[0] > 0)
+
+def _broaden_method(wvs, R):
+    if np.ndim(R) != 0:
+        return "sparse"
+    return "fft" if _is_log_uniform(wvs) else "sparse"
+
+def broaden_operator_nnz(wvs, R):
+    """ Number of non-zero elements of broaden_operator(wvs, R), without building it. """
+    _, _, lo, hi = _broaden_windows(wvs, R)
+    return int(np.sum(hi - lo))
+
+def broaden_operator(wvs, R, kernel=None, cache=True):
+    """
+    Sparse banded matrix A such that broaden(wvs, spectrum, R) = A @ spectrum / A @ np.ones(...) for a spectrum
+    without nans. The operators are kept in broaden_operator_cache, so that the broadening of many spectra with the
+    same wavelength sampling only builds the operator once.
+
+    Args:
+        wvs: Wavelength vector (ndarray).
+        R: Resolution, scalar or vector of the same size as wvs. See broaden().
+        kernel: Custom line spread function. See broaden().
+        cache: If True (default), use broaden_operator_cache.
+
+    Returns:
+        A: scipy.sparse.csr_matrix of shape (N,N) with N the size of wvs. A[k,j] is the line spread function at
+            wavelength k evaluated at wavelength j times the size of the bin j.
+    """
+    wvs = np.asarray(wvs, dtype=float)
+    key = None
+    if cache:
+        try:
+            hash(kernel)
+        except TypeError:
+            cache = False
+    if cache:
+        key = (hashlib.sha1(wvs.tobytes()).hexdigest(), np.size(wvs),
+               hashlib.sha1(np.ascontiguousarray(R, dtype=float).tobytes()).hexdigest(), np.shape(R), kernel)
+        with _broaden_cache_lock:
+            A = broaden_operator_cache.get(key)
+        if A is not None:
+            return A
+
+    A = _broaden_operator_rows(wvs, _broaden_windows(wvs, R), kernel, 0, np.size(wvs))
+    if key is not None:
+        with _broaden_cache_lock:
+            broaden_operator_cache[key] = A
+    return A
+
+def _broaden_operator_rows(wvs, windows, kernel, start, stop):
+    """ Rows start:stop of broaden_operator() for the windows returned by _broaden_windows(). """
+    sig, dwvs, lo, hi = windows
+    sig = np.zeros(wvs.shape) + sig
+    counts = hi[start:stop] - lo[start:stop]
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    rows = np.repeat(np.arange(start, stop), counts)
+    cols = lo[rows] + np.arange(indptr[-1]) - indptr[rows - start]
+    if kernel is None:
+        values = 1 / (np.sqrt(2 * np.pi) * sig[rows]) * np.exp(-0.5 * (wvs[cols] - wvs[rows]) ** 2 / sig[rows] ** 2)
+    else:
+        values = np.asarray(kernel((wvs[cols] - wvs[rows]) / wvs[rows]), dtype=float)
+    return scipy.sparse.csr_matrix((values * dwvs[cols], cols, indptr), shape=(stop - start, np.size(wvs)))
+
+def _broaden_sparse_blocks(wvs, spectra, R, kernel=None):
+    """ Same as apply_broaden_operator(broaden_operator(wvs, R), spectra), building and applying the operator by
+    blocks of rows of at most broaden_max_nnz elements. """
+    wvs = np.asarray(wvs, dtype=float)
+    spectra = np.asarray(spectra, dtype=float)
+    windows = _broaden_windows(wvs, R)
+    nnz = np.cumsum(windows[3] - windows[2])
+    conv_spectra = np.zeros(spectra.shape)
+    start = 0
+    while start < np.size(wvs):
+        offset = nnz[start - 1] if start > 0 else 0
+        stop = max(start + 1, int(np.searchsorted(nnz, offset + broaden_max_nnz, side="right")))
+        conv_spectra[..., start:stop] = apply_broaden_operator(_broaden_operator_rows(wvs, windows, kernel, start, stop),
+                                                               spectra)
+        start = stop
+    return conv_spectra
+
+def apply_broaden_operator(A, spectra):
+    """
+    Broaden spectra with an operator from broaden_operator(), ignoring the nans as in broaden().
+
+    Args:
+        A: Broadening operator of shape (N,N).
+        spectra: Spectrum of size N, or array of spectra of shape (M,N).
+
+    Returns:
+        Broadened spectra with the same shape as spectra.
+    """
+    spectra = np.asarray(spectra, dtype=float)
+    valid = ~np.isnan(spectra)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if np.all(valid):
+            # Same normalisation for all the spectra
+            return (A @ spectra.T).T / (A @ np.ones(A.shape[1]))
+        return ((A @ np.where(valid, spectra, 0).T) / (A @ valid.T.astype(float))).T
+
+def _broaden_fft(wvs, spectrum, R, kernel=None):
+    """ FFT implementation of broaden() for a scalar resolution R. See broaden(). """
+    if np.ndim(R) != 0:
+        raise ValueError("The fft broadening requires a scalar resolution.")
+    wvs = np.asarray(wvs, dtype=float)
+    spectrum = np.asarray(spectrum, dtype=float)
+    valid = ~np.isnan(spectrum)
+    grid_spec = np.where(valid, spectrum, 0)
+    grid_valid = valid.astype(float)
+    log_uniform = _is_log_uniform(wvs)
+    if log_uniform:
+        grid_wvs = wvs
+        dlog = (np.log(wvs[-1]) - np.log(wvs[0])) / (np.size(wvs) - 1)
+    else:
+        dlog = np.min(np.diff(np.log(wvs)))
+        if not dlog > 0:
+            raise ValueError("The fft broadening requires strictly increasing wavelengths.")
+        grid_size = (np.log(wvs[-1]) - np.log(wvs[0])) / dlog + 1
+        if grid_size > broaden_fft_max_factor * np.size(wvs):
+            raise ValueError("The fft broadening of this irregular wavelength sampling requires a grid of {0:.0f} "
+                             "bins. Use method=\"sparse\".".format(grid_size))
+        grid_wvs = np.exp(np.arange(np.log(wvs[0]), np.log(wvs[-1]) + dlog / 2, dlog))
+        # The nans are interpolated as zero weights
+        grid_spec = np.interp(grid_wvs, wvs, grid_spec)
+        grid_valid = np.interp(grid_wvs, wvs, grid_valid)
+
+    # On a uniform log(wavelength) grid, the window and the line spread function in units of bins are the same for
+    # all the wavelengths, and the broadening is a convolution. Same window [k-w, k+w) as in _task_broaden().
+    dwvs = grid_wvs[1::] - grid_wvs[0:(np.size(grid_wvs) - 1)]
+    dwvs = np.append(dwvs, dwvs[-1])
+    sig_rel = 1 / R / (2 * np.sqrt(2 * np.log(2)))
+    w = int(np.round(sig_rel / np.expm1(dlog) * 10.))
+    if w <= 0:
+        # Line spread function narrower than the bins: empty windows, as in _task_broaden()
+        return np.zeros(spectrum.shape) + np.nan
+    rel = np.expm1(np.arange(-w, w) * dlog)
+    if kernel is None:
+        lsf = np.exp(-0.5 * rel ** 2 / sig_rel ** 2)
+    else:
+        lsf = np.asarray(kernel(rel), dtype=float)
+    num = scipy.signal.fftconvolve(grid_spec * dwvs, lsf[::-1], mode="full")[w - 1:w - 1 + np.size(grid_wvs)]
+    den = scipy.signal.fftconvolve(grid_valid * dwvs, lsf[::-1], mode="full")[w - 1:w - 1 + np.size(grid_wvs)]
+    if not log_uniform:
+        # Round-off errors of the FFT where no valid bin is in the window
+        den[np.abs(den) <= 1e-12 * np.max(np.abs(den))] = 0
+        num = np.interp(wvs, grid_wvs, num)
+        den = np.interp(wvs, grid_wvs, den)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(den != 0, num / den, np.nan)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        conv_spectrum = num / den
+    # The round-off errors of the FFT are relative to the largest values: the wavelengths where the valid bins only
+    # have a small weight (next to large nan gaps) are computed directly, as well as the last bin, whose window can
+    # differ by one bin (see _broaden_windows()).
+    inaccurate = np.abs(den) <= 1e-4 * np.max(np.abs(den))
+    inaccurate[-1] = True
+    indices = np.where(inaccurate)[0]
+    conv_spectrum[indices] = _task_broaden((indices, wvs, spectrum, R, kernel))
+    return conv_spectrum
+
 def clean_nans(arr, set_to="median", allowed_range=None, continuum=None):
     """
 
@@ -585,44 +795,134 @@ def file_directory(file):
     return os.path.dirname(local(file))
 
 def LPFvsHPF(myvec, cutoff):
-    """ Ask JB to write documentation!
+    """ Split a spectrum into its low-pass and high-pass filtered components.
+    The low-pass filter keeps the first cutoff Fourier modes of the spectrum mirrored to twice its length. The nans are
+    temporarily replaced with a running median of the spectrum (window of np.size(myvec)/cutoff bins) and set back to
+    nan in the outputs.
 
     Parameters
     ----------
-    myvec
-    cutoff
+    myvec : ndarray
+        Spectrum. A 2d array (or more) is processed as a batch of spectra along its last axis, e.g. all the spaxels of
+        a cube with np.reshape(cube.T, (nx*ny, nz)).
+    cutoff : int
+        Number of Fourier modes kept in the low-pass filter. The higher the cutoff, the more aggressive the high-pass
+        filter.
 
     Returns
     -------
-
+    LPF_myvec, HPF_myvec : ndarrays with the same shape as myvec.
     """
-    myvec_cp = copy(myvec)
+    myvec = np.asarray(myvec, dtype=float)
+    nz = myvec.shape[-1]
+    myvec_cp = np.array(myvec).reshape(-1, nz)
     #handling nans:
-    wherenans = np.where(np.isnan(myvec_cp))
-    window = int(round(np.size(myvec_cp)/(cutoff/2.)/2.))#cutoff
-    tmp = np.array(pd.DataFrame(np.concatenate([myvec_cp, myvec_cp[::-1]], axis=0)).interpolate(method="linear").fillna(method="bfill").fillna(method="ffill"))
-    myvec_cp_lpf = np.array(pd.DataFrame(tmp).rolling(window=window, center=True).median().interpolate(method="linear").fillna(method="bfill").fillna(method="ffill"))[0:np.size(myvec), 0]
-    myvec_cp[wherenans] = myvec_cp_lpf[wherenans]
-
-
-    fftmyvec = np.fft.fft(np.concatenate([myvec_cp, myvec_cp[::-1]], axis=0))
-    LPF_fftmyvec = copy(fftmyvec)
-    LPF_fftmyvec[cutoff:(2*np.size(myvec_cp)-cutoff+1)] = 0
-    LPF_myvec = np.real(np.fft.ifft(LPF_fftmyvec))[0:np.size(myvec_cp)]
+    wherenans = np.isnan(myvec_cp)
+    window = int(round(nz/(cutoff/2.)/2.))#cutoff
+    rows_with_nans = np.where(np.any(wherenans, axis=1))[0]
+    if np.size(rows_with_nans) != 0:
+        tmp = _interpolate_nans(np.concatenate([myvec_cp[rows_with_nans], myvec_cp[rows_with_nans, ::-1]], axis=1))
+        rows, cols = np.where(wherenans[rows_with_nans])
+        myvec_cp[rows_with_nans[rows], cols] = _running_median_at(tmp, window, rows, cols)
+
+    fftmyvec = np.fft.rfft(np.concatenate([myvec_cp, myvec_cp[:, ::-1]], axis=1), axis=1)
+    fftmyvec[:, cutoff::] = 0
+    LPF_myvec = np.fft.irfft(fftmyvec, n=2 * nz, axis=1)[:, 0:nz]
     HPF_myvec = myvec_cp - LPF_myvec
 
-
     LPF_myvec[wherenans] = np.nan
     HPF_myvec[wherenans] = np.nan
+    return LPF_myvec.reshape(myvec.shape), HPF_myvec.reshape(myvec.shape)
+
+def _interpolate_nans(arr):
+    """ Linear interpolation of the nans along the last axis of a 2d array, constant beyond the first and last valid
+    values. Rows without valid values stay nan. """
+    nz = arr.shape[1]
+    valid = ~np.isnan(arr)
+    indices = np.arange(nz)
+    prev = np.maximum.accumulate(np.where(valid, indices, -1), axis=1)
+    nxt = np.minimum.accumulate(np.where(valid, indices, nz)[:, ::-1], axis=1)[:, ::-1]
+    prev = np.where(prev < 0, nxt, prev)
+    nxt = np.where(nxt >= nz, prev, nxt)
+    rows = np.arange(arr.shape[0])[:, None]
+    prev_val = arr[rows, np.clip(prev, 0, nz - 1)]
+    next_val = arr[rows, np.clip(nxt, 0, nz - 1)]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slope = (next_val - prev_val) / (nxt - prev)
+        out = np.where(nxt == prev, prev_val, slope * (indices - prev) + prev_val)
+    return np.where(valid, arr, np.where(prev >= nz, np.nan, out))
+
+def _running_median_at(arr, window, rows, cols, chunk_size=2 ** 22):
+    """ Centered running median of the rows of arr (without nans), as pandas rolling(window, center=True).median()
+    with the incomplete windows at the edges replaced by the closest complete one, evaluated at (rows, cols). """
+    nz = arr.shape[1]
+    if window > nz:
+        return np.zeros(np.size(rows)) + np.nan
+    starts = np.clip(np.asarray(cols) - window // 2, 0, nz - window)
+    out = np.zeros(np.size(rows))
+    step = max(1, chunk_size // window)
+    for k in range(0, np.size(rows), step):
+        windows = arr[np.asarray(rows)[k:k + step, None], starts[k:k + step, None] + np.arange(window)[None, :]]
+        out[k:k + step] = _median_last_axis(windows)
+    return out
+
+def _median_last_axis(windows):
+    window = windows.shape[-1]
+    if window % 2 == 1:
+        return np.partition(windows, window // 2, axis=-1)[..., window // 2]
+    part = np.partition(windows, [window // 2 - 1, window // 2], axis=-1)
+    return (part[..., window // 2 - 1] + part[..., window // 2]) / 2
+
+def mirrored_running_median(data, window):
+    """ Running median (see running_median()) of a spectrum mirrored to twice its length after the linear
+    interpolation of its nans. Used as the continuum of the spectra, e.g. in OSIRIS.set_noise().
 
-    # plt.figure(10)
-    # plt.plot(myvec_cp,label="fixed")
-    # plt.plot(myvec,label="ori")
-    # plt.plot(myvec_cp_lpf,label="lpf")
-    # plt.plot(LPF_myvec,label="lpf fft")
-    # plt.legend()
-    # plt.show()
-    return LPF_myvec,HPF_myvec
+    Parameters
+    ----------
+    data : ndarray
+        Spectrum, or batch of spectra along the last axis.
+    window : int
+        Size of the window.
+
+    Returns
+    -------
+    ndarray with the same shape as data.
+    """
+    data = np.asarray(data, dtype=float)
+    nz = data.shape[-1]
+    rows = data.reshape(-1, nz)
+    tmp = _interpolate_nans(np.concatenate([rows, rows[:, ::-1]], axis=1))
+    return running_median(tmp, window)[:, 0:nz].reshape(data.shape)
+
+def running_median(arr, window):
+    """ Centered running median along the last axis, as pandas rolling(window, center=True).median(), with the
+    incomplete windows at the edges replaced by the closest complete one (bfill/ffill).
+
+    Parameters
+    ----------
+    arr : ndarray
+        1d array or batch of arrays along the last axis, without nans.
+    window : int
+        Size of the window.
+
+    Returns
+    -------
+    ndarray with the same shape as arr.
+    """
+    arr = np.asarray(arr, dtype=float)
+    nz = arr.shape[-1]
+    rows = arr.reshape(-1, nz)
+    if window > nz:
+        return np.zeros(arr.shape) + np.nan
+    out = np.zeros(rows.shape)
+    for k, row in enumerate(rows):
+        med = median_filter(row, size=window) if window % 2 == 1 else \
+            (rank_filter(row, window // 2 - 1, size=window) + rank_filter(row, window // 2, size=window)) / 2
+        # Same window [i-window//2, i-window//2+window) as pandas, only the complete windows are kept
+        start = window // 2
+        stop = nz - window + window // 2
+        out[k] = med[np.clip(np.arange(nz), start, stop)]
+    return out.reshape(arr.shape)
 
 def gaussian2D(nx, ny, mu_x, mu_y, sig_x, sig_y, A):
     """ Two Dimensional Gaussian for getting PSF for different wavelength slices
@@ -647,11 +947,14 @@ def gaussian2D(nx, ny, mu_x, mu_y, sig_x, sig_y, A):
         np.exp(-((y_vals - mu_y) ** 2) / (2 * sig_y * sig_y))
     return gauss
 
-def get_spline_model(x_knots, x_samples, spline_degree=3):
+def get_spline_model(x_knots, x_samples, spline_degree=3, sparse=False, cache=True):
     """ Compute a spline based linear model.
     If Y = [y1, y2, ...] are the values of the function at the location of the node [x1,x2,...].
     np.dot(M,Y) is the interpolated spline corresponding to the sampling of the x-axis (x_samples)
 
+    The columns are the interpolating splines of the unit vectors (same basis as InterpolatedUnivariateSpline), computed
+    as the B-spline design matrix of x_samples times the B-spline coefficients of the unit vectors. The matrices are
+    kept in spline_model_cache, so that the model of a sampling already seen is not recomputed.
 
     Args:
         x_knots: List of nodes for the spline interpolation as np.ndarray in the same units as x_samples.
@@ -659,6 +962,10 @@ def get_spline_model(x_knots, x_samples, spline_degree=3):
         x_samples: Vector of x values. ie, the sampling of the data.
         spline_degree: Degree of the spline interpolation (default: 3).
             if np.size(x_knots) <= spline_degree, then spline_degree = np.size(x_knots)-1
+        sparse: If True, return M as a scipy.sparse.csr_matrix. The interpolating splines have a global support, so
+            only the samples outside of the nodes and the different segments of a discontinuous model give zeros.
+            Default False.
+        cache: If True (default), use spline_model_cache.
 
     Returns:
         M: Matrix of size (D,N) with D the size of x_samples and N the total number of nodes.
@@ -669,24 +976,57 @@ def get_spline_model(x_knots, x_samples, spline_degree=3):
         x_knots_list = [x_knots]
 
     if np.size(x_knots_list) <= 1:
-        return np.ones((np.size(x_samples),1))
+        M = np.ones((np.size(x_samples),1))
+        return scipy.sparse.csr_matrix(M) if sparse else M
     if np.size(x_knots_list) <= spline_degree:
         spline_degree = np.size(x_knots)-1
 
+    x_samples = np.asarray(x_samples)
+    key = None
+    if cache:
+        sha = hashlib.sha1(np.ascontiguousarray(x_samples, dtype=float).tobytes())
+        for nodes in x_knots_list:
+            sha.update(np.ascontiguousarray(nodes, dtype=float).tobytes())
+            sha.update(b"|")
+        key = (sha.hexdigest(), np.size(x_samples), int(spline_degree), bool(sparse))
+        with _spline_cache_lock:
+            M = spline_model_cache.get(key)
+        if M is not None:
+            return M.copy()
+
     M_list = []
     for nodes in x_knots_list:
-        M = np.zeros((np.size(x_samples), np.size(nodes)))
+        nodes = np.asarray(nodes, dtype=float)
         min,max = np.min(nodes),np.max(nodes)
         inbounds = np.where((min<x_samples)&(x_samples<max))
-        _x = x_samples[inbounds]
-
-        for chunk in range(np.size(nodes)):
-            tmp_y_vec = np.zeros(np.size(nodes))
-            tmp_y_vec[chunk] = 1
-            spl = InterpolatedUnivariateSpline(nodes, tmp_y_vec, k=spline_degree, ext=0)
-            M[inbounds[0], chunk] = spl(_x)
+        t, coefs = _spline_coefficients(nodes, spline_degree)
+        M = np.zeros((np.size(x_samples), np.size(nodes)))
+        M[inbounds[0], :] = BSpline.design_matrix(x_samples[inbounds], t, spline_degree) @ coefs
         M_list.append(M)
-    return np.concatenate(M_list, axis=1)
+    M = np.concatenate(M_list, axis=1)
+    if sparse:
+        M = scipy.sparse.csr_matrix(M)
+    if key is not None:
+        with _spline_cache_lock:
+            spline_model_cache[key] = M
+        return M.copy()
+    return M
+
+
+def _spline_coefficients(nodes, spline_degree):
+    """
+    Knots t and B-spline coefficients (shape (N_coefs, N_nodes)) of the splines interpolating the unit vectors on the
+    nodes, with the same not-a-knot boundary conditions as InterpolatedUnivariateSpline.
+    """
+    key = (nodes.tobytes(), int(spline_degree))
+    with _spline_cache_lock:
+        out = _spline_coefficients_cache.get(key)
+    if out is None:
+        spl = make_interp_spline(nodes, np.eye(np.size(nodes)), k=spline_degree)
+        out = (spl.t, spl.c)
+        with _spline_cache_lock:
+            _spline_coefficients_cache[key] = out
+    return out
 
 def broaden_kernel(wvs,spectrum,kernel):
     """ Broaden a spectrum to instrument resolution assuming a custom kernel.
@@ -932,3 +1272,46 @@ def pixgauss2d(p, shape, hdfactor=10, xhdgrid=None, yhdgrid=None):
         -0.5 * ((xA - xhdgrid) ** 2 + (yA - yhdgrid) ** 2) / w ** 2)
     gaussA = np.nanmean(np.reshape(gaussA_hd, (ny, hdfactor, nx, hdfactor)), axis=(1, 3))
     return gaussA + bkg
+
+class LRUCache(OrderedDict):
+    """ Dictionary holding at most maxsize items. The least recently used items are discarded first.
+    The number of successful (hits) and failed (misses) lookups through get() are counted.
+
+    Args:
+        maxsize: Maximum number of items in the cache. No limit if None.
+    """
+    def __init__(self, maxsize=128):
+        super().__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self:
+            self.hits += 1
+            self.move_to_end(key)
+            return super().__getitem__(key)
+        self.misses += 1
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if self.maxsize is not None and len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+# Matrices computed by get_spline_model(), e.g. one per detector row. Change spline_model_cache.maxsize to trade memory
+# for speed.
+spline_model_cache = LRUCache(maxsize=256)
+_spline_coefficients_cache = LRUCache(maxsize=256)
+# The caches can be used by several threads, see backend in breads.grid_search.grid_search()
+_spline_cache_lock = threading.Lock()
+# Operators computed by broaden_operator(), e.g. one per wavelength sampling and resolution. Each operator can take up
+# to ~12 bytes x broaden_max_nnz.
+broaden_operator_cache = LRUCache(maxsize=16)
+_broaden_cache_lock = threading.Lock()
+# Largest number of non-zero elements of a cached broadening operator, larger ones are applied by blocks of rows
+broaden_max_nnz = 5 * 10 ** 6
+# Largest size of the log(wavelength) grid of broaden(..., method="fft") relative to the size of an irregular sampling
+broaden_fft_max_factor = 8
@@ -7,6 +7,7 @@ import astropy.io.fits as pyfits
 
 from breads.instruments.OSIRIS import OSIRIS
 from breads.grid_search import grid_search
+from breads.parallel import Executor
 from breads.fm.hc_splinefm import hc_splinefm
 from breads.fm.iso_hpffm import iso_hpffm
 from breads.fm.hc_hpffm import hc_hpffm
@@ -109,7 +110,9 @@ if __name__ == "__main__":
     rvs = np.array([-15])
     ys = np.arange(ny)
     xs = np.arange(nx)
-    log_prob,log_prob_H0,rchi2,linparas,linparas_err = grid_search([rvs,ys,xs],dataobj,fm_func,fm_paras,numthreads=numthreads, computeH0=True)
+    # Keep the worker processes, with dataobj and fm_paras already installed, for the following grid searches
+    executor = Executor(numthreads, dataobj=dataobj, fm_paras=fm_paras)
+    log_prob,log_prob_H0,rchi2,linparas,linparas_err = grid_search([rvs,ys,xs],dataobj,fm_func,fm_paras,mypool=executor, computeH0=True)
     N_linpara = linparas.shape[-1]
 
     # print('how big:',np.size(log_prob), np.size(log_prob_H0))
@@ -117,7 +120,9 @@ if __name__ == "__main__":
     k,l,m = np.unravel_index(np.nanargmax(log_prob-log_prob_H0),log_prob.shape)
     print("best fit parameters: rv={0},y={1},x={2}".format(rvs[k],ys[l],xs[m]) )
     print(np.nanmax(log_prob-log_prob_H0))
-    best_log_prob,best_log_prob_H0,_,_,_ = grid_search([[rvs[k]], [ys[l]], [xs[m]]], dataobj, fm_func, fm_paras, numthreads=None)
+    best_log_prob,best_log_prob_H0,_,_,_ = grid_search([[rvs[k]], [ys[l]], [xs[m]]], dataobj, fm_func, fm_paras, mypool=executor)
+    executor.close()
+    executor.join()
     print(best_log_prob-best_log_prob_H0)
 
     plt.figure(1)